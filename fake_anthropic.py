@@ -0,0 +1,439 @@
+"""
+Fake Anthropic Messages API за офлайн тестове и benchmark-и на LLM pipeline-а.
+
+Локален HTTP сървър, който имитира POST /v1/messages (включително streaming/SSE):
+- Връща записани отговори по hash на prompt-а (model + system + messages)
+- Инжектира латентност, 429/529 грешки, невалиден JSON и отрязани отговори
+- Отчита използваните токени (usage) и статистика на GET /stats
+- В режим --record препраща пропуснатите заявки към истинското API и ги записва
+
+Кодът в scraper.py работи без промени чрез base URL override:
+
+    python fake_anthropic.py --fixtures fixtures/anthropic --port 8765 --error-rate 0.1
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 ANTHROPIC_API_KEY=fake python scraper.py
+
+От Python (напр. в benchmark):
+
+    with FakeAnthropicServer(fixtures_dir="fixtures/anthropic", latency=0.2) as server:
+        os.environ['ANTHROPIC_BASE_URL'] = server.base_url
+        ...
+        print(server.stats)
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import urllib.request
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+UPSTREAM_URL = "https://api.anthropic.com"
+
+ERROR_TYPES = {
+    429: "rate_limit_error",
+    500: "api_error",
+    529: "overloaded_error",
+}
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    """HTTP сървър, който не логва връзки, прекъснати от клиента (stream cancel, retry)."""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def prompt_hash(request_body):
+    """
+    Стабилен hash на заявката - определя кой записан отговор да се върне.
+    Параметри като max_tokens и stream не влизат в hash-а.
+    """
+    key = {
+        "model": request_body.get("model"),
+        "system": request_body.get("system"),
+        "messages": request_body.get("messages"),
+    }
+    canonical = json.dumps(key, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:24]
+
+
+def estimate_tokens(value):
+    """Груба оценка на токените (~4 символа на токен) когато fixture-ът няма usage."""
+    if isinstance(value, str):
+        return max(1, len(value) // 4)
+    total = 0
+    for message in value or []:
+        content = message.get("content") if isinstance(message, dict) else message
+        if isinstance(content, str):
+            total += len(content) // 4
+        elif isinstance(content, list):
+            for block in content:
+                if block.get("type") == "text":
+                    total += len(block.get("text", "")) // 4
+                elif block.get("type") == "image":
+                    # Anthropic таксува изображенията по размер; тук само приблизително
+                    total += len(block.get("source", {}).get("data", "")) // 1000
+    return max(1, total)
+
+
+class FakeAnthropicServer:
+    """
+    Fake Messages API сървър с fault injection.
+
+    Args:
+        fixtures_dir: Директория с записани отговори ({hash}.json)
+        latency: Фиксирана латентност в секунди преди всеки отговор
+        latency_jitter: Случайна добавка към латентността (0..jitter)
+        error_rate: Вероятност за HTTP грешка (статус от error_statuses)
+        error_statuses: HTTP статуси за инжектиране (по подразбиране 429 и 529)
+        malformed_rate: Вероятност отговорът да е с повреден JSON
+        truncate_rate: Вероятност отговорът да е отрязан (stop_reason=max_tokens)
+        default_text: Отговор при липсващ fixture (None -> 400 грешка)
+        record: Препраща пропуснатите заявки към истинското API и ги записва
+        stream_chunk_size: Символи на SSE delta при streaming
+        stream_chunk_delay: Пауза между SSE delta-ите в секунди
+        seed: Seed за възпроизводими грешки
+    """
+
+    def __init__(self, fixtures_dir=None, host="127.0.0.1", port=0,
+                 latency=0.0, latency_jitter=0.0, error_rate=0.0, error_statuses=(429, 529),
+                 malformed_rate=0.0, truncate_rate=0.0, default_text=None, record=False,
+                 stream_chunk_size=40, stream_chunk_delay=0.0, seed=None):
+        self.fixtures_dir = fixtures_dir
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.malformed_rate = malformed_rate
+        self.truncate_rate = truncate_rate
+        self.default_text = default_text
+        self.record = record
+        self.stream_chunk_size = stream_chunk_size
+        self.stream_chunk_delay = stream_chunk_delay
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.fixtures = {}
+        self.httpd = None
+        self.thread = None
+        self.reset_stats()
+        self.load_fixtures()
+
+    # -------------------------------------------------------------------------
+    # Fixtures
+    # -------------------------------------------------------------------------
+
+    def load_fixtures(self):
+        """Зарежда всички записани отговори от fixtures_dir."""
+        self.fixtures = {}
+        if not self.fixtures_dir or not os.path.isdir(self.fixtures_dir):
+            return
+        for filename in os.listdir(self.fixtures_dir):
+            if not filename.endswith('.json'):
+                continue
+            with open(os.path.join(self.fixtures_dir, filename), encoding='utf-8') as f:
+                self.fixtures[filename[:-5]] = json.load(f)
+
+    def add_fixture(self, request_body, text, usage=None, save=False):
+        """Добавя отговор за дадена заявка (и по желание го записва на диска)."""
+        key = prompt_hash(request_body)
+        fixture = {"text": text}
+        if usage:
+            fixture["usage"] = usage
+        with self.lock:
+            self.fixtures[key] = fixture
+        if save and self.fixtures_dir:
+            os.makedirs(self.fixtures_dir, exist_ok=True)
+            with open(os.path.join(self.fixtures_dir, key + '.json'), 'w', encoding='utf-8') as f:
+                json.dump(fixture, f, ensure_ascii=False, indent=2)
+        return key
+
+    def fetch_upstream(self, request_body):
+        """Изпълнява заявката към истинското API (без streaming) за режим --record."""
+        body = dict(request_body)
+        body.pop("stream", None)
+        request = urllib.request.Request(
+            UPSTREAM_URL + "/v1/messages",
+            data=json.dumps(body).encode('utf-8'),
+            headers={
+                "content-type": "application/json",
+                "x-api-key": os.environ.get("ANTHROPIC_API_KEY", ""),
+                "anthropic-version": "2023-06-01",
+            },
+        )
+        with urllib.request.urlopen(request, timeout=120) as response:
+            message = json.loads(response.read())
+        text = "".join(block.get("text", "") for block in message.get("content", []))
+        return self.add_fixture(request_body, text, usage=message.get("usage"), save=True)
+
+    # -------------------------------------------------------------------------
+    # Статистика
+    # -------------------------------------------------------------------------
+
+    def reset_stats(self):
+        self.stats = {
+            "requests": 0,
+            "responses": 0,
+            "stream_requests": 0,
+            "fixture_misses": 0,
+            "injected_errors": {},
+            "malformed": 0,
+            "truncated": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "requests_per_hash": {},
+            "total_latency": 0.0,
+        }
+
+    def _count(self, field, amount=1):
+        with self.lock:
+            self.stats[field] += amount
+
+    def retried_requests(self):
+        """Брой заявки, повторени със същия prompt (обикновено retry от SDK-то)."""
+        with self.lock:
+            return sum(n - 1 for n in self.stats["requests_per_hash"].values() if n > 1)
+
+    # -------------------------------------------------------------------------
+    # Обработка на заявка
+    # -------------------------------------------------------------------------
+
+    def plan_response(self, request_body):
+        """
+        Решава какво да се върне за заявката.
+
+        Returns:
+            tuple (status, payload) - payload е dict за грешка или за съобщение
+        """
+        key = prompt_hash(request_body)
+        with self.lock:
+            self.stats["requests"] += 1
+            per_hash = self.stats["requests_per_hash"]
+            per_hash[key] = per_hash.get(key, 0) + 1
+
+        delay = self.latency + (self.random.uniform(0, self.latency_jitter) if self.latency_jitter else 0)
+        if delay:
+            time.sleep(delay)
+            self._count("total_latency", delay)
+
+        if self.error_rate and self.random.random() < self.error_rate:
+            status = self.random.choice(self.error_statuses)
+            with self.lock:
+                errors = self.stats["injected_errors"]
+                errors[status] = errors.get(status, 0) + 1
+            return status, {
+                "type": "error",
+                "error": {"type": ERROR_TYPES.get(status, "api_error"), "message": f"Injected {status}"},
+            }
+
+        fixture = self.fixtures.get(key)
+        if fixture is None and self.record:
+            try:
+                fixture = self.fixtures[self.fetch_upstream(request_body)]
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                return 502, {"type": "error", "error": {"type": "api_error", "message": f"Upstream: {e}"}}
+        if fixture is None:
+            self._count("fixture_misses")
+            if self.default_text is None:
+                return 400, {
+                    "type": "error",
+                    "error": {"type": "invalid_request_error", "message": f"No fixture for prompt hash {key}"},
+                }
+            fixture = {"text": self.default_text}
+
+        text = fixture["text"]
+        stop_reason = "end_turn"
+        if self.malformed_rate and self.random.random() < self.malformed_rate:
+            # Типични LLM повреди: изпусната кавичка и trailing comma
+            text = text.replace('"', '', 1).replace('}', '},', 1)
+            self._count("malformed")
+        if self.truncate_rate and self.random.random() < self.truncate_rate:
+            text = text[:max(1, int(len(text) * self.random.uniform(0.3, 0.8)))]
+            stop_reason = "max_tokens"
+            self._count("truncated")
+
+        usage = dict(fixture.get("usage") or {})
+        usage.setdefault("input_tokens", estimate_tokens(request_body.get("messages")))
+        usage["output_tokens"] = estimate_tokens(text) if stop_reason == "max_tokens" else usage.get("output_tokens", estimate_tokens(text))
+        self._count("input_tokens", usage["input_tokens"])
+        self._count("output_tokens", usage["output_tokens"])
+        self._count("responses")
+
+        return 200, {
+            "id": "msg_fake_" + key,
+            "type": "message",
+            "role": "assistant",
+            "model": request_body.get("model", "fake"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": usage,
+        }
+
+    def stream_events(self, message):
+        """Генерира SSE събитията за streaming отговор."""
+        text = message["content"][0]["text"]
+        start = dict(message, content=[], stop_reason=None)
+        start["usage"] = {"input_tokens": message["usage"]["input_tokens"], "output_tokens": 1}
+        yield "message_start", {"type": "message_start", "message": start}
+        yield "content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}
+        for i in range(0, len(text), self.stream_chunk_size):
+            if self.stream_chunk_delay:
+                time.sleep(self.stream_chunk_delay)
+            yield "content_block_delta", {
+                "type": "content_block_delta", "index": 0,
+                "delta": {"type": "text_delta", "text": text[i:i + self.stream_chunk_size]},
+            }
+        yield "content_block_stop", {"type": "content_block_stop", "index": 0}
+        yield "message_delta", {
+            "type": "message_delta",
+            "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None},
+            "usage": {"output_tokens": message["usage"]["output_tokens"]},
+        }
+        yield "message_stop", {"type": "message_stop"}
+
+    # -------------------------------------------------------------------------
+    # Жизнен цикъл
+    # -------------------------------------------------------------------------
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, payload, headers=None):
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.rstrip('/') == "/stats":
+                    with server.lock:
+                        stats = json.loads(json.dumps(server.stats))
+                    stats["retried_requests"] = server.retried_requests()
+                    self._send_json(200, stats)
+                else:
+                    self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+            def do_POST(self):
+                if not self.path.split('?')[0].endswith("/v1/messages"):
+                    self._send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+                    return
+                length = int(self.headers.get("content-length") or 0)
+                try:
+                    request_body = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    self._send_json(400, {"type": "error", "error": {"type": "invalid_request_error", "message": "Invalid JSON"}})
+                    return
+
+                status, payload = server.plan_response(request_body)
+                if status != 200:
+                    headers = {"retry-after": "1"} if status in (429, 529) else None
+                    self._send_json(status, payload, headers)
+                    return
+
+                if not request_body.get("stream"):
+                    self._send_json(200, payload)
+                    return
+
+                server._count("stream_requests")
+                self.send_response(200)
+                self.send_header("content-type", "text/event-stream")
+                self.send_header("cache-control", "no-cache")
+                self.send_header("connection", "close")
+                self.end_headers()
+                try:
+                    for event, data in server.stream_events(payload):
+                        chunk = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                        self.wfile.write(chunk.encode('utf-8'))
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # Клиентът е прекъснал stream-а (напр. след края на JSON масива)
+                    pass
+                self.close_connection = True
+
+        self.httpd = QuietHTTPServer((self.host, self.port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Anthropic Messages API за офлайн тестове")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fixtures", default="fixtures/anthropic", help="Директория със записани отговори")
+    parser.add_argument("--latency", type=float, default=0.0, help="Латентност в секунди")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Случайна добавка към латентността")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Дял заявки с 429/529 грешка")
+    parser.add_argument("--error-statuses", default="429,529", help="HTTP статуси за инжектиране")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Дял отговори с повреден JSON")
+    parser.add_argument("--truncate-rate", type=float, default=0.0, help="Дял отрязани отговори")
+    parser.add_argument("--default-text", default=None, help="Отговор при липсващ fixture")
+    parser.add_argument("--record", action="store_true", help="Записва пропуснатите заявки от истинското API")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="Пауза между SSE delta-ите")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = FakeAnthropicServer(
+        fixtures_dir=args.fixtures, host=args.host, port=args.port,
+        latency=args.latency, latency_jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_statuses=[int(s) for s in args.error_statuses.split(',') if s.strip()],
+        malformed_rate=args.malformed_rate, truncate_rate=args.truncate_rate,
+        default_text=args.default_text, record=args.record,
+        stream_chunk_delay=args.chunk_delay, seed=args.seed,
+    ).start()
+
+    print(f"Fake Anthropic API: {server.base_url} ({len(server.fixtures)} fixtures)")
+    print(f"  ANTHROPIC_BASE_URL={server.base_url} ANTHROPIC_API_KEY=fake python scraper.py")
+    print(f"  Статистика: {server.base_url}/stats")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(json.dumps(server.stats, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""
+Fake Google Sheets backend за офлайн тестове на записа в Sheets.
+
+Имитира частта от gspread, която scraper.py използва:
+- Client.open_by_key
+- Spreadsheet.worksheets / add_worksheet / fetch_sheet_metadata
+- Spreadsheet.batch_update / values_batch_update / values_batch_clear
+- Worksheet.col_values, title, id, row_count, col_count
+
+Поведение:
+- Пази клетките, условните правила, developer metadata и размерите на листовете
+  в паметта, по желание и в JSON файл между стартиранията
+- Записи и формати извън размера на листа връщат 400, както истинското API
+- Инжектира 429/503 грешки и връща 429 при превишена квота за минута
+- Брои заявките по метод (stats)
+
+scraper.py го използва чрез HARMONICA_FAKE_SHEETS (":memory:" или път до JSON):
+
+    HARMONICA_FAKE_SHEETS=.cache/fake_sheets.json SPREADSHEET_ID=fake python scraper.py
+    python fake_sheets.py --state .cache/fake_sheets.json --sheet "Ценови Тракер"
+
+От Python (напр. в тест на SheetsGateway):
+
+    client = FakeSheetsClient(error_rate=0.2, seed=1)
+    spreadsheet = client.open_by_key("fake")
+    ...
+    print(client.stats)
+"""
+
+import os
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import a1_to_rowcol
+
+ERROR_STATUSES = {
+    400: "INVALID_ARGUMENT",
+    429: "RESOURCE_EXHAUSTED",
+    500: "INTERNAL",
+    503: "UNAVAILABLE",
+}
+
+_RANGE_RE = re.compile(r"^(?:'((?:[^']|'')+)'|([^!]+))(?:!(.+))?$")
+
+
+class FakeResponse:
+    """Минимален requests.Response, достатъчен за gspread.exceptions.APIError."""
+
+    def __init__(self, status, message, headers=None):
+        self.status_code = status
+        self.headers = headers or {}
+        self._body = {"error": {"code": status, "message": message, "status": ERROR_STATUSES.get(status, "UNKNOWN")}}
+        self.text = json.dumps(self._body)
+
+    def json(self):
+        return self._body
+
+
+def api_error(status, message, headers=None):
+    return APIError(FakeResponse(status, message, headers))
+
+
+def parse_range(range_name):
+    """
+    "'Лист'!A5:R7" -> (лист, начален ред, начална колона, краен ред, крайна колона)
+    с 0-базирани индекси и невключен край; без диапазон - None за границите.
+    """
+    match = _RANGE_RE.match(range_name)
+    if not match:
+        raise api_error(400, f"Unable to parse range: {range_name}")
+    title = (match.group(1) or "").replace("''", "'") or match.group(2)
+    cells = match.group(3)
+    if not cells:
+        return title, None, None, None, None
+    start, _, end = cells.partition(':')
+    start_row, start_col = a1_to_rowcol(start)
+    end_row, end_col = a1_to_rowcol(end) if end else (None, None)
+    return title, start_row - 1, start_col - 1, end_row, end_col
+
+
+class FakeWorksheet:
+    """Един лист: клетки {(ред, колона): стойност} и свойствата му."""
+
+    def __init__(self, spreadsheet, sheet_id, title, rows, cols):
+        self.spreadsheet = spreadsheet
+        self.id = sheet_id
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self.frozen_rows = 0
+        self.cells = {}
+        self.conditional_formats = []
+        self.developer_metadata = []
+        self.formatted_cells = 0
+
+    def values(self):
+        """Стойностите като list от редове (до последната непразна клетка)."""
+        if not self.cells:
+            return []
+        rows = max(r for r, _ in self.cells) + 1
+        cols = max(c for _, c in self.cells) + 1
+        return [[self.cells.get((r, c), '') for c in range(cols)] for r in range(rows)]
+
+    def check_grid(self, end_row, end_col, what):
+        if end_row > self.row_count or end_col > self.col_count:
+            raise api_error(400, f"{what} exceeds grid limits. Max rows: {self.row_count}, max columns: {self.col_count}")
+
+    def write(self, start_row, start_col, values):
+        end_row = start_row + len(values)
+        end_col = start_col + max((len(row) for row in values), default=0)
+        self.check_grid(end_row, end_col, f"Range ('{self.title}')")
+        for i, row in enumerate(values):
+            for j, value in enumerate(row):
+                if value == '' or value is None:
+                    self.cells.pop((start_row + i, start_col + j), None)
+                else:
+                    self.cells[(start_row + i, start_col + j)] = value
+
+    def col_values(self, col, value_render_option='FORMATTED_VALUE'):
+        """Стойностите на колона (1-базирана) до последната непразна клетка."""
+        self.spreadsheet.client._request("read", "values.get")
+        column = {r: v for (r, c), v in self.cells.items() if c == col - 1}
+        if not column:
+            return []
+        return [column.get(r) for r in range(max(column) + 1)]
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "title": self.title,
+            "rows": self.row_count,
+            "cols": self.col_count,
+            "frozen_rows": self.frozen_rows,
+            "cells": {f"{r},{c}": v for (r, c), v in self.cells.items()},
+            "conditional_formats": self.conditional_formats,
+            "developer_metadata": self.developer_metadata,
+        }
+
+    @classmethod
+    def from_dict(cls, spreadsheet, data):
+        sheet = cls(spreadsheet, data["id"], data["title"], data["rows"], data["cols"])
+        sheet.frozen_rows = data.get("frozen_rows", 0)
+        for key, value in data.get("cells", {}).items():
+            r, c = key.split(',')
+            sheet.cells[(int(r), int(c))] = value
+        sheet.conditional_formats = data.get("conditional_formats", [])
+        sheet.developer_metadata = data.get("developer_metadata", [])
+        return sheet
+
+
+class FakeSpreadsheet:
+    """Таблица с листове; методите следват gspread.Spreadsheet."""
+
+    def __init__(self, client, spreadsheet_id):
+        self.client = client
+        self.id = spreadsheet_id
+        self.sheets = []
+
+    def _sheet(self, title=None, sheet_id=None):
+        for sheet in self.sheets:
+            if sheet.title == title or (sheet_id is not None and sheet.id == sheet_id):
+                return sheet
+        raise api_error(400, f"Unable to find sheet: {title or sheet_id}")
+
+    def worksheets(self, exclude_hidden=False):
+        self.client._request("read", "get")
+        return list(self.sheets)
+
+    def worksheet(self, title):
+        self.client._request("read", "get")
+        for sheet in self.sheets:
+            if sheet.title == title:
+                return sheet
+        raise WorksheetNotFound(title)
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        self.client._request("write", "batchUpdate")
+        with self.client.lock:
+            if any(sheet.title == title for sheet in self.sheets):
+                raise api_error(400, f"A sheet with the name \"{title}\" already exists")
+            sheet_id = max((sheet.id for sheet in self.sheets), default=0) + 1
+            sheet = FakeWorksheet(self, sheet_id, title, int(rows), int(cols))
+            self.sheets.append(sheet)
+            self.client._save()
+        return sheet
+
+    def fetch_sheet_metadata(self, params=None):
+        self.client._request("read", "get")
+        return {"sheets": [
+            {
+                "properties": {
+                    "sheetId": sheet.id,
+                    "title": sheet.title,
+                    "gridProperties": {
+                        "rowCount": sheet.row_count,
+                        "columnCount": sheet.col_count,
+                        "frozenRowCount": sheet.frozen_rows,
+                    },
+                },
+                "conditionalFormats": list(sheet.conditional_formats),
+                "developerMetadata": list(sheet.developer_metadata),
+            }
+            for sheet in self.sheets
+        ]}
+
+    def values_batch_clear(self, params=None, body=None):
+        self.client._request("write", "values.batchClear")
+        with self.client.lock:
+            for range_name in (body or {}).get("ranges", []):
+                title, start_row, start_col, end_row, end_col = parse_range(range_name)
+                sheet = self._sheet(title)
+                if start_row is None:
+                    sheet.cells.clear()
+                    continue
+                for cell in list(sheet.cells):
+                    if start_row <= cell[0] < (end_row or start_row + 1) and start_col <= cell[1] < (end_col or start_col + 1):
+                        del sheet.cells[cell]
+            self.client._save()
+        return {"clearedRanges": (body or {}).get("ranges", [])}
+
+    def values_batch_update(self, body=None):
+        self.client._request("write", "values.batchUpdate")
+        body = body or {}
+        if body.get("valueInputOption") not in ("RAW", "USER_ENTERED"):
+            raise api_error(400, "Invalid valueInputOption")
+        with self.client.lock:
+            # Проверка на всички диапазони преди запис - заявката е атомарна
+            writes = []
+            for entry in body.get("data", []):
+                title, start_row, start_col, end_row, end_col = parse_range(entry["range"])
+                sheet = self._sheet(title)
+                values = entry["values"]
+                start_row, start_col = start_row or 0, start_col or 0
+                if end_row is not None and (end_row - start_row < len(values)
+                                            or end_col - start_col < max((len(row) for row in values), default=0)):
+                    raise api_error(400, f"Requested writing within range [{entry['range']}], but tried writing more")
+                sheet.check_grid(start_row + len(values), start_col + max((len(row) for row in values), default=0),
+                                 f"Range ({entry['range']})")
+                writes.append((sheet, start_row, start_col, values))
+            for sheet, start_row, start_col, values in writes:
+                sheet.write(start_row, start_col, values)
+            self.client._save()
+        return {"totalUpdatedCells": sum(len(row) for _, _, _, values in writes for row in values)}
+
+    def batch_update(self, body):
+        self.client._request("write", "batchUpdate")
+        with self.client.lock:
+            replies = [self._apply(request) for request in body.get("requests", [])]
+            self.client._save()
+        return {"replies": replies}
+
+    def _apply(self, request):
+        (kind, spec), = request.items()
+        if kind == "repeatCell":
+            grid = spec["range"]
+            sheet = self._sheet(sheet_id=grid["sheetId"])
+            sheet.check_grid(grid["endRowIndex"], grid["endColumnIndex"], "repeatCell range")
+            sheet.formatted_cells += (grid["endRowIndex"] - grid["startRowIndex"]) * (grid["endColumnIndex"] - grid["startColumnIndex"])
+        elif kind == "updateDimensionProperties":
+            grid = spec["range"]
+            sheet = self._sheet(sheet_id=grid["sheetId"])
+            limit = sheet.col_count if grid["dimension"] == "COLUMNS" else sheet.row_count
+            if grid["endIndex"] > limit:
+                raise api_error(400, "updateDimensionProperties range exceeds grid limits")
+        elif kind == "appendDimension":
+            sheet = self._sheet(sheet_id=spec["sheetId"])
+            if spec["dimension"] == "ROWS":
+                sheet.row_count += spec["length"]
+            else:
+                sheet.col_count += spec["length"]
+        elif kind == "updateSheetProperties":
+            sheet = self._sheet(sheet_id=spec["properties"]["sheetId"])
+            sheet.frozen_rows = spec["properties"].get("gridProperties", {}).get("frozenRowCount", sheet.frozen_rows)
+        elif kind == "addConditionalFormatRule":
+            rule = spec["rule"]
+            for grid in rule["ranges"]:
+                sheet = self._sheet(sheet_id=grid["sheetId"])
+                sheet.check_grid(grid["endRowIndex"], grid["endColumnIndex"], "Conditional format range")
+            sheet.conditional_formats.insert(spec.get("index", len(sheet.conditional_formats)), rule)
+        elif kind == "deleteConditionalFormatRule":
+            sheet = self._sheet(sheet_id=spec["sheetId"])
+            if spec["index"] >= len(sheet.conditional_formats):
+                raise api_error(400, "No conditional format on sheet at index")
+            sheet.conditional_formats.pop(spec["index"])
+        elif kind == "createDeveloperMetadata":
+            metadata = dict(spec["developerMetadata"])
+            sheet = self._sheet(sheet_id=metadata["location"]["sheetId"])
+            metadata["metadataId"] = self.client.next_metadata_id()
+            sheet.developer_metadata.append(metadata)
+            return {"createDeveloperMetadata": {"developerMetadata": metadata}}
+        elif kind == "updateDeveloperMetadata":
+            metadata_ids = {f["developerMetadataLookup"]["metadataId"] for f in spec["dataFilters"]}
+            for sheet in self.sheets:
+                for metadata in sheet.developer_metadata:
+                    if metadata["metadataId"] in metadata_ids:
+                        metadata.update(spec["developerMetadata"])
+        else:
+            raise api_error(400, f"Unsupported request in fake backend: {kind}")
+        return {}
+
+
+class FakeSheetsClient:
+    """
+    Fake gspread.Client с fault injection и квота.
+
+    Args:
+        state_path: JSON файл за състоянието между стартиранията (None - само в паметта)
+        error_rate: Вероятност за инжектирана грешка (статус от error_statuses)
+        error_statuses: HTTP статуси за инжектиране (по подразбиране 429 и 503)
+        read_quota / write_quota: Заявки за минута, над които се връща 429
+        latency: Латентност на заявка в секунди
+        seed: Seed за възпроизводими грешки
+    """
+
+    def __init__(self, state_path=None, error_rate=0.0, error_statuses=(429, 503),
+                 read_quota=60, write_quota=60, latency=0.0, seed=None):
+        self.state_path = state_path
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.quota = {"read": read_quota, "write": write_quota}
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.windows = {"read": deque(), "write": deque()}
+        self.spreadsheets = {}
+        self._metadata_id = 0
+        self.reset_stats()
+        self._load()
+
+    def reset_stats(self):
+        self.stats = {"requests": 0, "by_method": {}, "injected_errors": 0, "quota_errors": 0}
+
+    def next_metadata_id(self):
+        self._metadata_id += 1
+        return self._metadata_id
+
+    def _request(self, kind, method):
+        """Отчита заявката, проверява квотата и по желание инжектира грешка."""
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["by_method"][method] = self.stats["by_method"].get(method, 0) + 1
+            now = time.monotonic()
+            window = self.windows[kind]
+            while window and now - window[0] >= 60:
+                window.popleft()
+            if len(window) >= self.quota[kind]:
+                self.stats["quota_errors"] += 1
+                raise api_error(429, f"Quota exceeded for quota metric '{kind.capitalize()} requests'")
+            window.append(now)
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.stats["injected_errors"] += 1
+                status = self.random.choice(self.error_statuses)
+                raise api_error(status, "Injected error")
+
+    def open_by_key(self, key):
+        self._request("read", "get")
+        with self.lock:
+            if key not in self.spreadsheets:
+                self.spreadsheets[key] = FakeSpreadsheet(self, key)
+            return self.spreadsheets[key]
+
+    def _load(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        with open(self.state_path, encoding='utf-8') as f:
+            data = json.load(f)
+        self._metadata_id = data.get("metadata_id", 0)
+        for key, sheets in data.get("spreadsheets", {}).items():
+            spreadsheet = FakeSpreadsheet(self, key)
+            spreadsheet.sheets = [FakeWorksheet.from_dict(spreadsheet, sheet) for sheet in sheets]
+            self.spreadsheets[key] = spreadsheet
+
+    def _save(self):
+        if not self.state_path:
+            return
+        data = {
+            "metadata_id": self._metadata_id,
+            "spreadsheets": {
+                key: [sheet.to_dict() for sheet in spreadsheet.sheets]
+                for key, spreadsheet in self.spreadsheets.items()
+            },
+        }
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Съдържанието на fake Google Sheets състояние")
+    parser.add_argument("--state", required=True, help="JSON файл от HARMONICA_FAKE_SHEETS")
+    parser.add_argument("--sheet", default=None, help="Лист за отпечатване (по подразбиране - списък)")
+    args = parser.parse_args()
+
+    client = FakeSheetsClient(state_path=args.state)
+    for key, spreadsheet in client.spreadsheets.items():
+        for sheet in spreadsheet.sheets:
+            if args.sheet is None:
+                print(f"{key} / {sheet.title}: {sheet.row_count}x{sheet.col_count}, "
+                      f"{len(sheet.cells)} клетки, {len(sheet.conditional_formats)} условни правила")
+            elif sheet.title == args.sheet:
+                for row in sheet.values():
+                    print("\t".join(str(value) for value in row))
+
+
+if __name__ == "__main__":
+    main()
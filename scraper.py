@@ -9,34 +9,48 @@ Harmonica Price Tracker v9.1
 """
 
 import os
+import sys
 import json
 import re
 import gc
+import hashlib
+import functools
+import bisect
 import time
-import smtplib
 import base64
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from datetime import datetime
-from playwright.sync_api import sync_playwright
-import gspread
-from google.oauth2.service_account import Credentials
+import io
+import random
+import threading
+import sqlite3
+import argparse
+import subprocess
+import importlib.util
+import concurrent.futures
+from collections import deque
+from datetime import datetime, timedelta
 
-# Playwright Stealth за Cloudflare bypass
-try:
-    from playwright_stealth import stealth_sync
-    STEALTH_AVAILABLE = True
-except ImportError:
-    STEALTH_AVAILABLE = False
-    print("  [WARN] playwright-stealth не е инсталиран, Cloudflare сайтове може да не работят")
+# Тежките зависимости (Playwright, gspread/google-auth, anthropic, numpy,
+# scipy, Pillow, smtplib) се импортират във функциите, които ги използват - командите
+# без браузър и мрежа (report, extract, doctor) стартират за под секунда.
+# Наличността им се проверява без импортиране.
+
+
+def _module_available(name):
+    """Дали модулът е инсталиран - без да се импортира."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
 
+
+# Playwright Stealth за Cloudflare bypass
+STEALTH_AVAILABLE = _module_available('playwright_stealth')
+# Разредени матрици за n-gram съпоставянето (Фаза 2)
+SCIPY_AVAILABLE = _module_available('scipy')
+# Обработка на screenshots преди vision (смаляване, изрязване, JPEG/WebP)
+PIL_AVAILABLE = _module_available('PIL')
 # Claude API
-try:
-    import anthropic
-    CLAUDE_AVAILABLE = True
-except ImportError:
-    CLAUDE_AVAILABLE = False
-    print("⚠ Anthropic библиотеката не е налична")
+CLAUDE_AVAILABLE = _module_available('anthropic')
 
 # =============================================================================
 # КОНФИГУРАЦИЯ
@@ -45,6 +59,7 @@ except ImportError:
 # Фиксиран курс EUR/BGN (официален за еврозоната)
 EUR_BGN_RATE = 1.95583
 ALERT_THRESHOLD = 10
+ROBUST_Z_THRESHOLD = 3.5  # Модифицирана z-оценка (по медиана и MAD) за робастни аномалии
 
 # Базова валута за сравнение - BGN (до юни 2026)
 # След това може да се смени на EUR
@@ -57,6 +72,7 @@ BASE_CURRENCY = "BGN"
 CLAUDE_MODEL_PHASE1 = "claude-haiku-4-5-20251001"      # Извличане на продукти от HTML
 CLAUDE_MODEL_PHASE2 = "claude-sonnet-4-5-20250929"    # Семантично съпоставяне (Sonnet 4.5)
 CLAUDE_MODEL_VISION = "claude-haiku-4-5-20251001"      # Визуална верификация
+CLAUDE_MAX_RETRIES = 2  # Автоматични повторения на SDK-то при 429/529/5xx
 
 STORES = {
     "eBag": {
@@ -216,67 +232,784 @@ PRODUCT_VISUAL_DESCRIPTIONS = {
 
 # Алтернативни имена на продукти за по-добро съпоставяне
 # Кашон и други магазини използват различни наименования
+# Ключовете са ID-тата от PRODUCTS (27 продукта, v8.8 номерация)
 PRODUCT_ALIASES = {
-    16: [  # Био сироп от бъз
+    5: [  # Био кисело мляко 3,6%
+        "кисело мляко 3,6%",
+        "кисело мляко 3.6%",
+        "кисело мляко harmonica 3,6"
+    ],
+    7: [  # Био пълнозърнест сусамов тахан
+        "сусамов тахан",
+        "тахан сусамов",
+        "tahini",
+        "тахан harmonica"
+    ],
+    8: [  # Био локум натурален
+        "локум натурален",
+    ],
+    12: [  # Био краве сирене
+        "сирене краве",
+        "краве сирене harmonica",
+        "cow cheese"
+    ],
+    15: [  # Био локум роза
+        "локум роза",
+        "локум със сироп от роза",
+    ],
+    18: [  # Био сироп от бъз
         "сироп от плод на бъз",
         "сироп бъз",
         "elderflower syrup",
         "сироп от бъз harmonica"
     ],
-    19: [  # Био пълнозърнести солети
+    21: [  # Био бисквити с масло и какао
+        "обикновени бисквити с масло и какао",
+    ],
+    22: [  # Био пълнозърнести солети
         "солети пълнозърнести",
         "пълнозърнести солети harmonica",
         "whole grain pretzels"
     ],
-    20: [  # Био кисело пълномаслено мляко
+    23: [  # Био кисело пълномаслено мляко
         "по-кисело кисело мляко",
         "по-кисело мляко хармоника",
         "кисело мляко пълномаслено",
         "по-киселото мляко"
     ],
-    5: [  # Био кисело мляко 3,6%
-        "кисело мляко 3,6%",
-        "кисело мляко 3.6%",
-        "кисело мляко harmonica 3,6"
-    ],
-    23: [  # Био кисело мляко 2%
-        "кисело мляко 2%",
-        "кисело мляко 2.0%",
-        "кисело мляко harmonica 2"
-    ],
-    11: [  # Био краве сирене
-        "сирене краве",
-        "краве сирене harmonica",
-        "cow cheese"
-    ],
-    7: [  # Био пълнозърнест сусамов тахан
-        "сусамов тахан",
-        "тахан сусамов",
-        "tahini",
-        "тахан harmonica"
+    24: [  # Био извара - ВНИМАНИЕ: да не се бърка с крема сирене!
+        "извара harmonica",
+        "извара био",
+        "cottage cheese"
+        # НЕ включваме "сирене" защото се бърка с крема сирене
     ],
-    22: [  # Био студено пресовано слънчогледово масло
+    25: [  # Био студено пресовано слънчогледово масло
         "слънчогледово олио за готвене",
         "био слънчогледово олио",
         "sunflower oil",
         "олио за готвене"
     ],
-    21: [  # Био извара - ВНИМАНИЕ: да не се бърка с крема сирене!
-        "извара harmonica",
-        "извара био",
-        "cottage cheese"
-        # НЕ включваме "сирене" защото се бърка с крема сирене
+    26: [  # Био кисело мляко 2%
+        "кисело мляко 2%",
+        "кисело мляко 2.0%",
+        "кисело мляко harmonica 2"
     ],
 }
 
+# Ключови думи за валидация на визуалната идентификация (достатъчно е едно съвпадение)
+# Ключовете са ID-тата от PRODUCTS
+PRODUCT_KEYWORDS = {
+    1: ["вафла", "лимон", "крем", "30"],
+    2: ["вафла", "без", "захар", "30"],
+    3: ["козе", "сирене", "goat", "200"],
+    4: ["лютеница", "илиев", "260"],
+    5: ["кисело", "мляко", "3.6", "3,6", "400"],
+    6: ["лютеница", "хаджиев", "260"],
+    7: ["тахан", "сусам", "700"],
+    8: ["локум", "натурален", "natural", "140"],
+    9: ["кашкавал", "краве", "300"],
+    10: ["крема", "сирене", "cream", "125"],
+    11: ["вафла", "лимец", "кокос", "30"],
+    12: ["краве", "сирене", "400"],
+    13: ["кори", "баница", "400"],
+    14: ["фъстъчено", "масло", "250"],
+    15: ["локум", "роза", "rose", "140"],
+    16: ["слънчогледово", "масло", "500"],
+    17: ["тунквана", "вафла", "chocobiotic", "40"],
+    18: ["сироп", "бъз", "750"],
+    19: ["прясно", "мляко", "1л", "1l"],
+    20: ["солети", "лимец", "50"],
+    21: ["бисквити", "масло", "какао", "150"],
+    22: ["пълнозърнести", "солети", "60"],
+    23: ["пълномаслено", "кисело", "400"],
+    24: ["извара", "500"],
+    25: ["студено", "пресовано", "слънчогледово", "500"],
+    26: ["кисело", "мляко", "2%", "400"],
+    27: ["кефир", "500"],
+}
+
+# Видове продукти (за индекса по вид + грамаж). Проверяват се по ред -
+# по-специфичните видове са преди по-общите
+PRODUCT_FAMILIES = [
+    ("фъстъчено масло", ("фъстъчено масло", "peanut butter")),
+    ("олио", ("слънчогледово", "олио", "sunflower")),
+    ("кашкавал", ("кашкавал",)),
+    ("крема сирене", ("крема сирене", "cream cheese")),
+    ("сирене", ("сирене", "cheese")),
+    ("кисело мляко", ("кисело мляко", "кисело пълномаслено", "по-кисел", "yogurt")),
+    ("прясно мляко", ("прясно мляко",)),
+    ("кефир", ("кефир",)),
+    ("извара", ("извара", "cottage")),
+    ("лютеница", ("лютеница",)),
+    ("тахан", ("тахан", "tahini")),
+    ("локум", ("локум",)),
+    ("сироп", ("сироп", "syrup")),
+    ("солети", ("солети", "pretzel")),
+    ("бисквити", ("бисквит",)),
+    ("вафла", ("вафл",)),
+    ("кори", ("кори за баница",)),
+]
+
+# Ключови думи с грамаж за резервното (fallback) търсене - всички от група трябва да са в текста
+# Включени са алтернативни имена от различни магазини. Ключовете са ID-тата от PRODUCTS
+FALLBACK_KEYWORDS = {
+    1: [("вафла", "лимон", "30"), ("вафла", "крем", "30")],
+    2: [("вафла", "без", "захар", "30")],
+    3: [("козе", "сирене", "200"), ("goat", "cheese", "200")],
+    4: [("лютеница", "илиев", "260")],
+    5: [("кисело", "мляко", "3.6", "400"), ("кисело", "мляко", "3,6", "400")],
+    6: [("лютеница", "хаджиев", "260")],
+    7: [("тахан", "сусам", "700"), ("tahini", "700")],
+    # Zelen продукт - Био локум натурален
+    8: [("локум", "натурален", "140"), ("локум", "natural", "140")],
+    9: [("кашкавал", "краве", "300")],
+    10: [("крема", "сирене", "125"), ("cream", "cheese", "125")],
+    11: [("вафла", "лимец", "кокос", "30")],
+    12: [("краве", "сирене", "400"), ("сирене", "краве", "400")],
+    13: [("кори", "баница", "400")],
+    14: [("фъстъчено", "масло", "250"), ("peanut", "butter", "250")],
+    # Zelen продукт - Био локум роза
+    15: [("локум", "роза", "140"), ("локум", "rose", "140")],
+    16: [("слънчогледово", "масло", "500"), ("слънчогледово", "олио", "500"), ("олио", "готвене", "500")],
+    17: [("chocobiotic", "40"), ("тунквана", "вафла", "40")],
+    # Сироп от бъз - Кашон го нарича "Сироп от плод на бъз"
+    18: [("сироп", "бъз", "750"), ("сироп", "плод", "бъз", "750")],
+    19: [("прясно", "мляко", "1л"), ("прясно", "мляко", "1l")],
+    20: [("солети", "лимец", "50")],
+    # Zelen продукт - Био бисквити с масло и какао
+    21: [("бисквити", "масло", "какао", "150"), ("бисквити", "какао", "150"), ("обикновени", "бисквити", "150")],
+    # Пълнозърнести солети - Кашон го нарича "Солети пълнозърнести"
+    22: [("пълнозърнести", "солети", "60"), ("солети", "пълнозърнести", "60")],
+    # Пълномаслено мляко - Кашон го нарича "По-кисело кисело мляко"
+    23: [("пълномаслено", "мляко", "400"), ("по-кисело", "мляко", "400"), ("по-кисело", "кисело", "400")],
+    # Извара - ВАЖНО: търсим "извара" БЕЗ "сирене" за да не се бърка с крема сирене
+    24: [("извара", "500"), ("извара", "harmonica")],
+    # Студено пресовано масло - различно от обикновеното слънчогледово
+    25: [("студено", "пресовано", "500"), ("студено", "пресовано", "слънчогледово")],
+    26: [("кисело", "мляко", "2%", "400"), ("кисело", "мляко", "2.0", "400")],
+    27: [("кефир", "500")],
+}
+
 # Продукти, които не се продават в определени магазини (потвърдено ръчно)
+# Ключовете са ключовете от STORES, стойностите - ID-та от PRODUCTS
 PRODUCTS_NOT_AVAILABLE = {
-    "Kashon": [8, 16],  # Био кашкавал, Био сироп от бъз - не се продават в Кашон
+    "Kashon": [9, 18],  # Био кашкавал, Био сироп от бъз - не се продават в Кашон
 }
 
+# Директория за локален кеш (автомат с ключови думи, vision кеш и др.)
+CACHE_DIR = os.environ.get('HARMONICA_CACHE_DIR', '.cache')
+
 # Флаг за включване/изключване на визуална верификация
 ENABLE_VISUAL_VERIFICATION = True
 VISUAL_VERIFICATION_CONFIDENCE_THRESHOLD = 0.7  # Минимална увереност за приемане
+VISION_BATCH_SIZE = 4  # Карти в едно vision извикване (1 = по едно извикване на карта)
+VISION_MIN_CARD_SIZE = 80          # Продуктова карта е поне 80x80 пиксела
+VISION_CARD_TEXT_LIMIT = 600       # Символи текст от карта при откриването
+VISION_SCREENSHOT_SETTLE_MS = 0    # Пауза преди screenshot (за lazy-load снимки)
+VISION_WORKERS = 3                 # Нишки за обработка на снимки и vision извиквания
+VISION_MAX_IN_FLIGHT = 4           # Максимум задачи в обработка (заснемането изчаква)
+# Заснемане на картите: "element" - screenshot на всяка карта поотделно,
+# "tiled" - по един screenshot на екран и локално изрязване на картите (изисква Pillow)
+VISION_CAPTURE_MODE = "tiled"
+
+# Обработка на screenshots преди изпращане към vision (изисква Pillow)
+VISION_IMAGE_MAX_EDGE = 512      # Максимален размер на по-дългата страна (px)
+VISION_IMAGE_FORMAT = "JPEG"     # "JPEG", "WEBP" или "PNG"
+VISION_IMAGE_QUALITY = 80        # Качество за JPEG/WebP
+VISION_TRIM_BACKGROUND = True    # Изрязване на еднородния фон около опаковката
+VISION_TRIM_TOLERANCE = 12       # Допустима разлика от цвета на фона (0-255)
+# Зона на опаковката в картата по магазин (left, top, right, bottom като дял от размера)
+# напр. "eBag": (0.0, 0.0, 1.0, 0.65) - горната част на картата е снимката
+VISION_STORE_CROP = {}
+
+# Кеш на vision идентификациите по перцептивен хеш на снимката (изисква Pillow)
+VISION_CACHE_ENABLED = True
+VISION_CACHE_MAX_DISTANCE = 6          # Допустими различни бита от 64 в pHash
+VISION_CACHE_MAX_AGE_DAYS = 60         # Приетите идентификации се проверяват отново след толкова дни
+VISION_CACHE_NEGATIVE_AGE_DAYS = 21    # "Не е наш продукт" - по-кратко
+
+# Локално предварително съпоставяне преди Фаза 2
+# Всеки извлечен продукт получава до TOP_K кандидата от каталога;
+# еднозначните съвпадения се приемат локално, останалите отиват при Sonnet
+PHASE2_PREFILTER_TOP_K = 3
+PHASE2_AUTO_ACCEPT_SCORE = 0.8     # Минимален резултат за автоматично приемане
+PHASE2_AUTO_ACCEPT_MARGIN = 0.25   # Минимална разлика спрямо втория кандидат
+PHASE2_MIN_CANDIDATE_SCORE = 0.25  # Под този резултат продуктът не е от нашия списък
+PHASE2_FAMILY_SIZE_ACCEPT_SCORE = 0.6  # Приемане при единствен продукт от този вид и грамаж
+
+# Engine за Фаза 2:
+# - "llm": токенов pre-filter + Sonnet за неясните продукти
+# - "ngram": само локален n-gram TF-IDF matcher (без LLM във Фаза 2)
+# - "hybrid": n-gram matcher, само несигурните редове отиват при Sonnet
+PHASE2_ENGINE = os.environ.get('HARMONICA_PHASE2_ENGINE', 'hybrid')
+NGRAM_SIZE = 3
+NGRAM_ACCEPT_SCORE = 0.75   # Минимална косинусова прилика за локално приемане
+NGRAM_ACCEPT_MARGIN = 0.1   # Минимална разлика спрямо втория кандидат
+NGRAM_MIN_SCORE = 0.3       # Под тази прилика кандидатът се отхвърля
+
+# Фаза 1 в streaming режим - продуктите се парсват и съпоставят докато Haiku генерира
+PHASE1_STREAMING = True
+
+# Текстът на всяка страница след скрейпване (за командата extract); "" изключва
+PAGE_TEXT_DIR = os.path.join(CACHE_DIR, 'pages')
+
+# Локална история на цените (SQLite) - основният запис, табовете в Sheets се синхронизират от нея
+HISTORY_DB_PATH = os.environ.get('HARMONICA_HISTORY_DB', os.path.join(CACHE_DIR, 'history.sqlite'))
+
+# Google Sheets - запис само на промените спрямо локалната снимка на последния запис
+SHEETS_SNAPSHOT_PATH = os.path.join(CACHE_DIR, 'sheets_snapshot.json')
+SHEETS_FORCE_FULL_WRITE = os.environ.get('HARMONICA_SHEETS_FULL_WRITE') == '1'
+# Табове с история: "quarter" (История_2026_Q4) или "year" (История_2026)
+HISTORY_PARTITION = "quarter"
+HISTORY_TAB_ROWS = 500               # Начален размер на таб (и стъпка за разширяване)
+HISTORY_SUMMARY_SHEET_NAME = "История_Обобщение"
+# Заявки към Sheets: локален лимит за минута (квотата на API-то е 60/мин за потребител)
+# и повторения с експоненциално изчакване при 429/5xx
+SHEETS_QUOTA_PER_MINUTE = {"read": 55, "write": 55}
+SHEETS_MAX_RETRIES = 5
+SHEETS_RETRY_BASE_DELAY = 1.0        # Секунди (удвоява се при всеки опит)
+SHEETS_RETRY_MAX_DELAY = 32.0
+SHEETS_RETRY_STATUSES = (429, 500, 502, 503, 504)
+SHEETS_REQUEST_TIMEOUT = 60          # Секунди за една HTTP заявка
+
+# Публикуване след събирането: Sheets, имейл и JSON експорт паралелно.
+# Таймаутът е общ за всички опити на изхода; повторенията са след пълна грешка.
+PUBLISH_SINK_TIMEOUTS = {"sheets": 300, "email": 60, "export": 30}   # Секунди
+PUBLISH_SINK_RETRIES = {"sheets": 1, "email": 2, "export": 1}
+PUBLISH_RETRY_BASE_DELAY = 2.0       # Секунди (удвоява се при всеки опит)
+EXPORT_JSON_PATH = os.environ.get('HARMONICA_EXPORT_PATH', os.path.join(CACHE_DIR, 'latest_results.json'))
+
+
+# =============================================================================
+# НОРМАЛИЗАЦИЯ НА ТЕКСТ (lowercase + транслитерация)
+# =============================================================================
+
+# Транслитерация кирилица -> латиница (за сайтове с латински имена)
+TRANSLITERATIONS = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e',
+    'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l',
+    'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's',
+    'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch',
+    'ш': 'sh', 'щ': 'sht', 'ъ': 'a', 'ь': '', 'ю': 'yu', 'я': 'ya'
+}
+
+# Таблици за str.translate - изграждат се веднъж при зареждане
+_TRANSLIT_TABLE = str.maketrans(TRANSLITERATIONS)
+_TRANSLIT_LENGTHS = {char: len(latin) for char, latin in TRANSLITERATIONS.items()}
+
+
+def transliterate(text):
+    """Транслитерира кирилица към латиница (текстът трябва да е lowercase)."""
+    return text.translate(_TRANSLIT_TABLE)
+
+
+class NormalizedText:
+    """
+    Текст на страница, нормализиран веднъж за всички търсения.
+    
+    - lower: lowercase форма (за търсене на ключови думи)
+    - latin: транслитерирана lowercase форма (изчислява се при нужда)
+    
+    Пази карта на позициите обратно към оригиналния текст: lower() и
+    транслитерацията могат да променят дължината (напр. 'İ', 'ж' -> 'zh'),
+    затова позиция от нормализираната форма се превежда с to_original()
+    / latin_to_original() преди да се режe оригиналният текст.
+    """
+    
+    __slots__ = ('original', 'lower', '_lower_offsets', '_latin', '_latin_offsets')
+    
+    def __init__(self, text):
+        self.original = text
+        self.lower = text.lower()
+        self._lower_offsets = None
+        if len(self.lower) != len(text):
+            offsets = []
+            for i, char in enumerate(text):
+                offsets.extend([i] * len(char.lower()))
+            self._lower_offsets = offsets
+        self._latin = None
+        self._latin_offsets = None
+    
+    @property
+    def latin(self):
+        if self._latin is None:
+            self._latin = self.lower.translate(_TRANSLIT_TABLE)
+        return self._latin
+    
+    def to_original(self, index):
+        """Позиция в lower -> позиция в оригиналния текст."""
+        if self._lower_offsets is None or index >= len(self._lower_offsets):
+            return min(index, len(self.original))
+        return self._lower_offsets[index]
+    
+    def latin_to_original(self, index):
+        """Позиция в latin -> позиция в оригиналния текст."""
+        if self._latin_offsets is None:
+            self._latin_offsets = [
+                i for i, char in enumerate(self.lower)
+                for _ in range(_TRANSLIT_LENGTHS.get(char, 1))
+            ]
+        if index >= len(self._latin_offsets):
+            return len(self.original)
+        return self.to_original(self._latin_offsets[index])
+    
+    def contains(self, pattern):
+        """Съдържа ли текстът pattern директно или в транслитерирана форма."""
+        pattern_lower, pattern_latin = normalize_pattern(pattern)
+        return pattern_lower in self.lower or pattern_latin in self.lower
+
+
+@functools.lru_cache(maxsize=8)
+def normalize_text(text):
+    """
+    Нормализира текст на страница (кешира се - една страница се нормализира
+    веднъж, независимо колко продукта и ключови думи се търсят в нея).
+    """
+    return NormalizedText(text)
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_pattern(pattern):
+    """Връща (lowercase, транслитерирана) форма на ключова дума или име."""
+    pattern_lower = pattern.lower()
+    return pattern_lower, pattern_lower.translate(_TRANSLIT_TABLE)
+
+
+# =============================================================================
+# ЦЕНИ - ЕДИНЕН ТОКЕНИЗАТОР
+# =============================================================================
+
+# Валутни означения преди/след цената
+_CURRENCY_WORDS = {
+    'лв': "BGN", 'лв.': "BGN", 'лева': "BGN", 'bgn': "BGN", 'lv': "BGN", 'lv.': "BGN",
+    '€': "EUR", 'eur': "EUR", 'евро': "EUR",
+}
+_CURRENCY_PATTERN = r'лв\.?|лева|bgn|lv\.?|€|eur|евро'
+
+# "2,99 лв.", "€ 1.43", "1 299,00", "1.299,00 лв", "BGN 2.99"
+# Разделителят за хиляди е интервал (вкл. неразделящ) или точка пред група от 3 цифри
+_PRICE_TOKEN_RE = re.compile(
+    r'(?<![\d.,])'
+    r'(?:(?P<pre>' + _CURRENCY_PATTERN + r')\s*)?'
+    r'(?P<int>\d{1,3}(?:[   .]\d{3})+|\d+)'
+    r'[.,](?P<dec>\d{2})(?![.,]?\d)'
+    r'(?:\s*(?P<post>' + _CURRENCY_PATTERN + r')(?![a-zа-я]))?',
+    re.IGNORECASE
+)
+
+# Същото, но с допустими цели числа и една десетична цифра ("4", "4.5 лв")
+# - за стойности, които вече са цени (напр. полето "price" в JSON от Claude)
+_PRICE_VALUE_RE = re.compile(
+    r'(?<![\d.,])'
+    r'(?:(?P<pre>' + _CURRENCY_PATTERN + r')\s*)?'
+    r'(?P<int>\d{1,3}(?:[   .]\d{3})+|\d+)'
+    r'(?:[.,](?P<dec>\d{1,2}))?(?![.,]?\d)'
+    r'(?:\s*(?P<post>' + _CURRENCY_PATTERN + r')(?![a-zа-я]))?',
+    re.IGNORECASE
+)
+
+# Две цени една до друга (само интервали/разделители между тях)
+_PRICE_GAP_RE = re.compile(r'[\s/|–-]{0,12}')
+
+
+class PriceToken:
+    """
+    Една цена в текст.
+    
+    - value: числова стойност
+    - currency: "BGN", "EUR" или None (ако няма означение)
+    - start/end: позиции в текста
+    - role: "regular", "old" (зачеркната стара цена) или "promo" (промоционална)
+    - twin: другата цена при двойно BGN/EUR показване
+    """
+    
+    __slots__ = ('value', 'currency', 'start', 'end', 'raw', 'role', 'twin')
+    
+    def __init__(self, value, currency, start, end, raw):
+        self.value = value
+        self.currency = currency
+        self.start = start
+        self.end = end
+        self.raw = raw
+        self.role = "regular"
+        self.twin = None
+    
+    def __repr__(self):
+        return f"PriceToken({self.value}, {self.currency}, {self.start}-{self.end}, {self.role})"
+
+
+def _token_from_match(match):
+    integer = re.sub(r'\D', '', match.group('int'))
+    decimals = match.group('dec') or '0'
+    currency_word = (match.group('pre') or match.group('post') or '').lower()
+    return PriceToken(
+        float(f"{integer}.{decimals}"),
+        _CURRENCY_WORDS.get(currency_word),
+        match.start(),
+        match.end(),
+        match.group(0)
+    )
+
+
+def _is_dual_display(a, b):
+    """
+    BGN/EUR двойно показване: съотношение ~ EUR_BGN_RATE и валути,
+    които не си противоречат (липсващата валута се допълва).
+    """
+    if a.currency and a.currency == b.currency:
+        return False
+    high, low = (a, b) if a.value >= b.value else (b, a)
+    if low.value <= 0 or abs(high.value / low.value - EUR_BGN_RATE) >= 0.05:
+        return False
+    if high.currency == "EUR" or low.currency == "BGN":
+        return False
+    high.currency, low.currency = "BGN", "EUR"
+    return True
+
+
+def _link_adjacent_prices(text, tokens):
+    """
+    Свързва съседни цени: BGN/EUR двойки (twin) и стара/промо цена.
+    Съседни са цени, между които има само интервали или разделители.
+    """
+    for a, b in zip(tokens, tokens[1:]):
+        gap = _PRICE_GAP_RE.fullmatch(text, a.end, b.start)
+        if not gap:
+            continue
+        if _is_dual_display(a, b):
+            a.twin, b.twin = b, a
+        elif (a.currency == b.currency or not a.currency or not b.currency) and a.value != b.value:
+            old, promo = (a, b) if a.value > b.value else (b, a)
+            old.role, promo.role = "old", "promo"
+            if not old.currency:
+                old.currency = promo.currency
+            elif not promo.currency:
+                promo.currency = old.currency
+    return tokens
+
+
+def scan_prices(text):
+    """
+    Намира всички цени в текста с едно минаване.
+    
+    Поддържа "2,99 лв.", "€ 1.43", "1 299,00", стара + промо цена
+    и двойно BGN/EUR показване. Всяка цена носи собствената си валута.
+    
+    Returns:
+        list от PriceToken, подредени по позиция
+    """
+    if not text:
+        return []
+    tokens = [_token_from_match(m) for m in _PRICE_TOKEN_RE.finditer(text)]
+    return _link_adjacent_prices(text, tokens)
+
+
+def parse_price_token(value):
+    """
+    Превръща стойност на цена (число или текст "4.28 лв.", "€ 4,5", "4") в PriceToken.
+    Валутата е None, ако стойността няма валутно означение.
+    
+    Returns:
+        PriceToken или None ако няма цена
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return PriceToken(float(value), None, 0, 0, str(value))
+    match = _PRICE_VALUE_RE.search(str(value))
+    if not match:
+        return None
+    return _token_from_match(match)
+
+
+def parse_price_value(value):
+    """
+    Превръща стойност на цена (число или текст "4.28 лв.", "4,5", "4") в float.
+    
+    Returns:
+        float или None ако няма цена
+    """
+    token = parse_price_token(value)
+    return token.value if token else None
+
+
+def parse_currency_code(value):
+    """Валутен код ("BGN"/"EUR") от означение като "лв.", "€", "EUR"; None ако е непознато."""
+    if not isinstance(value, str):
+        return None
+    return _CURRENCY_WORDS.get(value.strip().lower())
+
+
+def select_current_price(tokens, prefer_currency=None):
+    """
+    Избира актуалната цена от цените в една продуктова карта:
+    пропуска зачеркнатите стари цени и при двойно показване
+    предпочита prefer_currency.
+    """
+    current = [t for t in tokens if t.role != "old"]
+    if not current:
+        return None
+    if prefer_currency:
+        for token in current:
+            if token.currency == prefer_currency:
+                return token
+            if token.twin and token.twin.currency == prefer_currency:
+                return token.twin
+    return current[0]
+
+
+def is_price_only_line(line):
+    """Дали редът съдържа само цени (и валутни означения/разделители)."""
+    rest = _PRICE_TOKEN_RE.sub('', line)
+    return bool(rest != line and not re.search(r'[^\s/|–-]', rest))
+
+
+def dominant_price_currency(tokens):
+    """
+    Най-честата изрична валута сред цените (None ако няма означения).
+    При двойно BGN/EUR показване се брои само BGN цената.
+    """
+    counts = {}
+    for token in tokens:
+        if token.twin and token.currency == "EUR":
+            continue
+        if token.currency:
+            counts[token.currency] = counts.get(token.currency, 0) + 1
+    if not counts:
+        return None
+    return max(counts, key=counts.get)
+
+
+# =============================================================================
+# ГРАМАЖ / ОБЕМ И ЦЕНА ЗА КГ/Л
+# =============================================================================
+
+# Грамаж/обем: "30г", "500 мл", "1л", "0,5 l", "1.2kg", "140 g", "2 x 200 г"
+_WEIGHT_RE = re.compile(
+    r'(?:(?P<count>\d+)\s*[xх×*]\s*)?'
+    r'(?P<amount>\d+(?:[.,]\d+)?)\s*'
+    r'(?P<unit>килограма?|кг|kg|грама?|гр|г|g|милилитра|мл|ml|литра?|литър|л|l)'
+    r'(?![a-zа-я])'
+)
+
+# Мерна единица -> (канонична единица, множител)
+_WEIGHT_UNITS = {
+    "килограм": ("g", 1000), "килограма": ("g", 1000), "кг": ("g", 1000), "kg": ("g", 1000),
+    "грам": ("g", 1), "грама": ("g", 1), "гр": ("g", 1), "г": ("g", 1), "g": ("g", 1),
+    "милилитра": ("ml", 1), "мл": ("ml", 1), "ml": ("ml", 1),
+    "литър": ("ml", 1000), "литра": ("ml", 1000), "литр": ("ml", 1000), "л": ("ml", 1000), "l": ("ml", 1000),
+}
+
+# Етикет на цената за единица: за грамове - на кг, за милилитри - на литър
+UNIT_PRICE_LABELS = {"g": "кг", "ml": "л"}
+
+
+def parse_weight(text):
+    """
+    Извлича грамажа/обема от име на продукт в канонична форма
+    (грамове или милилитри). При мултипакет ("2 x 200 г") връща общото количество.
+    
+    Returns:
+        tuple (количество, "g"/"ml") или None ако няма грамаж
+    """
+    match = _WEIGHT_RE.search(normalize_pattern(text)[0])
+    if not match:
+        return None
+    unit, factor = _WEIGHT_UNITS[match.group('unit')]
+    amount = float(match.group('amount').replace(',', '.')) * factor
+    if match.group('count'):
+        amount *= int(match.group('count'))
+    if amount <= 0:
+        return None
+    return (round(amount, 1), unit)
+
+
+def strip_weight(text):
+    """Премахва грамажа от (lowercase) текст."""
+    return _WEIGHT_RE.sub(' ', text)
+
+
+def unit_price(price, size):
+    """
+    Цена за кг (при грамове) или за литър (при милилитри).
+    Позволява сравнение на различни разфасовки.
+    """
+    if not price or not size:
+        return None
+    amount, _ = size
+    return round(price * 1000 / amount, 2)
+
+
+@functools.lru_cache(maxsize=4096)
+def detect_product_family(text):
+    """
+    Вид на продукта ("кисело мляко", "вафла", ...) по PRODUCT_FAMILIES.
+    Проверява кирилската и транслитерираната форма на текста.
+    
+    Returns:
+        име на вида или None
+    """
+    lower, latin = normalize_pattern(text)
+    for family, stems in PRODUCT_FAMILIES:
+        for stem in stems:
+            stem_lower, stem_latin = normalize_pattern(stem)
+            if stem_lower in lower or stem_latin in latin:
+                return family
+    return None
+
+
+# =============================================================================
+# КАТАЛОГ НА ПРОДУКТИТЕ (индекси по ID, име и алтернативно име)
+# =============================================================================
+
+class ProductRecord:
+    """
+    Всички данни за един продукт на едно място.
+    
+    Събира PRODUCTS, PRODUCT_VISUAL_DESCRIPTIONS, PRODUCT_ALIASES,
+    PRODUCT_KEYWORDS и FALLBACK_KEYWORDS; производните полета
+    (грамаж, токени за съпоставяне) се изчисляват веднъж.
+    """
+    
+    __slots__ = (
+        'id', 'name', 'weight', 'ref_price_bgn', 'ref_price_eur',
+        'visual_description', 'aliases', 'keywords', 'fallback_keywords',
+        'weight_value', 'family', 'ref_unit_price_bgn', 'name_variants', 'unavailable_in',
+    )
+    
+    def __init__(self, product):
+        product_id = product['id']
+        self.id = product_id
+        self.name = product['name']
+        self.weight = product['weight']
+        self.ref_price_bgn = product['ref_price_bgn']
+        self.ref_price_eur = product['ref_price_eur']
+        self.visual_description = PRODUCT_VISUAL_DESCRIPTIONS.get(product_id, '')
+        self.aliases = tuple(PRODUCT_ALIASES.get(product_id, ()))
+        self.keywords = tuple(PRODUCT_KEYWORDS.get(product_id, ()))
+        self.fallback_keywords = tuple(tuple(group) for group in FALLBACK_KEYWORDS.get(product_id, ()))
+        self.weight_value = parse_weight(self.weight)
+        self.family = detect_product_family(self.name)
+        self.ref_unit_price_bgn = unit_price(self.ref_price_bgn, self.weight_value)
+        # Токени на името и на алтернативните имена (за локалното съпоставяне)
+        variants = [tokenize_product_name(self.name)]
+        for alias in self.aliases:
+            alias_tokens = tokenize_product_name(alias)
+            if alias_tokens:
+                variants.append(alias_tokens)
+        self.name_variants = tuple(variants)
+        self.unavailable_in = frozenset(
+            store_key for store_key, ids in PRODUCTS_NOT_AVAILABLE.items() if product_id in ids
+        )
+    
+    def __repr__(self):
+        return f"ProductRecord(#{self.id} {self.name} {self.weight})"
+
+
+class ProductCatalog:
+    """
+    Каталог с индекси за постоянно време на търсене.
+    
+    - by_id: ID -> ProductRecord
+    - by_name: нормализирано име -> ProductRecord
+    - by_alias: нормализирано алтернативно име -> ProductRecord
+    - by_prefix: 4-буквен префикс на токен -> set(ID) (за локалното съпоставяне)
+    - by_family_size: (вид, каноничен грамаж) -> tuple(ID)
+    
+    Обхождането (for record in catalog) запазва реда от PRODUCTS.
+    """
+    
+    def __init__(self, products):
+        self.records = [ProductRecord(p) for p in products]
+        self.by_id = {}
+        self.by_name = {}
+        self.by_alias = {}
+        self.by_prefix = {}
+        by_family_size = {}
+        for record in self.records:
+            if record.family and record.weight_value:
+                by_family_size.setdefault((record.family, record.weight_value), []).append(record.id)
+            self.by_id[record.id] = record
+            self.by_name[normalize_pattern(record.name)[0]] = record
+            for alias in record.aliases:
+                self.by_alias[normalize_pattern(alias)[0]] = record
+            for tokens in record.name_variants:
+                for token in tokens:
+                    self.by_prefix.setdefault(token[:4], set()).add(record.id)
+        self.by_family_size = {key: tuple(ids) for key, ids in by_family_size.items()}
+        self.families = {record.family for record in self.records if record.family}
+        self._check_references()
+    
+    def _check_references(self):
+        """Грешка при ID-та или магазини в помощните речници, които липсват в PRODUCTS/STORES."""
+        sources = {
+            "PRODUCT_VISUAL_DESCRIPTIONS": PRODUCT_VISUAL_DESCRIPTIONS,
+            "PRODUCT_ALIASES": PRODUCT_ALIASES,
+            "PRODUCT_KEYWORDS": PRODUCT_KEYWORDS,
+            "FALLBACK_KEYWORDS": FALLBACK_KEYWORDS,
+        }
+        broken = []
+        for source_name, mapping in sources.items():
+            unknown = sorted(set(mapping) - set(self.by_id))
+            if unknown:
+                broken.append(f"{source_name}: непознати ID {unknown}")
+        for store_key, ids in PRODUCTS_NOT_AVAILABLE.items():
+            unknown = sorted(set(ids) - set(self.by_id))
+            if store_key not in STORES or unknown:
+                broken.append(f"PRODUCTS_NOT_AVAILABLE[{store_key}]: непознат магазин или ID {unknown}")
+        if broken:
+            raise ValueError("Невалиден каталог - " + "; ".join(broken))
+    
+    def unindexed(self):
+        """Продуктите без вид или грамаж (липсват в by_family_size)."""
+        return [record for record in self.records if not record.family or not record.weight_value]
+    
+    def __iter__(self):
+        return iter(self.records)
+    
+    def __len__(self):
+        return len(self.records)
+    
+    def get(self, product_id):
+        """Продукт по ID (None ако няма такъв)."""
+        return self.by_id.get(product_id)
+    
+    def find(self, name):
+        """Продукт по точно име или алтернативно име (без значение от регистъра)."""
+        key = normalize_pattern(name)[0].strip()
+        return self.by_name.get(key) or self.by_alias.get(key)
+    
+    def classify(self, name):
+        """
+        Вид и каноничен грамаж на извлечено име.
+        
+        Returns:
+            tuple (family, size, ids): ids са продуктите от каталога със
+            същия вид и грамаж; None ако видът или грамажът не са известни
+        """
+        family = detect_product_family(name)
+        size = parse_weight(name)
+        if not family or not size or family not in self.families:
+            return family, size, None
+        return family, size, self.by_family_size.get((family, size), ())
+    
+    def name_of(self, product_id):
+        """Името на продукта по ID (None ако няма такъв)."""
+        record = self.by_id.get(product_id)
+        return record.name if record else None
+    
+    def unavailable_names(self, store_key):
+        """Имената на продуктите, които не се продават в магазина."""
+        return [record.name for record in self.records if store_key in record.unavailable_in]
+
+
+_CATALOG = None
+
+
+def get_catalog():
+    """Връща (и при нужда създава) каталога на продуктите."""
+    global _CATALOG
+    if _CATALOG is None:
+        _CATALOG = ProductCatalog(PRODUCTS)
+    return _CATALOG
 
 
 # =============================================================================
@@ -301,7 +1034,7 @@ def detect_currency_from_text(text):
     if not text:
         return None
     
-    text_lower = text.lower()
+    text_lower = normalize_text(text).lower
     
     # EUR индикатори (по-често срещани след 01.01.2026)
     eur_indicators = ['€', 'eur', ' е ', 'евро']
@@ -326,20 +1059,20 @@ def detect_currency_from_price_pattern(price_str):
     Ако цената е твърде висока за EUR за обичаен продукт (> 50), вероятно е BGN.
     
     Това е backup метод когато няма явни валутни индикатори.
+    Ако цената носи собствено валутно означение, то има предимство.
     """
-    try:
-        # Извличаме числото
-        price_match = re.search(r'(\d+[.,]\d{2})', str(price_str))
-        if price_match:
-            price = float(price_match.group(1).replace(',', '.'))
-            # Много ниска цена (< 0.5) е почти сигурно EUR
-            if price < 0.5:
-                return "EUR"
-            # Много висока цена (> 50) е вероятно BGN за тези продукти
-            if price > 50:
-                return "BGN"
-    except:
-        pass
+    tokens = scan_prices(str(price_str))
+    if not tokens:
+        return None
+    token = tokens[0]
+    if token.currency:
+        return token.currency
+    # Много ниска цена (< 0.5) е почти сигурно EUR
+    if token.value < 0.5:
+        return "EUR"
+    # Много висока цена (> 50) е вероятно BGN за тези продукти
+    if token.value > 50:
+        return "BGN"
     return None
 
 
@@ -387,6 +1120,21 @@ def convert_to_bgn(price, detected_currency):
         return round(price, 2)
 
 
+def price_in_bgn(price, currency):
+    """
+    Цената в BGN за сравнение с референтните цени.
+    Без изрична валута стойността се приема както е (в BGN).
+    """
+    if price is None or currency != "EUR":
+        return price
+    return round(price * EUR_BGN_RATE, 2)
+
+
+def format_price_label(price, currency=None):
+    """Цена с валутно означение за промптове и логове ("2.99 лв", "1.53 €")."""
+    return str(price) + (" €" if currency == "EUR" else " лв")
+
+
 def detect_currency_by_reference(price_value, ref_price_bgn):
     """
     Детектира валутата чрез сравнение с референтната BGN цена.
@@ -486,57 +1234,186 @@ def smart_price_normalization(price_value, page_text, store_config):
         price_bgn = round(price_value, 2)
     
     return price_bgn, detected
-# ВИЗУАЛНА ВЕРИФИКАЦИЯ С CLAUDE VISION
+
+
 # =============================================================================
+# ОБРАБОТКА НА ИЗОБРАЖЕНИЯ ЗА VISION
+# =============================================================================
+
+_IMAGE_MEDIA_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+# base64 се кодира на парчета, кратни на 3 байта (без padding между тях)
+_BASE64_CHUNK_SIZE = 3 * 64 * 1024
+
+
+def encode_base64_chunked(data):
+    """base64 кодиране на парчета - без второ копие на целия буфер в паметта."""
+    view = memoryview(data)
+    return ''.join(
+        base64.b64encode(view[i:i + _BASE64_CHUNK_SIZE]).decode('ascii')
+        for i in range(0, len(view), _BASE64_CHUNK_SIZE)
+    )
+
 
-def capture_product_screenshot(page, product_selector, index=0):
+def estimate_image_tokens(width, height):
+    """Приблизителен брой входни токени за изображение (~ ширина × височина / 750)."""
+    return max(1, int(width * height / 750))
+
+
+def _trim_background(image):
+    """
+    Изрязва еднородния фон около опаковката (по цвета на горния ляв ъгъл).
+    Не изрязва ако остава твърде малка част от картата.
+    """
+    from PIL import Image, ImageChops
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    diff = ImageChops.difference(image, background).convert('L')
+    bbox = diff.point(lambda value: 255 if value > VISION_TRIM_TOLERANCE else 0).getbbox()
+    if not bbox:
+        return image
+    width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    if width * height < 0.2 * image.size[0] * image.size[1]:
+        return image
+    return image.crop(bbox)
+
+
+def prepare_vision_image(png_bytes, store_name=None):
     """
-    Заснема screenshot на продуктова карта от страницата.
+    Подготвя screenshot за vision: изрязване до опаковката, смаляване до
+    VISION_IMAGE_MAX_EDGE и кодиране в VISION_IMAGE_FORMAT с VISION_IMAGE_QUALITY.
     
-    Args:
-        page: Playwright page обект
-        product_selector: CSS селектор за продуктовите карти
-        index: Индекс на продукта (ако има множество елементи)
+    png_bytes може да е и RGB масив (изрязана карта от екранен screenshot).
+    Без Pillow изображението се изпраща непроменено (PNG).
     
     Returns:
-        base64 encoded string на изображението или None при грешка
+        dict с "data" (base64), "media_type", "width", "height",
+        "original_bytes", "bytes", "tokens", "phash"
     """
-    try:
-        # Намираме всички продуктови карти
-        elements = page.query_selector_all(product_selector)
-        
-        if not elements or index >= len(elements):
-            return None
-        
-        element = elements[index]
-        
-        # Скролираме до елемента за да е видим
-        element.scroll_into_view_if_needed()
-        page.wait_for_timeout(300)
-        
-        # Заснемаме screenshot само на този елемент
-        screenshot_bytes = element.screenshot()
-        
-        # Конвертираме в base64
-        screenshot_base64 = base64.b64encode(screenshot_bytes).decode('utf-8')
-        
-        return screenshot_base64
-        
-    except Exception as e:
-        print(f"      [VISION] Грешка при screenshot: {str(e)[:50]}")
-        return None
+    if not PIL_AVAILABLE or VISION_IMAGE_FORMAT not in _IMAGE_MEDIA_TYPES:
+        return {
+            "data": encode_base64_chunked(png_bytes),
+            "media_type": "image/png",
+            "width": None,
+            "height": None,
+            "original_bytes": len(png_bytes),
+            "bytes": len(png_bytes),
+            "tokens": None,
+            "phash": None,
+        }
+    
+    import numpy as np
+    from PIL import Image
+    if isinstance(png_bytes, np.ndarray):
+        image = Image.fromarray(png_bytes)
+        original_bytes = png_bytes.nbytes
+    else:
+        image = Image.open(io.BytesIO(png_bytes)).convert('RGB')
+        original_bytes = len(png_bytes)
+    
+    # Изрязване до зоната на опаковката - първо по конфигурацията на магазина
+    crop_box = VISION_STORE_CROP.get(store_name)
+    if crop_box:
+        left, top, right, bottom = crop_box
+        width, height = image.size
+        image = image.crop((int(left * width), int(top * height), int(right * width), int(bottom * height)))
+    if VISION_TRIM_BACKGROUND:
+        image = _trim_background(image)
+    
+    # Смаляване до максимален размер на по-дългата страна
+    if max(image.size) > VISION_IMAGE_MAX_EDGE:
+        image.thumbnail((VISION_IMAGE_MAX_EDGE, VISION_IMAGE_MAX_EDGE), Image.LANCZOS)
+    phash = perceptual_hash(image)
+    
+    buffer = io.BytesIO()
+    if VISION_IMAGE_FORMAT == "PNG":
+        image.save(buffer, format="PNG", optimize=True)
+    else:
+        image.save(buffer, format=VISION_IMAGE_FORMAT, quality=VISION_IMAGE_QUALITY)
+    encoded = buffer.getbuffer()
+    
+    return {
+        "data": encode_base64_chunked(encoded),
+        "media_type": _IMAGE_MEDIA_TYPES[VISION_IMAGE_FORMAT],
+        "width": image.size[0],
+        "height": image.size[1],
+        "original_bytes": original_bytes,
+        "bytes": len(encoded),
+        "tokens": estimate_image_tokens(*image.size),
+        "phash": phash,
+    }
+
 
+@functools.lru_cache(maxsize=4)
+def _dct_matrix(size):
+    """Матрица на DCT-II с размер size × size."""
+    import numpy as np
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    matrix[0] *= 1 / np.sqrt(2)
+    return matrix * np.sqrt(2 / size)
 
-def verify_product_with_vision(client, screenshot_base64, text_name, text_price, store_name):
+
+def perceptual_hash(image):
     """
-    Използва Claude Vision за верификация на продукт по снимка.
+    DCT перцептивен хеш (pHash) - 64 бита като hex низ.
+    
+    Изображението се смалява до 32×32 сиво; битовете са нискочестотните
+    8×8 DCT коефициенти (без DC) спрямо медианата им. Близки изображения
+    (друг размер, компресия, малко изместване) дават близки хешове.
+    """
+    import numpy as np
+    from PIL import Image
+    pixels = np.asarray(image.convert('L').resize((32, 32), Image.LANCZOS), dtype=float)
+    dct = _dct_matrix(32)
+    coefficients = (dct @ pixels @ dct.T)[:8, :8].flatten()[1:]
+    bits = coefficients > np.median(coefficients)
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return f"{value:016x}"
+
+
+def hamming_distance(hash_a, hash_b):
+    """Брой различни битове между два hex хеша."""
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+def log_vision_image_stats(images):
+    """Логва общия размер преди/след обработката и приблизителните токени."""
+    if not images:
+        return
+    original = sum(image['original_bytes'] for image in images)
+    encoded = sum(image['bytes'] for image in images)
+    tokens = sum(image['tokens'] or 0 for image in images)
+    ratio = original / encoded if encoded else 0
+    print(f"      [VISION] Изображения: {len(images)}, {original // 1024}KB -> {encoded // 1024}KB "
+          f"(x{ratio:.1f}), ~{tokens} токена ({images[0]['media_type']})")
+
+
+# =============================================================================
+# ВИЗУАЛНА ВЕРИФИКАЦИЯ С CLAUDE VISION
+# =============================================================================
+
+def build_vision_products_text():
+    """Списък с продуктите и визуалните им описания за vision prompt-а."""
+    products_list = []
+    for record in get_catalog():
+        products_list.append(str(record.id) + ". " + record.name + " (" + record.weight + ") - " + record.visual_description)
+    return "\n".join(products_list)
+
+
+def verify_product_with_vision(client, screenshot_base64, text_name, text_price, store_name, media_type="image/png", text_currency=None):
+    """
+    Използва Claude Vision за верификация на продукт по снимка.
     
     Args:
         client: Anthropic клиент
         screenshot_base64: base64 encoded изображение
+        media_type: MIME типът на изображението (според VISION_IMAGE_FORMAT)
         text_name: Името на продукта от текста на сайта
         text_price: Цената от текста на сайта
         store_name: Име на магазина
+        text_currency: Валутата на цената ("BGN"/"EUR", None - без означение)
     
     Returns:
         dict с:
@@ -547,20 +1424,14 @@ def verify_product_with_vision(client, screenshot_base64, text_name, text_price,
     if not client or not screenshot_base64:
         return {"product_id": None, "confidence": "none", "reason": "Липсва изображение или клиент"}
     
-    # Създаваме списък с продуктите и визуалните им описания
-    products_list = []
-    for p in PRODUCTS:
-        visual_desc = PRODUCT_VISUAL_DESCRIPTIONS.get(p['id'], '')
-        products_list.append(str(p['id']) + ". " + p['name'] + " (" + p['weight'] + ") - " + visual_desc)
-    
-    products_text = "\n".join(products_list)
+    products_text = build_vision_products_text()
     
     prompt = """Анализирай изображението на продукт от магазин и определи кой точно продукт от списъка е.
 
 ПРОДУКТИ ЗА ИДЕНТИФИКАЦИЯ:
 """ + products_text + """
 
-ТЕКСТ ОТ САЙТА: """ + text_name + """ - """ + str(text_price) + """ лв
+ТЕКСТ ОТ САЙТА: """ + text_name + """ - """ + format_price_label(text_price, text_currency) + """
 
 ИНСТРУКЦИИ:
 1. Разгледай ВИЗУАЛНАТА информация: опаковка, цветове, надписи, лого Harmonica
@@ -584,7 +1455,7 @@ def verify_product_with_vision(client, screenshot_base64, text_name, text_price,
                         "type": "image",
                         "source": {
                             "type": "base64",
-                            "media_type": "image/png",
+                            "media_type": media_type,
                             "data": screenshot_base64
                         }
                     },
@@ -618,6 +1489,108 @@ def verify_product_with_vision(client, screenshot_base64, text_name, text_price,
         return {"product_id": None, "confidence": "none", "reason": str(e)[:50]}
 
 
+def verify_products_with_vision_batch(client, cards, store_name):
+    """
+    Верифицира няколко продуктови карти с едно Claude Vision извикване.
+    
+    Всяка снимка е предхождана от етикет "КАРТА N"; списъкът с продукти
+    се изпраща веднъж за целия batch вместо за всяка карта.
+    
+    Args:
+        cards: list от dict с "index", "screenshot_base64", "media_type", "name", "price"
+    
+    Returns:
+        dict {card index: {"product_id", "confidence", "reason"}};
+        картите без отговор липсват в резултата
+    """
+    if not client or not cards:
+        return {}
+    
+    content = []
+    card_lines = []
+    for card in cards:
+        content.append({"type": "text", "text": "КАРТА " + str(card['index']) + ":"})
+        content.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": card.get('media_type', "image/png"),
+                "data": card['screenshot_base64']
+            }
+        })
+        card_lines.append("КАРТА " + str(card['index']) + ": " + card['name'][:100] + " - " + format_price_label(card['price'], card.get('currency')))
+    
+    prompt = """Анализирай изображенията на продукти от магазин и за ВСЯКА карта определи кой точно продукт от списъка е.
+
+ПРОДУКТИ ЗА ИДЕНТИФИКАЦИЯ:
+""" + build_vision_products_text() + """
+
+ТЕКСТ ОТ САЙТА (по карти):
+""" + "\n".join(card_lines) + """
+
+ИНСТРУКЦИИ:
+1. Разгледай ВИЗУАЛНАТА информация: опаковка, цветове, надписи, лого Harmonica
+2. Сравни с описанията на продуктите
+3. ГРАМАЖЪТ е критичен - 40г е различно от 30г!
+4. Всяка карта се оценява самостоятелно
+5. Ако не си сигурен - върни null за product_id
+
+ФОРМАТ (само JSON масив, по един обект за всяка карта, без обяснения):
+[{"card": НОМЕР_НА_КАРТА, "product_id": NUMBER_OR_NULL, "confidence": "high/medium/low", "reason": "кратко обяснение"}]"""
+    content.append({"type": "text", "text": prompt})
+    
+    try:
+        message = client.messages.create(
+            model=CLAUDE_MODEL_VISION,
+            max_tokens=100 + 120 * len(cards),
+            messages=[{"role": "user", "content": content}]
+        )
+        response_text = message.content[0].text.strip()
+    except Exception as e:
+        print(f"      [VISION] API грешка (batch): {str(e)[:50]}")
+        return {}
+    
+    return parse_vision_batch_response(response_text, {card['index'] for card in cards})
+
+
+def parse_vision_batch_response(response_text, card_indexes):
+    """
+    Парсва JSON масива от batch vision отговора.
+    Отговори за карти, които не са в batch-а, се игнорират.
+    """
+    cleaned = response_text
+    if "```" in cleaned:
+        cleaned = re.sub(r'```(?:json)?\s*', '', cleaned)
+        cleaned = cleaned.replace('```', '').strip()
+    
+    items = []
+    array_match = re.search(r'\[[\s\S]*\]', cleaned)
+    if array_match:
+        try:
+            items = json.loads(array_match.group())
+        except json.JSONDecodeError:
+            items = []
+    if not items:
+        # Непълен или невалиден масив - вземаме всеки цял обект поотделно
+        for obj_match in re.finditer(r'\{[^{}]+\}', cleaned):
+            try:
+                items.append(json.loads(obj_match.group()))
+            except json.JSONDecodeError:
+                continue
+    
+    results = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            card_index = int(item.get('card'))
+        except (TypeError, ValueError):
+            continue
+        if card_index in card_indexes:
+            results[card_index] = item
+    return results
+
+
 def get_product_card_selectors(store_name):
     """
     Връща CSS селектори за продуктови карти според магазина.
@@ -715,14 +1688,10 @@ def validate_visual_price(product_id, visual_price, tolerance_percent=50):
         tuple: (is_valid, reason)
     """
     # Намираме референтната цена
-    ref_price = None
-    for p in PRODUCTS:
-        if p['id'] == product_id:
-            ref_price = p['ref_price_bgn']
-            break
-    
-    if not ref_price:
+    record = get_catalog().get(product_id)
+    if not record:
         return False, "Непознат продукт"
+    ref_price = record.ref_price_bgn
     
     if visual_price <= 0:
         return False, "Невалидна цена"
@@ -737,41 +1706,6 @@ def validate_visual_price(product_id, visual_price, tolerance_percent=50):
     return True, "OK"
 
 
-def get_product_keywords(product_id):
-    """
-    Връща ключови думи за търсене на продукт по ID.
-    Използва се за валидация на визуална идентификация.
-    Актуализирано за 24 продукта (v7.1).
-    """
-    keywords = {
-        1: ["вафла", "лимон", "крем", "30"],
-        2: ["вафла", "без", "захар", "30"],
-        3: ["козе", "сирене", "goat", "200"],
-        4: ["лютеница", "илиев", "260"],
-        5: ["кисело", "мляко", "3.6", "3,6", "400"],
-        6: ["лютеница", "хаджиев", "260"],
-        7: ["тахан", "сусам", "700"],
-        8: ["кашкавал", "краве", "300"],
-        9: ["крема", "сирене", "cream", "125"],
-        10: ["вафла", "лимец", "кокос", "30"],
-        11: ["краве", "сирене", "400"],
-        12: ["кори", "баница", "400"],
-        13: ["фъстъчено", "масло", "250"],
-        14: ["слънчогледово", "масло", "500"],
-        15: ["тунквана", "вафла", "chocobiotic", "40"],
-        16: ["сироп", "бъз", "750"],
-        17: ["прясно", "мляко", "1л", "1l"],
-        18: ["солети", "лимец", "50"],
-        19: ["пълнозърнести", "солети", "60"],
-        20: ["пълномаслено", "кисело", "400"],
-        21: ["извара", "500"],
-        22: ["студено", "пресовано", "слънчогледово", "500"],
-        23: ["кисело", "мляко", "2%", "400"],
-        24: ["кефир", "500"],
-    }
-    return keywords.get(product_id, [])
-
-
 def text_contains_product_keywords(text, product_id, min_matches=1):
     """
     Проверява дали текстът съдържа достатъчно ключови думи за продукта.
@@ -784,19 +1718,516 @@ def text_contains_product_keywords(text, product_id, min_matches=1):
     Returns:
         bool: True ако има достатъчно съвпадения
     """
-    text_lower = text.lower()
-    keywords = get_product_keywords(product_id)
+    record = get_catalog().get(product_id)
+    if not record:
+        return False
+    normalized = normalize_text(text)
     
-    matches = sum(1 for kw in keywords if kw.lower() in text_lower)
+    matches = sum(1 for kw in record.keywords if normalized.contains(kw))
     return matches >= min_matches
 
 
-def visual_verify_products(page, client, store_name, text_products, max_verify=5):
+# Намира продуктовите карти за всички селектори с едно извикване в страницата.
+# За всяка карта връща позиция, размер, текст и индекс (nth) в селектора -
+# без ElementHandle обекти и без отделни CDP заявки за всеки елемент.
+_DISCOVER_CARDS_JS = """
+([selectors, minSize, maxText]) => selectors.map((selector) => {
+    let elements;
+    try {
+        elements = document.querySelectorAll(selector);
+    } catch (e) {
+        return {selector, count: 0, cards: []};
+    }
+    const cards = [];
+    elements.forEach((el, nth) => {
+        const rect = el.getBoundingClientRect();
+        if (rect.width < minSize || rect.height < minSize) return;
+        cards.push({
+            nth,
+            x: rect.x + window.scrollX,
+            y: rect.y + window.scrollY,
+            width: rect.width,
+            height: rect.height,
+            text: (el.innerText || '').slice(0, maxText),
+        });
+    });
+    return {selector, count: elements.length, cards};
+})
+"""
+
+
+def parse_card_text(text):
+    """
+    Име, актуална цена и нейната валута от текста на продуктова карта.
+    
+    Returns:
+        tuple (име, цена, валута) или None ако картата няма цена;
+        валутата е None, ако цената няма означение
+    """
+    # Актуалната цена в картата (без зачеркнатата стара цена;
+    # при двойно показване - в BGN, както са референтните цени)
+    current = select_current_price(scan_prices(text), prefer_currency="BGN")
+    if not current:
+        return None
+    
+    # Извличаме име (първия ред с текст, който не е само цени)
+    product_name = "Неизвестен"
+    for line in text.split('\n'):
+        line = line.strip()
+        if line and not is_price_only_line(line):
+            product_name = line
+            break
+    return product_name, current.value, current.currency
+
+
+def discover_product_cards(page, selectors):
+    """
+    Открива продуктовите карти с едно page.evaluate за всички селектори.
+    Избира първия селектор (по приоритет), който има карти с цена.
+    
+    Returns:
+        tuple (selector, cards): всяка карта е dict с "selector", "nth",
+        "rect", "text", "name", "price", "currency"; (None, []) ако няма карти
+    """
+    try:
+        found = page.evaluate(_DISCOVER_CARDS_JS, [selectors, VISION_MIN_CARD_SIZE, VISION_CARD_TEXT_LIMIT])
+    except Exception as e:
+        print("      [VISION] Грешка при откриване на карти: " + str(e)[:50])
+        return None, []
+    
+    for entry in found:
+        cards = []
+        for raw in entry['cards']:
+            parsed = parse_card_text(raw['text'])
+            if not parsed:
+                continue
+            name, price, currency = parsed
+            cards.append({
+                "selector": entry['selector'],
+                "nth": raw['nth'],
+                "rect": (raw['x'], raw['y'], raw['width'], raw['height']),
+                "text": raw['text'],
+                "name": name,
+                "price": price,
+                "currency": currency,
+            })
+        if cards:
+            return entry['selector'], cards
+    return None, []
+
+
+def rank_vision_candidates(cards, text_products, product_names=None):
+    """
+    Подрежда картите по полза от визуална проверка:
+    0 - вероятно наш продукт, който липсва в текстовото извличане
+    1 - неясно съвпадение (няколко кандидата)
+    2 - продукт, вече намерен в текста (потвърждение)
+    3 - не прилича на наш продукт (или на избран продукт при product_names)
+    При равен приоритет се запазва редът в страницата.
+    """
+    catalog = get_catalog()
+    ranked = []
+    for order, card in enumerate(cards):
+        decision, candidates = prefilter_extracted_product({"name": card['name'], "price": card['price']})
+        if product_names is not None:
+            candidates = [c for c in candidates if catalog.name_of(c[0]) in product_names]
+        if decision == "skip" or not candidates:
+            priority = 3
+        elif any(catalog.name_of(c[0]) not in text_products for c in candidates):
+            priority = 0 if decision == "accept" or len(candidates) == 1 else 1
+        elif decision == "ambiguous":
+            priority = 1
+        else:
+            priority = 2
+        card['priority'] = priority
+        ranked.append((priority, order, card))
+    ranked.sort(key=lambda item: (item[0], item[1]))
+    return [card for _, _, card in ranked]
+
+
+def capture_card_screenshot(page, card):
+    """
+    Заснема открита продуктова карта чрез locator (селектор + nth).
+    Извиква се само от нишката на браузъра.
+    
+    Returns:
+        PNG байтове или None при грешка
+    """
+    try:
+        locator = page.locator(card['selector']).nth(card['nth'])
+        if VISION_SCREENSHOT_SETTLE_MS:
+            page.wait_for_timeout(VISION_SCREENSHOT_SETTLE_MS)
+        return locator.screenshot()
+    except Exception:
+        return None
+
+
+class ViewportTiler:
+    """
+    Заснемане на картите с по един screenshot на екран (viewport).
+    
+    Картите се разпределят в екрани по геометрията от discover_product_cards;
+    всеки екран се заснема и декодира веднъж, а картите са изрези (views) от
+    масива му без копиране. Карта, която не се побира в екран, връща None
+    и се заснема поотделно.
+    """
+    
+    _SCROLL_JS = "y => { window.scrollTo(0, y); return [window.scrollX, window.scrollY]; }"
+    _VIEWPORT_JS = "() => [window.innerWidth, window.innerHeight]"
+    
+    def __init__(self, page, cards):
+        self.page = page
+        self.tiles = {}  # начало на екрана -> (scrollX, scrollY, мащаб, RGB масив)
+        self.captures = 0
+        viewport = page.viewport_size or {}
+        width, height = viewport.get('width'), viewport.get('height')
+        if not width or not height:
+            width, height = page.evaluate(self._VIEWPORT_JS)
+        self.viewport = (width, height)
+        self.tile_of = self.plan(cards, height)
+    
+    @staticmethod
+    def plan(cards, viewport_height):
+        """
+        Групира картите в екрани: екранът започва от горния край на
+        първата непокрита карта (по вертикала) и покрива всички карти,
+        които се побират изцяло в него.
+        
+        Returns:
+            dict {id(card): начало на екрана}
+        """
+        tile_of = {}
+        tile_top = None
+        for card in sorted(cards, key=lambda c: c['rect'][1]):
+            _, y, _, h = card['rect']
+            if h > viewport_height:
+                continue
+            if tile_top is None or y + h > tile_top + viewport_height:
+                tile_top = max(0, int(y))
+            tile_of[id(card)] = tile_top
+        return tile_of
+    
+    def _capture(self, tile_top):
+        import numpy as np
+        from PIL import Image
+        scroll_x, scroll_y = self.page.evaluate(self._SCROLL_JS, tile_top)
+        if VISION_SCREENSHOT_SETTLE_MS:
+            self.page.wait_for_timeout(VISION_SCREENSHOT_SETTLE_MS)
+        pixels = np.asarray(Image.open(io.BytesIO(self.page.screenshot())).convert('RGB'))
+        self.captures += 1
+        return scroll_x, scroll_y, pixels.shape[1] / self.viewport[0], pixels
+    
+    def crop(self, card):
+        """
+        Изрезът на картата от нейния екран (RGB масив) или None.
+        Извиква се само от нишката на браузъра.
+        """
+        tile_top = self.tile_of.get(id(card))
+        if tile_top is None:
+            return None
+        try:
+            if tile_top not in self.tiles:
+                self.tiles[tile_top] = self._capture(tile_top)
+        except Exception:
+            return None
+        scroll_x, scroll_y, scale, pixels = self.tiles[tile_top]
+        x, y, w, h = card['rect']
+        left, top = int(round((x - scroll_x) * scale)), int(round((y - scroll_y) * scale))
+        right, bottom = left + int(round(w * scale)), top + int(round(h * scale))
+        # Страницата не е превъртяна докрай (края на документа) - картата не е в екрана
+        if left < 0 or top < 0 or right > pixels.shape[1] or bottom > pixels.shape[0]:
+            return None
+        return pixels[top:bottom, left:right]
+
+
+def prepare_vision_card(card, png_bytes, index, store_name=None):
+    """
+    Допълва картата с обработената снимка (prepare_vision_image).
+    png_bytes е screenshot на картата или изрез от екранен screenshot.
+    Не използва браузъра - изпълнява се в работните нишки.
+    
+    Returns:
+        картата, допълнена с "index", "screenshot_base64", "media_type",
+        "image", "phash"; None при грешка
+    """
+    try:
+        image = prepare_vision_image(png_bytes, store_name)
+    except Exception:
+        return None
+    card = dict(card)
+    card.update({
+        "index": index,
+        "screenshot_base64": image['data'],
+        "media_type": image['media_type'],
+        "image": image,
+        "phash": image['phash'],
+    })
+    return card
+
+
+def apply_vision_result(card, result, verified, stats):
+    """
+    Проверява отговора за една карта (увереност, цена, ключови думи)
+    и при успех я добавя към verified.
+    """
+    i = card['index']
+    product_name = card['name']
+    price = card['price']
+    
+    # Логваме резултата ако няма разпознат продукт (за debug)
+    if not result.get('product_id'):
+        # Показваме само първите няколко неразпознати за да не спамим лога
+        if i < 3:
+            reason = result.get('reason') or 'няма причина'
+            print("      [VISION] Неразпознат: " + product_name[:30] + " (" + format_price_label(price, card.get('currency')) + ") - " + reason[:40])
+        return False
+    
+    if result.get('confidence') not in ['high', 'medium']:
+        if i < 3:
+            print("      [VISION] Ниска увереност за #" + str(result.get('product_id')) + ": " + str(result.get('confidence', 'none')))
+        return False
+    
+    try:
+        product_id = int(result['product_id'])
+    except (TypeError, ValueError):
+        return False
+    
+    # ВАЛИДАЦИЯ 1: Проверка на цената
+    price_valid, price_reason = validate_visual_price(product_id, price_in_bgn(price, card.get('currency')))
+    if not price_valid:
+        stats["price"] += 1
+        print("      [VISION] Отхвърлен #" + str(product_id) + ": " + price_reason[:50])
+        return False
+    
+    # ВАЛИДАЦИЯ 2: Проверка на ключови думи (поне 1 съвпадение)
+    if not text_contains_product_keywords(card['text'], product_id, min_matches=1):
+        stats["keywords"] += 1
+        print("      [VISION] Отхвърлен #" + str(product_id) + ": липсват ключови думи в текста")
+        return False
+    
+    # Втора карта за вече верифициран продукт - пазим първата (по-важната)
+    if product_id in verified:
+        return True
+    
+    # Всичко е OK - добавяме към верифицираните
+    verified[product_id] = {
+        'price': price,
+        'currency': card.get('currency'),
+        'confidence': result.get('confidence'),
+        'reason': result.get('reason', ''),
+        'text_name': product_name[:50]
+    }
+    stats["verified"] += 1
+    print("      [VISION] #" + str(product_id) + ": " + result.get('confidence', '') + " - " + (result.get('reason') or '')[:40])
+    return True
+
+
+class VisionCache:
+    """
+    Постоянен кеш на vision идентификациите: (магазин, pHash, име от сайта)
+    -> product_id и увереност от предишна верификация.
+    
+    Търсенето допуска до VISION_CACHE_MAX_DISTANCE различни бита в pHash-а.
+    Записите остаряват VISION_CACHE_MAX_AGE_DAYS дни след последната
+    верификация с Claude (отрицателните - след VISION_CACHE_NEGATIVE_AGE_DAYS),
+    така че всяка карта периодично се проверява отново.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # "магазин|име" -> [запис]
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        # lookup/remember се викат от работните нишки на vision pipeline-а
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def _key(store_name, text_name):
+        return store_name + "|" + normalize_pattern(text_name.strip())[0]
+    
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.entries = data.get('entries', {})
+        except (OSError, ValueError):
+            self.entries = {}
+        self.evict()
+        return self
+    
+    def evict(self, now=None):
+        """Премахва остарелите записи."""
+        now = now or time.time()
+        evicted = 0
+        for key in list(self.entries):
+            fresh = []
+            for entry in self.entries[key]:
+                max_age = VISION_CACHE_MAX_AGE_DAYS if entry.get('product_id') else VISION_CACHE_NEGATIVE_AGE_DAYS
+                if now - entry.get('verified_at', 0) <= max_age * 86400:
+                    fresh.append(entry)
+            evicted += len(self.entries[key]) - len(fresh)
+            if fresh:
+                self.entries[key] = fresh
+            else:
+                del self.entries[key]
+        if evicted:
+            self.dirty = True
+        return evicted
+    
+    def lookup(self, store_name, text_name, phash):
+        """
+        Най-близкият запис за картата.
+        
+        Returns:
+            dict {"product_id", "confidence", "reason"} или None
+        """
+        if not phash:
+            return None
+        best = None
+        best_distance = VISION_CACHE_MAX_DISTANCE + 1
+        with self.lock:
+            for entry in self.entries.get(self._key(store_name, text_name), ()):
+                distance = hamming_distance(phash, entry['phash'])
+                if distance < best_distance:
+                    best, best_distance = entry, distance
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return {
+            "product_id": best.get('product_id'),
+            "confidence": best.get('confidence'),
+            "reason": "кеш (pHash Δ" + str(best_distance) + ")",
+        }
+    
+    def remember(self, store_name, text_name, phash, result):
+        """Записва отговор от Claude за картата (заменя близките стари записи)."""
+        if not phash:
+            return
+        key = self._key(store_name, text_name)
+        with self.lock:
+            entries = [
+                entry for entry in self.entries.get(key, ())
+                if hamming_distance(phash, entry['phash']) > VISION_CACHE_MAX_DISTANCE
+            ]
+            entries.append({
+                "phash": phash,
+                "product_id": result.get('product_id'),
+                "confidence": result.get('confidence'),
+                "verified_at": time.time(),
+            })
+            self.entries[key] = entries
+            self.dirty = True
+    
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"entries": self.entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError as e:
+            print(f"      [VISION] Кешът не е записан: {str(e)[:50]}")
+
+
+_VISION_CACHE = None
+
+
+def get_vision_cache():
+    """Връща vision кеша (None ако е изключен или няма Pillow за pHash)."""
+    global _VISION_CACHE
+    if not VISION_CACHE_ENABLED or not PIL_AVAILABLE:
+        return None
+    if _VISION_CACHE is None:
+        _VISION_CACHE = VisionCache(os.path.join(CACHE_DIR, 'vision_cache.json')).load()
+    return _VISION_CACHE
+
+
+def remember_vision_result(cache, store_name, card, result, accepted):
+    """
+    Кешира отговор от Claude: приетите идентификации и явните "не е наш продукт".
+    Ниска увереност и отхвърлените от валидациите не се кешират.
+    """
+    if cache is None:
+        return
+    if accepted or (not result.get('product_id') and not result.get('missing')):
+        cache.remember(store_name, card['name'], card.get('phash'), result)
+
+
+def verify_vision_work_item(client, captured, store_name, cache=None):
+    """
+    Работна задача от vision pipeline-а (изпълнява се в пула от нишки).
+    
+    Обработва снимките, проверява кеша и изпраща на Claude само
+    непознатите карти - с едно извикване (batch) или поотделно.
+    
+    Args:
+        captured: list от (index, открита карта, PNG байтове или RGB изрез)
+    
+    Returns:
+        list от (card, result, from_claude) по реда на картите
+    """
+    cards = [prepare_vision_card(card, png_bytes, index, store_name) for index, card, png_bytes in captured]
+    cards = [card for card in cards if card]
+    
+    answers = {}
+    to_ask = []
+    for card in cards:
+        # Позната снимка - Claude не се вика, проверките за цена и ключови думи остават
+        cached = cache.lookup(store_name, card['name'], card['phash']) if cache else None
+        if cached:
+            answers[card['index']] = (cached, False)
+        else:
+            to_ask.append(card)
+    
+    if len(to_ask) == 1 and VISION_BATCH_SIZE <= 1:
+        # Единичен режим - по едно извикване за всяка карта
+        card = to_ask[0]
+        result = verify_product_with_vision(
+            client,
+            card['screenshot_base64'],
+            card['name'][:100],
+            card['price'],
+            store_name,
+            media_type=card['media_type'],
+            text_currency=card.get('currency')
+        )
+        # "none" е грешка/липсващ отговор - не се кешира
+        if result.get('confidence') == "none":
+            result['missing'] = True
+        answers[card['index']] = (result, True)
+    elif to_ask:
+        started_at = time.time()
+        results = verify_products_with_vision_batch(client, to_ask, store_name)
+        print(f"      [VISION] Batch от {len(to_ask)} карти: {len(results)} отговора за {time.time() - started_at:.1f}s")
+        for card in to_ask:
+            result = results.get(card['index'], {"product_id": None, "reason": "Няма отговор за картата", "missing": True})
+            answers[card['index']] = (result, True)
+    
+    return [(card,) + answers[card['index']] for card in cards]
+
+
+def visual_verify_products(page, client, store_name, text_products, max_verify=5, product_names=None):
     """
     Визуално верифицира продукти чрез screenshots.
+    product_names ограничава проверката до избраните продукти (частично стартиране).
     
     Включва валидация на цените, филтриране по ключови думи,
     и филтриране на елементи по размер за по-точна идентификация.
+    Картите се откриват с едно извикване в страницата и се подреждат по
+    полза: първо липсващите от текстовото извличане, после неясните.
+    Картите, които не приличат на наш продукт (приоритет 3), не се заснемат
+    и не се изпращат на Claude. Изпращат се на batch-ове от VISION_BATCH_SIZE
+    в едно извикване.
+    
+    Браузърът се използва само от текущата нишка (sync Playwright API не е
+    thread-safe): тя заснема картите, докато пул от VISION_WORKERS нишки
+    обработва снимките и чака отговорите на Claude. При VISION_CAPTURE_MODE
+    "tiled" се заснема по веднъж всеки екран с карти (ViewportTiler).
     """
     if not ENABLE_VISUAL_VERIFICATION:
         return {}
@@ -808,132 +2239,116 @@ def visual_verify_products(page, client, store_name, text_products, max_verify=5
     verified = {}
     selectors = get_product_card_selectors(store_name)
     
-    # Опитваме различни селектори
-    product_elements = []
-    used_selector = None
-    for selector in selectors:
-        try:
-            elements = page.query_selector_all(selector)
-            if elements and len(elements) > 0:
-                # Филтрираме елементите по размер - продуктова карта е поне 80x80 пиксела
-                valid_elements = []
-                for el in elements:
-                    try:
-                        box = el.bounding_box()
-                        if box and box['width'] >= 80 and box['height'] >= 80:
-                            # Проверяваме дали елементът съдържа цена
-                            text = el.inner_text()
-                            if re.search(r'\d+[,.]\d{2}', text):
-                                valid_elements.append(el)
-                    except:
-                        continue
-                
-                if valid_elements:
-                    product_elements = valid_elements
-                    used_selector = selector
-                    print("      [VISION] Намерени " + str(len(valid_elements)) + " валидни продуктови карти с '" + selector + "'")
-                    break
-        except:
-            continue
-    
-    if not product_elements:
+    # Всички селектори с едно извикване в страницата
+    used_selector, cards = discover_product_cards(page, selectors)
+    if not cards:
         print("      [VISION] Не са намерени продуктови карти за screenshot")
         debug_page_elements(page, store_name)
         return {}
     
-    # Верифицираме до max_verify продукта
-    verified_count = 0
-    skipped_price = 0
-    skipped_keywords = 0
+    cards = rank_vision_candidates(cards, text_products or {}, product_names)
+    priorities = [card['priority'] for card in cards]
+    print("      [VISION] Намерени " + str(len(cards)) + " валидни продуктови карти с '" + used_selector + "'"
+          + " (липсващи: " + str(priorities.count(0)) + ", неясни: " + str(priorities.count(1))
+          + ", чужди: " + str(priorities.count(3)) + ")")
     
-    for i, element in enumerate(product_elements):
-        if verified_count >= max_verify:
-            break
-        
+    # Чуждите карти са подредени последни - спираме преди тях
+    cards = [card for card in cards if card['priority'] < 3]
+    if not cards:
+        print("      [VISION] Няма карти, които приличат на наш продукт")
+        return {}
+    
+    # Верифицираме до max_verify различни продукта
+    # Producer/consumer: нишката на браузъра заснема картите, а пул от
+    # VISION_WORKERS нишки ги обработва и проверява с Claude междувременно.
+    # В обработка са най-много VISION_MAX_IN_FLIGHT задачи наведнъж, а
+    # заснетите и още непроверени карти не надхвърлят оставащия бюджет -
+    # така всяка заснета карта стига до проверката и до кеша.
+    stats = {"verified": 0, "price": 0, "keywords": 0}
+    batch_size = max(1, VISION_BATCH_SIZE)
+    images = []
+    cache = get_vision_cache()
+    cache_counts = (cache.hits, cache.misses) if cache else (0, 0)
+    
+    in_flight = {}  # future -> брой карти в задачата
+    tiler = None
+    if VISION_CAPTURE_MODE == "tiled" and PIL_AVAILABLE:
         try:
-            # Заснемаме screenshot
-            element.scroll_into_view_if_needed()
-            page.wait_for_timeout(200)
-            screenshot_bytes = element.screenshot()
-            screenshot_base64 = base64.b64encode(screenshot_bytes).decode('utf-8')
-            
-            # Опитваме се да извлечем текста от елемента
-            element_text = element.inner_text()
-            
-            # Подобрено извличане на цена - търсим различни формати
-            # Формати: "2.99", "2,99", "2.99 лв", "2,99лв", "BGN 2.99"
-            price = 0
-            price_patterns = [
-                r'(\d+)[,.](\d{2})\s*(?:лв|BGN|EUR)?',  # Стандартен формат
-                r'(?:лв|BGN|EUR)\s*(\d+)[,.](\d{2})',   # Валута отпред
-            ]
-            for pattern in price_patterns:
-                price_match = re.search(pattern, element_text)
-                if price_match:
-                    price = float(price_match.group(1) + "." + price_match.group(2))
-                    break
-            
-            # Пропускаме ако няма цена
-            if price == 0:
-                continue
-            
-            # Извличаме име (първия ред с текст, който не е цена)
-            lines = [l.strip() for l in element_text.split('\n') if l.strip()]
-            product_name = "Неизвестен"
-            for line in lines:
-                if not re.match(r'^[\d,.]+\s*(лв|BGN|EUR)?$', line):
-                    product_name = line
-                    break
-            
-            # Верифицираме с Claude Vision
-            result = verify_product_with_vision(
-                client, 
-                screenshot_base64, 
-                product_name[:100],
-                price, 
-                store_name
-            )
-            
-            # Логваме резултата ако няма разпознат продукт (за debug)
-            if not result.get('product_id'):
-                # Показваме само първите няколко неразпознати за да не спамим лога
-                if i < 3:
-                    reason = result.get('reason', 'няма причина')
-                    print("      [VISION] Неразпознат: " + product_name[:30] + " (" + str(price) + " лв) - " + reason[:40])
-                continue
-            
-            if result.get('confidence') not in ['high', 'medium']:
-                if i < 3:
-                    print("      [VISION] Ниска увереност за #" + str(result.get('product_id')) + ": " + result.get('confidence', 'none'))
-                continue
-            
-            product_id = result['product_id']
-            
-            # ВАЛИДАЦИЯ 1: Проверка на цената
-            price_valid, price_reason = validate_visual_price(product_id, price)
-            if not price_valid:
-                skipped_price += 1
-                print("      [VISION] Отхвърлен #" + str(product_id) + ": " + price_reason[:50])
+            tiler = ViewportTiler(page, cards)
+        except Exception as e:
+            print("      [VISION] Заснемане по екрани не е възможно: " + str(e)[:50])
+    element_captures = 0
+    
+    def collect(block):
+        """Прилага резултатите от завършените задачи (в нишката на браузъра)."""
+        if not in_flight:
+            return
+        timeout = None if block else 0
+        done, _ = concurrent.futures.wait(in_flight, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            in_flight.pop(future)
+            try:
+                outcomes = future.result()
+            except Exception as e:
+                print("      [VISION] Грешка в задача: " + str(e)[:50])
                 continue
+            for card, result, from_claude in outcomes:
+                images.append(card['image'])
+                if len(verified) < max_verify:
+                    accepted = apply_vision_result(card, result, verified, stats)
+                else:
+                    # Над бюджета резултатът само се кешира (платената проверка не се губи)
+                    accepted = apply_vision_result(card, result, {}, dict(stats))
+                if from_claude:
+                    remember_vision_result(cache, store_name, card, result, accepted)
+    
+    captured = []
+    
+    def submit():
+        nonlocal captured
+        if captured:
+            in_flight[executor.submit(verify_vision_work_item, client, captured, store_name, cache)] = len(captured)
+            captured = []
+    
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, VISION_WORKERS))
+    try:
+        for i, discovered in enumerate(cards):
+            collect(block=False)
+            # Картите в обработка покриват оставащия бюджет - първо чакаме резултатите им
+            while len(captured) + sum(in_flight.values()) >= max_verify - len(verified) > 0:
+                submit()
+                collect(block=True)
+            while len(in_flight) >= VISION_MAX_IN_FLIGHT:
+                collect(block=True)
+            if len(verified) >= max_verify:
+                break
             
-            # ВАЛИДАЦИЯ 2: Проверка на ключови думи (поне 1 съвпадение)
-            if not text_contains_product_keywords(element_text, product_id, min_matches=1):
-                skipped_keywords += 1
-                print("      [VISION] Отхвърлен #" + str(product_id) + ": липсват ключови думи в текста")
+            source = tiler.crop(discovered) if tiler else None
+            if source is None:
+                source = capture_card_screenshot(page, discovered)
+                element_captures += 1
+            if source is None:
                 continue
-            
-            # Всичко е OK - добавяме към верифицираните
-            verified[product_id] = {
-                'price': price,
-                'confidence': result.get('confidence'),
-                'reason': result.get('reason', ''),
-                'text_name': product_name[:50]
-            }
-            verified_count += 1
-            print("      [VISION] #" + str(product_id) + ": " + result.get('confidence', '') + " - " + result.get('reason', '')[:40])
+            captured.append((i, discovered, source))
+            if len(captured) >= batch_size:
+                submit()
         
-        except Exception as e:
-            continue
+        # Заснетите карти се довършват и резултатите им се кешират
+        submit()
+        while in_flight:
+            collect(block=True)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    
+    if tiler:
+        print(f"      [VISION] Заснемане: {tiler.captures} екрана, {element_captures} отделни карти")
+    if cache:
+        print(f"      [VISION] Кеш: {cache.hits - cache_counts[0]} попадения, {cache.misses - cache_counts[1]} пропуски")
+        cache.save()
+    
+    skipped_price = stats["price"]
+    skipped_keywords = stats["keywords"]
+    log_vision_image_stats(images)
     
     print("      [VISION] Верифицирани: " + str(len(verified)) + ", Отхвърлени (цена): " + str(skipped_price) + ", Отхвърлени (ключови думи): " + str(skipped_keywords))
     
@@ -944,65 +2359,457 @@ def visual_verify_products(page, client, store_name, text_products, max_verify=5
 
 
 # =============================================================================
-# CLAUDE API - ДВУФАЗЕН АНАЛИЗ
+# ЛОКАЛНО ПРЕДВАРИТЕЛНО СЪПОСТАВЯНЕ (PRE-FILTER ЗА ФАЗА 2)
 # =============================================================================
 
-def get_claude_client():
-    """Създава Claude API клиент."""
-    api_key = os.environ.get('ANTHROPIC_API_KEY')
-    if not api_key:
-        print("    [CLAUDE] API ключ не е зададен")
-        return None
-    try:
-        return anthropic.Anthropic(api_key=api_key)
-    except Exception as e:
-        print(f"    [CLAUDE] Грешка при създаване на клиент: {str(e)[:50]}")
-        return None
+# Думи, които не носят информация за конкретния продукт
+PREFILTER_STOPWORDS = {
+    "био", "bio", "organic", "harmonica", "хармоника",
+    "с", "със", "от", "и", "на", "за", "в", "the", "with",
+}
+_PREFILTER_STOPWORDS_LATIN = {transliterate(word) for word in PREFILTER_STOPWORDS}
 
+_NAME_TOKEN_RE = re.compile(r'\d+(?:[.,]\d+)?|[a-zа-я][a-zа-я-]*')
 
-def phase1_extract_all_products(client, page_text, store_name):
+def tokenize_product_name(text):
     """
-    ФАЗА 1: Груба екстракция
-    Намира ВСИЧКИ ХРАНИТЕЛНИ продукти на Harmonica от текста.
-    Връща списък с продукти точно както са изписани в сайта.
+    Разделя име на продукт на значими токени (без грамаж и стоп думи).
+    Числата се запазват като токени ("3,6%" -> "3.6", "2.0%" -> "2") -
+    масленостите различават иначе еднакви продукти.
+    Токените са транслитерирани, така че "Лютеница" и "Lyutenitsa" съвпадат.
     """
-    
-    # Ограничаваме текста
-    if len(page_text) > 14000:
-        page_text = page_text[:14000]
-    
-    prompt = f"""Анализирай текста от българския онлайн магазин "{store_name}" и извлечи САМО ХРАНИТЕЛНИТЕ продукти на марката Harmonica (Хармоника) с техните цени.
-
-ТЕКСТ ОТ СТРАНИЦАТА:
-{page_text}
-
-ИЗВЛИЧАЙ САМО ХРАНИ:
-- Млечни продукти (айран, кисело мляко, сирене, крема сирене)
-- Сладкарски изделия (локум, бисквити, вафли, топчета)
-- Напитки (лимонада, сиропи)
-- Консерви (пасирани домати, passata)
-- Снаксове (претцели, smiles, чипс)
+    text_latin = transliterate(strip_weight(normalize_pattern(text)[0]))
+    tokens = set()
+    for token in _NAME_TOKEN_RE.findall(text_latin):
+        if token[0].isdigit():
+            token = '%g' % float(token.replace(',', '.'))
+        else:
+            token = token.strip('-')
+        if token and token not in _PREFILTER_STOPWORDS_LATIN:
+            tokens.add(token)
+    return tokens
 
-НЕ ИЗВЛИЧАЙ: дрехи, аксесоари, козметика, нехранителни продукти.
 
-ИНСТРУКЦИИ:
-1. Намери ХРАНИТЕЛНИ продукти на Harmonica/Хармоника
-2. Извлечи ТОЧНОТО име + цена в лева (BGN)
-3. Включи грамажа/обема
+def _tokens_match(a, b):
+    """Два токена съвпадат при равенство или общ корен (лимон/лимонов, илиев/илиеви)."""
+    if a == b:
+        return True
+    if len(a) < 4 or len(b) < 4 or a[0].isdigit() or b[0].isdigit():
+        return False
+    return a.startswith(b) or b.startswith(a)
 
-КРИТИЧНО - ФОРМАТ НА ОТГОВОРА:
-- Върни САМО JSON масив
-- БЕЗ ```json``` маркери
-- БЕЗ обяснения преди или след JSON
-- БЕЗ коментари
-- Само чист JSON!
 
-Пример за правилен отговор:
-[{{"name": "Био Айран 500мл", "price": 2.99}}, {{"name": "Вафла класик 40г", "price": 2.19}}]
+def _token_overlap_score(tokens_a, tokens_b):
+    """Dice коефициент между два набора токени с толеранс за окончания."""
+    if not tokens_a or not tokens_b:
+        return 0.0
+    matched = sum(1 for a in tokens_a if any(_tokens_match(a, b) for b in tokens_b))
+    return 2.0 * matched / (len(tokens_a) + len(tokens_b))
 
-Ако няма продукти: []"""
 
-    try:
+def score_catalog_candidates(extracted_name, top_k=PHASE2_PREFILTER_TOP_K):
+    """
+    Оценява кои продукти от каталога отговарят на извлеченото име.
+    
+    Резултатът е Dice припокриване на токените (най-добрият от името и
+    алтернативните имена); различен грамаж силно намалява резултата.
+    Оценяват се само продуктите с общ префикс (обратен индекс), затова
+    времето не расте линейно с размера на каталога.
+    
+    Returns:
+        list от (product_id, score, weight_agrees) сортиран по score, до top_k елемента
+    """
+    catalog = get_catalog()
+    tokens = tokenize_product_name(extracted_name)
+    weight = parse_weight(extracted_name)
+    
+    candidate_ids = set()
+    for token in tokens:
+        candidate_ids.update(catalog.by_prefix.get(token[:4], ()))
+    
+    scored = []
+    for product_id in candidate_ids:
+        record = catalog.by_id[product_id]
+        score = max(_token_overlap_score(tokens, variant) for variant in record.name_variants)
+        weight_agrees = None
+        if weight and record.weight_value:
+            weight_agrees = weight == record.weight_value
+            if not weight_agrees:
+                score *= 0.3
+        scored.append((product_id, round(score, 3), weight_agrees))
+    
+    scored.sort(key=lambda item: (-item[1], item[0]))
+    return scored[:top_k]
+
+
+def prefilter_extracted_product(extracted):
+    """
+    Локално решение за един извлечен продукт.
+    
+    Грамажът се решава локално чрез индекса (вид, грамаж): продукт от
+    наш вид, но с грамаж, какъвто нямаме (напр. кефир 1л), не стига до LLM.
+    
+    Returns:
+        tuple (decision, candidates):
+            - ("accept", [(product_id, score, True)]) - еднозначно съвпадение
+            - ("ambiguous", кандидати) - изпраща се на Claude с кандидатите
+            - ("skip", кандидати) - не прилича на нито един наш продукт
+    """
+    candidates = score_catalog_candidates(extracted['name'])
+    if not candidates or candidates[0][1] < PHASE2_MIN_CANDIDATE_SCORE:
+        return "skip", candidates
+    
+    _, _, same_size_ids = get_catalog().classify(extracted['name'])
+    if same_size_ids is not None and not same_size_ids:
+        return "skip", candidates
+    
+    best_id, best_score, weight_agrees = candidates[0]
+    second_score = candidates[1][1] if len(candidates) > 1 else 0.0
+    if (weight_agrees and best_score >= PHASE2_AUTO_ACCEPT_SCORE
+            and best_score - second_score >= PHASE2_AUTO_ACCEPT_MARGIN):
+        return "accept", candidates[:1]
+    
+    # Единственият продукт от този вид и грамаж - приемаме при достатъчна прилика
+    if (same_size_ids and len(same_size_ids) == 1 and best_id == same_size_ids[0]
+            and best_score >= PHASE2_FAMILY_SIZE_ACCEPT_SCORE):
+        return "accept", candidates[:1]
+    
+    # За Claude пращаме само кандидатите, които не противоречат по грамаж
+    shortlist = [c for c in candidates if c[2] is not False and c[1] >= PHASE2_MIN_CANDIDATE_SCORE]
+    if not shortlist:
+        return "skip", candidates
+    return "ambiguous", shortlist
+
+
+# =============================================================================
+# N-GRAM СЪПОСТАВЯНЕ (локален engine за Фаза 2)
+# =============================================================================
+
+def _char_ngrams(tokens, n=NGRAM_SIZE):
+    """Символни n-грами на всеки токен, ограден с интервали (" kefir " -> " ke", "kef", ...)."""
+    grams = []
+    for token in tokens:
+        padded = f" {token} "
+        if len(padded) <= n:
+            grams.append(padded)
+        else:
+            grams.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return grams
+
+
+class NgramMatcher:
+    """
+    Детерминистичен matcher със символни n-грами и TF-IDF.
+    
+    Имената и алтернативните имена от каталога се векторизират веднъж в
+    разредена матрица (документи × n-грами). Всички извлечени имена от
+    един магазин се съпоставят с едно умножение на разредени матрици;
+    резултатът за продукт е най-добрият от неговите документи.
+    """
+    
+    def __init__(self, catalog):
+        import numpy as np
+        self.catalog = catalog
+        self.product_ids = []
+        self.sizes = []
+        doc_grams = []
+        doc_starts = []
+        for record in catalog:
+            doc_starts.append(len(doc_grams))
+            self.product_ids.append(record.id)
+            self.sizes.append(record.weight_value)
+            for tokens in record.name_variants:
+                doc_grams.append(_char_ngrams(sorted(tokens)))
+        # Начало на документите на всеки продукт (за np.maximum.reduceat)
+        self.doc_starts = np.array(doc_starts)
+        
+        self.vocabulary = {}
+        for grams in doc_grams:
+            for gram in grams:
+                self.vocabulary.setdefault(gram, len(self.vocabulary))
+        
+        counts = self._count_matrix(doc_grams)
+        # Изгладен IDF: редките n-грами носят повече информация
+        document_frequency = np.bincount(counts.indices, minlength=len(self.vocabulary))
+        self.idf = np.log((1 + len(doc_grams)) / (1 + document_frequency)) + 1.0
+        self.documents = self._tfidf(counts)
+    
+    def _count_matrix(self, gram_lists):
+        import numpy as np
+        rows, cols = [], []
+        for row, grams in enumerate(gram_lists):
+            for gram in grams:
+                col = self.vocabulary.get(gram)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+        import scipy.sparse as scipy_sparse
+        data = np.ones(len(rows))
+        matrix = scipy_sparse.csr_matrix(
+            (data, (rows, cols)), shape=(len(gram_lists), len(self.vocabulary))
+        )
+        matrix.sum_duplicates()
+        return matrix
+    
+    def _tfidf(self, counts):
+        """TF-IDF с L2 нормализация на редовете (косинусовата прилика става скаларно произведение)."""
+        import numpy as np
+        import scipy.sparse as scipy_sparse
+        weighted = counts.multiply(self.idf).tocsr()
+        norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        return scipy_sparse.diags(1.0 / norms) @ weighted
+    
+    def score(self, names):
+        """
+        Косинусова прилика на всяко име с всеки продукт от каталога.
+        
+        Returns:
+            np.ndarray (len(names) × брой продукти)
+        """
+        import numpy as np
+        queries = self._tfidf(self._count_matrix([
+            _char_ngrams(sorted(tokenize_product_name(name))) for name in names
+        ]))
+        similarity = (queries @ self.documents.T).toarray()
+        return np.maximum.reduceat(similarity, self.doc_starts, axis=1)
+    
+    def match(self, extracted_products, top_k=PHASE2_PREFILTER_TOP_K):
+        """
+        Съпоставя всички извлечени продукти на един магазин наведнъж.
+        
+        Различен грамаж изключва кандидата; продукт от наш вид, но с
+        грамаж, какъвто нямаме, се пропуска.
+        
+        Returns:
+            list от (extracted, (decision, candidates)) - форматът на
+            prefilter_extracted_product, за phase2_prefilter
+        """
+        import numpy as np
+        if not extracted_products:
+            return []
+        names = [p['name'] for p in extracted_products]
+        scores = self.score(names)
+        
+        decisions = []
+        for row, extracted in enumerate(extracted_products):
+            size = parse_weight(extracted['name'])
+            _, _, same_size_ids = self.catalog.classify(extracted['name'])
+            
+            candidates = []
+            for col in np.argsort(-scores[row], kind='stable')[:top_k * 2]:
+                score = float(scores[row, col])
+                if score < NGRAM_MIN_SCORE:
+                    break
+                weight_agrees = None
+                if size and self.sizes[col]:
+                    weight_agrees = size == self.sizes[col]
+                    if not weight_agrees:
+                        continue
+                candidates.append((self.product_ids[col], round(score, 3), weight_agrees))
+                if len(candidates) == top_k:
+                    break
+            
+            if not candidates or (same_size_ids is not None and not same_size_ids):
+                decisions.append((extracted, ("skip", candidates)))
+                continue
+            
+            best_id, best_score, weight_agrees = candidates[0]
+            second_score = candidates[1][1] if len(candidates) > 1 else 0.0
+            if (weight_agrees and best_score >= NGRAM_ACCEPT_SCORE
+                    and best_score - second_score >= NGRAM_ACCEPT_MARGIN):
+                decisions.append((extracted, ("accept", candidates[:1])))
+            else:
+                decisions.append((extracted, ("ambiguous", candidates)))
+        return decisions
+
+
+_NGRAM_MATCHER = None
+
+
+def get_ngram_matcher():
+    """Връща (и при нужда създава) n-gram matcher-а за каталога."""
+    global _NGRAM_MATCHER
+    if _NGRAM_MATCHER is None:
+        _NGRAM_MATCHER = NgramMatcher(get_catalog())
+    return _NGRAM_MATCHER
+
+
+def get_phase2_engine():
+    """Избраният engine за Фаза 2 ("llm" ако scipy липсва за n-gram engine-ите)."""
+    engine = PHASE2_ENGINE
+    if engine not in ("llm", "ngram", "hybrid"):
+        print(f"    [ФАЗА 2] Непознат engine '{engine}', използваме 'llm'")
+        return "llm"
+    if engine != "llm" and not SCIPY_AVAILABLE:
+        print(f"    [ФАЗА 2] scipy не е наличен, '{engine}' -> 'llm'")
+        return "llm"
+    return engine
+
+
+# =============================================================================
+# CLAUDE API - ДВУФАЗЕН АНАЛИЗ
+# =============================================================================
+
+def get_claude_client():
+    """
+    Създава Claude API клиент.
+    ANTHROPIC_BASE_URL пренасочва заявките (напр. към fake_anthropic.py за офлайн тестове).
+    """
+    api_key = os.environ.get('ANTHROPIC_API_KEY')
+    if not api_key:
+        print("    [CLAUDE] API ключ не е зададен")
+        return None
+    try:
+        import anthropic
+        return anthropic.Anthropic(
+            api_key=api_key,
+            base_url=os.environ.get('ANTHROPIC_BASE_URL') or None,
+            max_retries=CLAUDE_MAX_RETRIES
+        )
+    except Exception as e:
+        print(f"    [CLAUDE] Грешка при създаване на клиент: {str(e)[:50]}")
+        return None
+
+
+def build_phase1_prompt(page_text, store_name):
+    """Създава prompt-а за Фаза 1 (текстът се ограничава до 14000 символа)."""
+    
+    # Ограничаваме текста
+    if len(page_text) > 14000:
+        page_text = page_text[:14000]
+    
+    return f"""Анализирай текста от българския онлайн магазин "{store_name}" и извлечи САМО ХРАНИТЕЛНИТЕ продукти на марката Harmonica (Хармоника) с техните цени.
+
+ТЕКСТ ОТ СТРАНИЦАТА:
+{page_text}
+
+ИЗВЛИЧАЙ САМО ХРАНИ:
+- Млечни продукти (айран, кисело мляко, сирене, крема сирене)
+- Сладкарски изделия (локум, бисквити, вафли, топчета)
+- Напитки (лимонада, сиропи)
+- Консерви (пасирани домати, passata)
+- Снаксове (претцели, smiles, чипс)
+
+НЕ ИЗВЛИЧАЙ: дрехи, аксесоари, козметика, нехранителни продукти.
+
+ИНСТРУКЦИИ:
+1. Намери ХРАНИТЕЛНИ продукти на Harmonica/Хармоника
+2. Извлечи ТОЧНОТО име + цена и нейната валута: "BGN" за лв, "EUR" за € (при двойно показване - цената в лева)
+3. Включи грамажа/обема
+
+КРИТИЧНО - ФОРМАТ НА ОТГОВОРА:
+- Върни САМО JSON масив
+- БЕЗ ```json``` маркери
+- БЕЗ обяснения преди или след JSON
+- БЕЗ коментари
+- Само чист JSON!
+
+Пример за правилен отговор:
+[{{"name": "Био Айран 500мл", "price": 2.99, "currency": "BGN"}}, {{"name": "Вафла класик 40г", "price": 1.12, "currency": "EUR"}}]
+
+Ако няма продукти: []"""
+
+
+def normalize_phase1_product(p):
+    """
+    Валидира един продукт от отговора на Фаза 1.
+    
+    Валутата идва от полето "currency" или от означението в самата цена
+    ("1.53 €"); None ако отговорът не я посочва.
+    
+    Returns:
+        {"name": str, "price": float, "currency": str|None}
+        или None ако продуктът е невалиден
+    """
+    if not (isinstance(p, dict) and 'name' in p and 'price' in p):
+        return None
+    try:
+        # Обработваме цената - може да е число или string
+        # (напр. "4.28 лв." -> 4.28, "4" -> 4.0)
+        token = parse_price_token(p['price'])
+        if token is None:
+            return None
+        
+        price = token.value
+        currency = parse_currency_code(p.get('currency')) or token.currency
+        if 0.5 < price_in_bgn(price, currency) < 200:
+            return {"name": str(p['name']), "price": price, "currency": currency}
+    except:
+        pass
+    return None
+
+
+def parse_phase1_response(response_text):
+    """
+    Парсва пълния отговор на Фаза 1 до списък със сурови продукти.
+    При невалиден JSON опитва поправка, а накрая - regex екстракция.
+    """
+    # Почистване
+    cleaned = response_text
+    if "```" in cleaned:
+        cleaned = re.sub(r'```(?:json)?\s*', '', cleaned)
+        cleaned = re.sub(r'\s*```', '', cleaned)
+    
+    # Търсим JSON масив
+    array_match = re.search(r'\[[\s\S]*\]', cleaned)
+    if array_match:
+        cleaned = array_match.group(0)
+    
+    # Поправяме често срещани JSON грешки
+    # 1. Trailing commas преди ] или }
+    cleaned = re.sub(r',\s*]', ']', cleaned)
+    cleaned = re.sub(r',\s*}', '}', cleaned)
+    # 2. Single quotes вместо double quotes
+    # (по-сложно, правим го само ако има грешка)
+    
+    try:
+        return json.loads(cleaned)
+    except json.JSONDecodeError as e:
+        print(f"    [ФАЗА 1] JSON грешка, опитваме поправка: {str(e)[:50]}")
+    
+    # Опитваме да поправим single quotes
+    try:
+        # Заменяме single quotes с double quotes (внимателно)
+        fixed = re.sub(r"'([^']*)':", r'"\1":', cleaned)
+        fixed = re.sub(r":\s*'([^']*)'", r': "\1"', fixed)
+        return json.loads(fixed)
+    except:
+        pass
+    
+    # Последен опит - извличаме продукти с regex
+    print(f"    [ФАЗА 1] Използваме regex екстракция")
+    products = []
+    # Pattern 1: "price": число (без кавички)
+    pattern1 = r'"name"\s*:\s*"([^"]+)"\s*,\s*"price"\s*:\s*(\d+\.?\d*)(?:\s*,\s*"currency"\s*:\s*"([^"]*)")?'
+    matches = re.findall(pattern1, cleaned)
+    for name, price, currency in matches:
+        try:
+            products.append({"name": name, "price": float(price), "currency": currency or None})
+        except:
+            pass
+    
+    # Pattern 2: "price": "X.XX лв." (string с валутен символ)
+    if not products:
+        pattern2 = r'"name"\s*:\s*"([^"]+)"\s*,\s*"price"\s*:\s*"(\d+[.,]?\d*)\s*(лв\.?|BGN|EUR|€)?"'
+        matches = re.findall(pattern2, cleaned)
+        for name, price, currency in matches:
+            price = parse_price_value(price)
+            if price is not None:
+                products.append({"name": name, "price": price, "currency": parse_currency_code(currency)})
+    
+    return products
+
+
+def phase1_extract_all_products(client, page_text, store_name):
+    """
+    ФАЗА 1: Груба екстракция
+    Намира ВСИЧКИ ХРАНИТЕЛНИ продукти на Harmonica от текста.
+    Връща списък с продукти точно както са изписани в сайта.
+    """
+    prompt = build_phase1_prompt(page_text, store_name)
+
+    try:
         message = client.messages.create(
             model=CLAUDE_MODEL_PHASE1,
             max_tokens=4000,  # Увеличено от 2000 за магазини с много продукти (eBag: 57, Кашон: 64)
@@ -1012,89 +2819,14 @@ def phase1_extract_all_products(client, page_text, store_name):
         response_text = message.content[0].text.strip()
         print(f"    [ФАЗА 1] Отговор: {response_text[:200]}...")
         
-        # Почистване
-        cleaned = response_text
-        if "```" in cleaned:
-            cleaned = re.sub(r'```(?:json)?\s*', '', cleaned)
-            cleaned = re.sub(r'\s*```', '', cleaned)
-        
-        # Търсим JSON масив
-        array_match = re.search(r'\[[\s\S]*\]', cleaned)
-        if array_match:
-            cleaned = array_match.group(0)
-        
-        # Поправяме често срещани JSON грешки
-        # 1. Trailing commas преди ] или }
-        cleaned = re.sub(r',\s*]', ']', cleaned)
-        cleaned = re.sub(r',\s*}', '}', cleaned)
-        # 2. Single quotes вместо double quotes
-        # (по-сложно, правим го само ако има грешка)
-        
-        try:
-            products = json.loads(cleaned)
-        except json.JSONDecodeError as e:
-            print(f"    [ФАЗА 1] JSON грешка, опитваме поправка: {str(e)[:50]}")
-            # Опитваме да поправим single quotes
-            try:
-                # Заменяме single quotes с double quotes (внимателно)
-                fixed = re.sub(r"'([^']*)':", r'"\1":', cleaned)
-                fixed = re.sub(r":\s*'([^']*)'", r': "\1"', fixed)
-                products = json.loads(fixed)
-            except:
-                # Последен опит - извличаме продукти с regex
-                print(f"    [ФАЗА 1] Използваме regex екстракция")
-                products = []
-                # Pattern 1: "price": число (без кавички)
-                pattern1 = r'"name"\s*:\s*"([^"]+)"\s*,\s*"price"\s*:\s*(\d+\.?\d*)'
-                matches = re.findall(pattern1, cleaned)
-                for name, price in matches:
-                    try:
-                        products.append({"name": name, "price": float(price)})
-                    except:
-                        pass
-                
-                # Pattern 2: "price": "X.XX лв." (string с валутен символ)
-                if not products:
-                    pattern2 = r'"name"\s*:\s*"([^"]+)"\s*,\s*"price"\s*:\s*"(\d+[.,]?\d*)\s*(?:лв\.?|BGN|EUR|€)?"'
-                    matches = re.findall(pattern2, cleaned)
-                    for name, price in matches:
-                        try:
-                            price_clean = price.replace(',', '.')
-                            products.append({"name": name, "price": float(price_clean)})
-                        except:
-                            pass
+        products = parse_phase1_response(response_text)
         
         # Валидираме структурата
         valid_products = []
         for p in products:
-            if isinstance(p, dict) and 'name' in p and 'price' in p:
-                try:
-                    # Обработваме цената - може да е число или string
-                    price_raw = p['price']
-                    if isinstance(price_raw, str):
-                        # Извличаме числото от string-а (напр. "4.28 лв." -> 4.28)
-                        # Търсим десетично число или цяло число
-                        price_match = re.search(r'(\d+)[.,](\d+)', price_raw)
-                        if price_match:
-                            # Десетично число: "4.28" или "4,28"
-                            price = float(f"{price_match.group(1)}.{price_match.group(2)}")
-                        else:
-                            # Цяло число: "4"
-                            int_match = re.search(r'(\d+)', price_raw)
-                            if int_match:
-                                price = float(int_match.group(1))
-                            else:
-                                continue
-                    else:
-                        price = float(price_raw)
-                    
-                    if 0.5 < price < 200:
-                        valid_products.append({
-                            "name": str(p['name']),
-                            "price": price
-                        })
-                except:
-                    pass
+            product = normalize_phase1_product(p)
+            if product:
+                valid_products.append(product)
         
         print(f"    [ФАЗА 1] Намерени: {len(valid_products)} продукта")
         return valid_products
@@ -1104,79 +2836,324 @@ def phase1_extract_all_products(client, page_text, store_name):
         return []
 
 
-def phase2_match_products(client, extracted_products, store_name):
+class StreamingProductParser:
+    """
+    Инкрементален парсер на JSON масив от продукти.
+    
+    Получава отговора на части (както идват от stream-а) и връща всеки
+    {...} обект веднага щом е затворен. Следи низовете и escape символите,
+    за да не се подведе от скоби в имената. done става True при
+    затварящата ] на масива.
+    """
+    
+    def __init__(self):
+        self.buffer = []
+        self.started = False
+        self.done = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.current = []
+    
+    def feed(self, chunk):
+        """Добавя част от отговора и връща списък със завършените обекти."""
+        completed = []
+        self.buffer.append(chunk)
+        for char in chunk:
+            if self.done:
+                break
+            if not self.started:
+                if char == '[':
+                    self.started = True
+                continue
+            
+            if self.depth > 0:
+                self.current.append(char)
+            
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+            
+            if char == '"':
+                self.in_string = self.depth > 0
+            elif char == '{':
+                if self.depth == 0:
+                    self.current = ['{']
+                self.depth += 1
+            elif char == '}' and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    obj = self._parse_object("".join(self.current))
+                    if obj is not None:
+                        completed.append(obj)
+                    self.current = []
+            elif char == ']' and self.depth == 0:
+                self.done = True
+        return completed
+    
+    def text(self):
+        """Целият получен досега текст."""
+        return "".join(self.buffer)
+    
+    @staticmethod
+    def _parse_object(text):
+        """Парсва един обект с поправка на trailing commas и single quotes."""
+        text = re.sub(r',\s*}', '}', text)
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            pass
+        try:
+            fixed = re.sub(r"'([^']*)':", r'"\1":', text)
+            fixed = re.sub(r":\s*'([^']*)'", r': "\1"', fixed)
+            return json.loads(fixed)
+        except:
+            return None
+
+
+def phase1_extract_all_products_streaming(client, page_text, store_name, on_product=None):
+    """
+    ФАЗА 1 в streaming режим.
+    
+    Парсва продуктите от потока токени още докато Haiku генерира и
+    подава всеки валиден продукт на on_product веднага. Генерирането се
+    прекъсва при затварянето на JSON масива. При прекъснат или отрязан
+    отговор се запазват вече парснатите продукти; regex спасяването
+    се ползва само ако stream-ът не е дал нито един продукт.
+    """
+    prompt = build_phase1_prompt(page_text, store_name)
+    parser = StreamingProductParser()
+    valid_products = []
+    started_at = time.time()
+    first_product_at = None
+    
+    def accept(raw):
+        nonlocal first_product_at
+        product = normalize_phase1_product(raw)
+        if not product:
+            return
+        if first_product_at is None:
+            first_product_at = time.time() - started_at
+        valid_products.append(product)
+        if on_product:
+            on_product(product)
+    
+    try:
+        with client.messages.stream(
+            model=CLAUDE_MODEL_PHASE1,
+            max_tokens=4000,
+            messages=[{"role": "user", "content": prompt}]
+        ) as stream:
+            for chunk in stream.text_stream:
+                for raw in parser.feed(chunk):
+                    accept(raw)
+                if parser.done:
+                    # Масивът е затворен - не чакаме останалия текст
+                    break
+    except Exception as e:
+        print(f"    [ФАЗА 1] Stream прекъснат: {str(e)[:80]}")
+    
+    response_text = parser.text().strip()
+    print(f"    [ФАЗА 1] Отговор: {response_text[:200]}...")
+    
+    if not valid_products and response_text:
+        for raw in parse_phase1_response(response_text):
+            accept(raw)
+    
+    if first_product_at is not None:
+        print(f"    [ФАЗА 1] Първи продукт след {first_product_at:.1f}s, общо {time.time() - started_at:.1f}s")
+    print(f"    [ФАЗА 1] Намерени: {len(valid_products)} продукта" + ("" if parser.done else " (непълен отговор)"))
+    return valid_products
+
+
+def validate_matched_price(product, price, store_name, currency=None):
+    """
+    Проверява дали съпоставената цена е в допустимия диапазон спрямо референцията.
+    Използва толеранс от конфигурацията на магазина ако има.
+    EUR цените се сравняват по BGN равностойността си.
+    """
+    ref_price = product.ref_price_bgn
+    store_config = STORES.get(store_name, {})
+    tolerance = store_config.get('price_tolerance', 0.50)  # По подразбиране 50%
+    min_valid = (1 - tolerance) * ref_price
+    max_valid = (1 + tolerance) * ref_price
+    if min_valid <= price_in_bgn(price, currency) <= max_valid:
+        return True
+    print(f"    [ФАЗА 2] Отхвърлена: #{product.id} цена {format_price_label(f'{price:.2f}', currency)} (валидно: {min_valid:.2f}-{max_valid:.2f} лв)")
+    return False
+
+
+def phase2_prefilter(extracted_products, prefiltered=None, currencies=None):
+    """
+    Локален етап на Фаза 2 - разделя извлечените продукти на:
+    - accepted: {product_id: price} - еднозначни съвпадения, приети без LLM
+    - ambiguous: [(extracted, shortlist)] - изпращат се на Claude с кандидатите
+    - skipped: брой продукти, които не приличат на нито един наш продукт
+    
+    prefiltered: готови решения [(extracted, (decision, candidates))],
+    изчислени по време на streaming във Фаза 1
+    currencies: ако е подаден dict, в него се записва валутата на всяка
+    приета цена ({product_id: "BGN"/"EUR"/None})
+    """
+    if prefiltered is None:
+        prefiltered = [(p, prefilter_extracted_product(p)) for p in extracted_products]
+    
+    accepted = {}
+    accepted_scores = {}
+    ambiguous = []
+    skipped = 0
+    
+    for extracted, (decision, candidates) in prefiltered:
+        if decision == "accept":
+            product_id, score, _ = candidates[0]
+            # При дублиране пазим по-сигурното съвпадение
+            if score > accepted_scores.get(product_id, -1):
+                accepted[product_id] = extracted['price']
+                accepted_scores[product_id] = score
+                if currencies is not None:
+                    currencies[product_id] = extracted.get('currency')
+        elif decision == "ambiguous":
+            ambiguous.append((extracted, candidates))
+        else:
+            skipped += 1
+    
+    # Кандидати, които вече са приети локално, не се предлагат повторно
+    pruned = []
+    for extracted, shortlist in ambiguous:
+        shortlist = [c for c in shortlist if c[0] not in accepted]
+        if shortlist:
+            pruned.append((extracted, shortlist))
+    ambiguous = pruned
+    
+    return accepted, ambiguous, skipped
+
+
+def _ambiguous_match_currency(ambiguous, product_id, price):
+    """
+    Валутата на цена, съпоставена от Claude: взима се от извлечения продукт
+    с тази цена, сред чиито кандидати е product_id.
+    """
+    offered = [extracted for extracted, shortlist in ambiguous if any(c[0] == product_id for c in shortlist)]
+    for extracted in offered:
+        if abs(extracted['price'] - price) < 0.005:
+            return extracted.get('currency')
+    currencies = {extracted.get('currency') for extracted in offered}
+    return currencies.pop() if len(currencies) == 1 else None
+
+
+def phase2_match_products(client, extracted_products, store_name, prefiltered=None, currencies=None, product_names=None):
     """
     ФАЗА 2: Интелигентно съпоставяне
     Съпоставя намерените продукти от Фаза 1 с нашия списък.
     Използва номера на продуктите за еднозначна идентификация.
     ВАЖНО: НЕ показваме референтните цени на Claude, за да избегнем халюцинации!
-    Актуализирано за 24 продукта (v7.1).
+    
+    Локалният pre-filter приема еднозначните съвпадения без LLM.
+    На Claude се изпращат само неясните продукти, всеки със собствен
+    списък от кандидати - размерът на prompt-а не зависи от каталога.
+    
+    currencies: ако е подаден dict, в него се записва валутата
+    на всяка съпоставена цена ({име: "BGN"/"EUR"/None})
+    product_names: ако е подаден, съпоставят се само тези продукти -
+    останалите кандидати не се изпращат на Claude (частично стартиране)
     """
     
     if not extracted_products:
         print(f"    [ФАЗА 2] Няма продукти за съпоставяне")
         return {}
     
-    # Подготвяме списъка с нашите продукти - БЕЗ РЕФЕРЕНТНИ ЦЕНИ!
-    our_products_text = "\n".join([
-        f"{p['id']}. {p['name']} ({p['weight']})"
-        for p in PRODUCTS
-    ])
+    catalog = get_catalog()
+    accepted_currencies = {}
+    accepted, ambiguous, skipped = phase2_prefilter(extracted_products, prefiltered, accepted_currencies)
+    if product_names is not None:
+        accepted = {pid: price for pid, price in accepted.items() if catalog.name_of(pid) in product_names}
+        selected = []
+        for extracted, shortlist in ambiguous:
+            shortlist = [c for c in shortlist if catalog.name_of(c[0]) in product_names]
+            if shortlist:
+                selected.append((extracted, shortlist))
+        ambiguous = selected
+    print(f"    [ФАЗА 2] Локално: {len(accepted)} приети, {len(ambiguous)} {'за Claude' if client else 'неясни (пропуснати)'}, {skipped} пропуснати")
+    
+    matches = {}
+    if ambiguous and client:
+        try:
+            matches = phase2_match_ambiguous_with_claude(client, ambiguous, store_name)
+        except Exception as e:
+            # Локалните съвпадения остават валидни и при грешка в API-то
+            print(f"    [ФАЗА 2] Claude грешка: {str(e)[:80]}")
+    
+    # Обединяваме: локалните съвпадения са с предимство
+    combined = dict(matches)
+    combined.update(accepted)
+    
+    result = {}
+    for product_id, price in combined.items():
+        record = catalog.get(product_id)
+        if product_id in accepted:
+            currency = accepted_currencies.get(product_id)
+        else:
+            currency = _ambiguous_match_currency(ambiguous, product_id, price)
+        if record and validate_matched_price(record, price, store_name, currency):
+            result[record.name] = price
+            if currencies is not None:
+                currencies[record.name] = currency
+    
+    print(f"    [ФАЗА 2] Съпоставени: {len(result)} продукта")
+    return result
+
+
+def phase2_match_ambiguous_with_claude(client, ambiguous, store_name):
+    """
+    Изпраща на Claude само неясните продукти с техните кандидати.
     
-    # Подготвяме списъка с намерените продукти
-    found_products_text = "\n".join([
-        f"- \"{p['name']}\" → {p['price']:.2f} лв"
-        for p in extracted_products
-    ])
+    Args:
+        ambiguous: [(extracted, shortlist)] от phase2_prefilter
     
-    prompt = f"""Съпостави продуктите от магазин "{store_name}" с нашия списък от 27 продукта.
-
-НАШИЯТ СПИСЪК:
-{our_products_text}
+    Returns:
+        dict {product_id: price}
+    """
+    catalog = get_catalog()
+    allowed_ids = set()
+    found_lines = []
+    
+    for i, (extracted, shortlist) in enumerate(ambiguous, 1):
+        price_label = format_price_label(f"{extracted['price']:.2f}", extracted.get('currency'))
+        found_lines.append(f"{i}. \"{extracted['name']}\" → {price_label}")
+        for product_id, _, _ in shortlist:
+            record = catalog.by_id[product_id]
+            aliases = record.aliases
+            alias_text = f" (известен и като: {', '.join(aliases[:3])})" if aliases else ""
+            found_lines.append(f"   #{product_id} {record.name} ({record.weight}){alias_text}")
+            allowed_ids.add(product_id)
+    
+    found_products_text = "\n".join(found_lines)
+    
+    prompt = f"""Съпостави продуктите от магазин "{store_name}" с нашия списък.
+Под всеки продукт от сайта са изброени кандидатите от нашия списък (#номер).
 
-ПРОДУКТИ ОТ САЙТА:
+ПРОДУКТИ ОТ САЙТА И КАНДИДАТИ:
 {found_products_text}
 
 ПРАВИЛА:
 1. ГРАМАЖЪТ Е ЗАДЪЛЖИТЕЛЕН - "750мл" ≠ "500мл", "40г" ≠ "30г"
-2. ВНИМАВАЙ ЗА ПОДОБНИ: "3.6%" ≠ "2%", "Илиеви" ≠ "Хаджиеви"
-3. ИЗПОЛЗВАЙ САМО цени от списъка "ПРОДУКТИ ОТ САЙТА"
-4. Ако не си 100% сигурен - ПРОПУСНИ
-
-АЛТЕРНАТИВНИ ИМЕНА (разпознай ги като същите продукти):
-- #8 "Локум натурален" = "Био Локум натурален" (140г)
-- #15 "Локум роза" = "Локум със сироп от роза" (140г)
-- #18 "Сироп от плод на бъз" = "Био сироп от бъз" (750мл)
-- #21 "Обикновени бисквити с масло и какао" = "Био бисквити с масло и какао" (150г)
-- #22 "Солети пълнозърнести" = "Био пълнозърнести солети" (60г)
-- #23 "По-кисело кисело мляко" = "Био кисело пълномаслено мляко" (400г)
-- #12 "Сирене краве" = "Био краве сирене" (400г)
-- #7 "Тахан сусамов" = "Био пълнозърнест сусамов тахан" (700г)
-- #25 "Слънчогледово олио за готвене" = "Био студено пресовано слънчогледово масло" (500мл)
-
-ВНИМАНИЕ - НЕ БЪРКАЙ ТЕЗИ ПРОДУКТИ:
-- #24 "Био извара" (500г, ~3.69лв) ≠ #10 "Био крема сирене" (125г, ~5.69лв)
-- Извара е 500г, крема сирене е 125г - ГРАМАЖЪТ е ключов!
-
-ПРИМЕРИ ЗА СЪВПАДЕНИЯ (v8.6 номерация):
-#1=вафла+лимонов крем+30г, #2=вафла+без захар+30г, #3=козе сирене+200г
-#4=лютеница+Илиеви+260г, #5=кисело мляко+3.6%+400г, #6=лютеница+Хаджиеви+260г
-#7=тахан+сусамов+700г, #8=локум+натурален+140г, #9=кашкавал+краве+300г
-#10=крема сирене+125г, #11=вафла+лимец+кокос+30г, #12=краве сирене+400г
-#13=кори баница+400г, #14=фъстъчено масло+250г, #15=локум+роза+140г
-#16=слънчогледово масло+500мл, #17=Chocobiotic+40г, #18=сироп бъз+750мл
-#19=прясно мляко+1л, #20=солети лимец+50г, #21=бисквити+масло+какао+150г
-#22=пълнозърнести солети+60г, #23=пълномаслено мляко+400г, #24=извара+500г
-#25=студено пресовано масло+500мл, #26=кисело мляко+2%+400г, #27=кефир+500мл
+2. ВНИМАВАЙ ЗА ПОДОБНИ: "3.6%" ≠ "2%", "Илиеви" ≠ "Хаджиеви", извара ≠ крема сирене
+3. ИЗПОЛЗВАЙ САМО цени от списъка по-горе
+4. Избирай САМО измежду кандидатите на съответния продукт
+5. Ако не си 100% сигурен - ПРОПУСНИ
 
 КРИТИЧНО - ФОРМАТ НА ОТГОВОРА:
-- Върни САМО JSON обект
+- Върни САМО JSON обект {{"номер на наш продукт": цена}}
 - БЕЗ ```json``` маркери
 - БЕЗ обяснения преди или след JSON
-- БЕЗ коментари или текст
 - Само чист JSON!
 
-Пример за правилен отговор: {{"3": 10.99, "5": 2.79, "10": 5.69}}
+Пример за правилен отговор: {{"3": 10.99, "5": 2.79}}
 Ако няма съвпадения: {{}}"""
 
     # Опитваме първо с предпочитания модел (Sonnet), с fallback към Haiku ако не е наличен
@@ -1217,45 +3194,25 @@ def phase2_match_products(client, extracted_products, store_name):
         
         matches = json.loads(cleaned)
         
-        # Конвертираме номера към имена на продукти
         result = {}
         for product_id_str, price in matches.items():
             try:
                 product_id = int(product_id_str)
                 
-                # Почистваме цената ако е текст (напр. "1.49 лв." или "1,49")
-                if isinstance(price, str):
-                    # Извличаме само числото от текста
-                    price_match = re.search(r'(\d+)[.,](\d{1,2})', price)
-                    if price_match:
-                        price = float(f"{price_match.group(1)}.{price_match.group(2)}")
-                    else:
-                        # Опитваме да намерим цяло число
-                        int_match = re.search(r'(\d+)', price)
-                        if int_match:
-                            price = float(int_match.group(1))
-                        else:
-                            continue
-                else:
-                    price = float(price)
+                # Приемаме само номера от предложените кандидати
+                if product_id not in allowed_ids:
+                    print(f"    [ФАЗА 2] Игнориран #{product_id} - не е сред кандидатите")
+                    continue
                 
-                # Намираме продукта по ID
-                product = next((p for p in PRODUCTS if p['id'] == product_id), None)
-                if product:
-                    # Валидираме цената - използваме толеранс от store config ако има
-                    ref_price = product['ref_price_bgn']
-                    store_config = STORES.get(store_name, {})
-                    tolerance = store_config.get('price_tolerance', 0.50)  # По подразбиране 50%
-                    min_valid = (1 - tolerance) * ref_price
-                    max_valid = (1 + tolerance) * ref_price
-                    if min_valid <= price <= max_valid:
-                        result[product['name']] = price
-                    else:
-                        print(f"    [ФАЗА 2] Отхвърлена: #{product_id} цена {price:.2f} (валидно: {min_valid:.2f}-{max_valid:.2f})")
+                # Цената може да е текст (напр. "1.49 лв." или "1,49")
+                price = parse_price_value(price)
+                if price is None:
+                    continue
+                
+                result[product_id] = price
             except (ValueError, TypeError):
                 continue
         
-        print(f"    [ФАЗА 2] Съпоставени: {len(result)} продукта")
         return result
         
     except Exception as e:
@@ -1263,11 +3220,14 @@ def phase2_match_products(client, extracted_products, store_name):
         return {}
 
 
-def extract_prices_with_claude_two_phase(page_text, store_name):
+def extract_prices_with_claude_two_phase(page_text, store_name, currencies=None, product_names=None):
     """
     Главна функция за двуфазно извличане на цени с Claude.
     Фаза 1: Груба екстракция на всички Harmonica продукти
     Фаза 2: Интелигентно съпоставяне с нашия списък
+    
+    currencies: ако е подаден dict, в него се записва валутата на всяка цена
+    product_names: ако е подаден, Фаза 2 съпоставя само тези продукти
     """
     if not CLAUDE_AVAILABLE:
         return {}
@@ -1276,27 +3236,58 @@ def extract_prices_with_claude_two_phase(page_text, store_name):
     if not client:
         return {}
     
-    print(f"    [CLAUDE] Стартиране на двуфазен анализ...")
+    engine = get_phase2_engine()
+    print(f"    [CLAUDE] Стартиране на двуфазен анализ (Фаза 2: {engine})...")
     
     # Фаза 1: Груба екстракция
-    extracted = phase1_extract_all_products(client, page_text, store_name)
+    prefiltered = None
+    if PHASE1_STREAMING:
+        # Всеки продукт минава през локалното съпоставяне веднага щом е парснат,
+        # докато Haiku генерира останалите
+        prefiltered = []
+        if engine == "llm":
+            match_product = prefilter_extracted_product
+        else:
+            matcher = get_ngram_matcher()
+            match_product = lambda product: matcher.match([product])[0][1]
+        match_time = 0.0
+        
+        def on_product(product):
+            nonlocal match_time
+            started_at = time.time()
+            prefiltered.append((product, match_product(product)))
+            match_time += time.time() - started_at
+        
+        extracted = phase1_extract_all_products_streaming(client, page_text, store_name, on_product=on_product)
+        if extracted and engine != "llm":
+            print(f"    [ФАЗА 2] n-gram съпоставяне по време на stream: {len(extracted)} продукта за {match_time * 1000:.1f}ms")
+    else:
+        extracted = phase1_extract_all_products(client, page_text, store_name)
+        if extracted and engine != "llm":
+            started_at = time.time()
+            prefiltered = get_ngram_matcher().match(extracted)
+            print(f"    [ФАЗА 2] n-gram съпоставяне: {len(extracted)} продукта за {(time.time() - started_at) * 1000:.1f}ms")
     
     if not extracted:
         return {}
     
     # Фаза 2: Съпоставяне с retry логика
-    matched = phase2_match_products(client, extracted, store_name)
+    # При "ngram" Claude не участва - неясните продукти се пропускат
+    phase2_client = None if engine == "ngram" else client
+    matched = phase2_match_products(phase2_client, extracted, store_name, prefiltered=prefiltered,
+                                    currencies=currencies, product_names=product_names)
     
     # Retry: Ако Sonnet върна празен резултат и имаме поне 5 извлечени продукта,
     # опитваме отново с Haiku като fallback
-    if len(matched) == 0 and len(extracted) >= 5:
+    if len(matched) == 0 and len(extracted) >= 5 and phase2_client:
         print(f"    [ФАЗА 2] Retry: Sonnet върна 0 резултата, опитваме с Haiku...")
         # Временно сменяме модела на Haiku
         original_model = globals().get('CLAUDE_MODEL_PHASE2')
         try:
             # Използваме директно Haiku за retry
             globals()['CLAUDE_MODEL_PHASE2'] = CLAUDE_MODEL_PHASE1
-            matched = phase2_match_products(client, extracted, store_name)
+            matched = phase2_match_products(client, extracted, store_name, prefiltered=prefiltered,
+                                            currencies=currencies, product_names=product_names)
             if len(matched) > 0:
                 print(f"    [ФАЗА 2] Retry успешен: {len(matched)} продукта с Haiku")
         finally:
@@ -1314,133 +3305,262 @@ def fuzzy_match(text, pattern, threshold=0.7):
     """
     Прост fuzzy matching - връща True ако pattern се съдържа в text
     с позволени дребни разлики (транслитерация, малки/големи букви).
+    Текстът се нормализира веднъж и се кешира между извикванията.
     """
-    text = text.lower()
-    pattern = pattern.lower()
+    return normalize_text(text).contains(pattern)
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick автомат за всички ключови думи от FALLBACK_KEYWORDS.
     
-    # Директно съвпадение
-    if pattern in text:
-        return True
+    Всяка ключова дума се добавя в кирилска и в транслитерирана форма,
+    и двете водят към една и съща ключова дума. find_all() намира всички
+    срещания с едно минаване по текста - времето зависи от дължината
+    на страницата, а не от броя продукти и ключови думи.
+    """
     
-    # Транслитерация вариации
-    transliterations = {
-        'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e',
-        'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l',
-        'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's',
-        'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch',
-        'ш': 'sh', 'щ': 'sht', 'ъ': 'a', 'ь': '', 'ю': 'yu', 'я': 'ya'
-    }
+    def __init__(self, keywords=()):
+        self.goto = [{}]       # преходи: състояние -> {символ: състояние}
+        self.fail = [0]        # failure връзки
+        self.output = [[]]     # състояние -> индекси на завършени шаблони
+        self.patterns = []     # [(ключова дума, дължина на шаблона)]
+        self.fingerprint = self.compute_fingerprint(keywords)
+        for keyword in keywords:
+            variants = set(normalize_pattern(keyword))
+            for pattern in variants:
+                self._add(pattern, keyword)
+        self._build()
+    
+    @staticmethod
+    def compute_fingerprint(keywords):
+        """Hash на ключовите думи - кешираният автомат е валиден само при същия набор."""
+        joined = "\n".join(sorted(set(keywords)))
+        return hashlib.sha1(joined.encode('utf-8')).hexdigest()
+    
+    def _add(self, pattern, keyword):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = next_state
+        self.output[state].append(len(self.patterns))
+        self.patterns.append((keyword, len(pattern)))
+    
+    def _build(self):
+        """
+        Изчислява failure връзките (BFS по trie-то) и ги разгъва в пълна
+        таблица на преходите (DFA) - при търсене няма връщане по fail връзки.
+        """
+        queue = deque(self.goto[0].values())
+        order = []
+        while queue:
+            state = queue.popleft()
+            order.append(state)
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+        
+        # В BFS ред fail състоянието винаги е вече разгънато
+        for state in order:
+            inherited = self.goto[self.fail[state]]
+            for char, target in inherited.items():
+                self.goto[state].setdefault(char, target)
+    
+    def find_all(self, text):
+        """
+        Намира всички срещания на ключовите думи в текста.
+        
+        Returns:
+            dict {ключова дума: [начални позиции във възходящ ред]}
+        """
+        goto = self.goto
+        output = self.output
+        patterns = self.patterns
+        occurrences = {}
+        state = 0
+        for i, char in enumerate(text):
+            state = goto[state].get(char, 0)
+            if output[state]:
+                for pattern_index in output[state]:
+                    keyword, length = patterns[pattern_index]
+                    occurrences.setdefault(keyword, []).append(i - length + 1)
+        return occurrences
+    
+    def to_dict(self):
+        return {
+            "fingerprint": self.fingerprint,
+            "goto": self.goto,
+            "fail": self.fail,
+            "output": self.output,
+            "patterns": self.patterns,
+        }
+    
+    @classmethod
+    def from_dict(cls, data):
+        automaton = cls.__new__(cls)
+        automaton.fingerprint = data['fingerprint']
+        automaton.goto = data['goto']
+        automaton.fail = data['fail']
+        automaton.output = data['output']
+        automaton.patterns = [tuple(p) for p in data['patterns']]
+        return automaton
+
+
+_KEYWORD_AUTOMATON = None
+
+
+def get_keyword_automaton():
+    """
+    Връща автомата за fallback търсенето.
+    Зарежда го от кеша на диска, ако е построен за същите ключови думи;
+    иначе го построява и записва за следващото стартиране.
+    """
+    global _KEYWORD_AUTOMATON
+    if _KEYWORD_AUTOMATON is not None:
+        return _KEYWORD_AUTOMATON
     
-    # Конвертираме pattern към латиница
-    pattern_latin = ''
-    for char in pattern:
-        pattern_latin += transliterations.get(char, char)
+    keywords = sorted({kw for tuples in FALLBACK_KEYWORDS.values() for group in tuples for kw in group})
+    fingerprint = KeywordAutomaton.compute_fingerprint(keywords)
+    cache_path = os.path.join(CACHE_DIR, 'keyword_automaton.json')
     
-    if pattern_latin in text:
-        return True
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('fingerprint') == fingerprint:
+            _KEYWORD_AUTOMATON = KeywordAutomaton.from_dict(data)
+            return _KEYWORD_AUTOMATON
+    except (OSError, ValueError, KeyError):
+        pass
     
-    return False
+    _KEYWORD_AUTOMATON = KeywordAutomaton(keywords)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(_KEYWORD_AUTOMATON.to_dict(), f, ensure_ascii=False)
+    except OSError as e:
+        print(f"    [FALLBACK] Автоматът не е записан в кеша: {str(e)[:50]}")
+    return _KEYWORD_AUTOMATON
+
+
+# Контекст около ключова дума, в който се търси цената (символи преди/след)
+FALLBACK_CONTEXT_BEFORE = 100
+FALLBACK_CONTEXT_AFTER = 200
+
+class PriceIndex:
+    """
+    Всички цени в текста на страницата, подредени по позиция.
+    
+    Текстът се сканира веднъж със scan_prices; цените около дадена позиция
+    се намират с bisect вместо с нов regex върху всеки контекстен прозорец.
+    Зачеркнатите стари цени и EUR половината на двойно показване не се
+    индексират - референтните цени са в BGN. Всяка цена пази собствената
+    си валута (None ако няма означение).
+    """
+    
+    __slots__ = ('starts', 'ends', 'values', 'currencies')
+    
+    def __init__(self, text):
+        self.starts = []
+        self.ends = []
+        self.values = []
+        self.currencies = []
+        for token in scan_prices(text):
+            if token.role == "old" or (token.twin and token.twin.currency == "BGN"):
+                continue
+            self.starts.append(token.start)
+            self.ends.append(token.end)
+            self.values.append(token.value)
+            self.currencies.append(token.currency)
+    
+    def in_window(self, start, end):
+        """Цените (стойност, валута), които са изцяло в [start, end)."""
+        lo = bisect.bisect_left(self.starts, start)
+        hi = bisect.bisect_left(self.starts, end)
+        return [(self.values[i], self.currencies[i]) for i in range(lo, hi) if self.ends[i] <= end]
 
 
-def extract_prices_with_fallback(page_text):
+def _has_occurrence_near(positions, idx):
+    """Има ли срещане в контекстния прозорец около idx (positions е сортиран)."""
+    i = bisect.bisect_left(positions, idx - FALLBACK_CONTEXT_BEFORE)
+    return i < len(positions) and positions[i] < idx + FALLBACK_CONTEXT_AFTER
+
+
+def extract_prices_with_fallback(page_text, currencies=None, product_names=None):
     """
     Резервен метод с ключови думи и fuzzy matching.
     Използва се само ако Claude не намери нищо.
     По-стриктен - изисква съвпадение на грамаж.
     Актуализирано за 27 продукта (v8.8) с Zelen продуктите.
+    
+    Всички ключови думи (кирилица + транслитерация) се търсят с едно
+    минаване на Aho-Corasick автомата, а всички цени - с едно минаване
+    на regex-а. Проверява се всяко срещане на продукта, не само първото;
+    срещанията, около които са и останалите ключови думи, са с предимство.
+    
+    EUR цените се сравняват с референцията по BGN равностойността си;
+    ако е подаден currencies (dict), в него се записва валутата на всяка цена.
+    product_names ограничава търсенето до избраните продукти.
     """
     prices = {}
-    page_lower = page_text.lower()
-    
-    # Специфични ключови думи с грамаж за 27 продукта
-    # Включени са алтернативни имена от различни магазини
-    keywords_map = {
-        "Био вафла с лимонов крем": [("вафла", "лимон", "30"), ("вафла", "крем", "30")],
-        "Био вафла без добавена захар": [("вафла", "без", "захар", "30")],
-        "Био сирене козе": [("козе", "сирене", "200"), ("goat", "cheese", "200")],
-        "Био лютеница Илиеви": [("лютеница", "илиев", "260")],
-        "Био кисело мляко 3,6%": [("кисело", "мляко", "3.6", "400"), ("кисело", "мляко", "3,6", "400")],
-        "Био лютеница Хаджиеви": [("лютеница", "хаджиев", "260")],
-        "Био пълнозърнест сусамов тахан": [("тахан", "сусам", "700"), ("tahini", "700")],
-        # Zelen продукт #8 - Био локум натурален
-        "Био локум натурален": [("локум", "натурален", "140"), ("локум", "natural", "140")],
-        "Био кашкавал от краве мляко": [("кашкавал", "краве", "300")],
-        "Био крема сирене": [("крема", "сирене", "125"), ("cream", "cheese", "125")],
-        "Био вафла с лимец и кокос": [("вафла", "лимец", "кокос", "30")],
-        "Био краве сирене": [("краве", "сирене", "400"), ("сирене", "краве", "400")],
-        "Био пълнозърнести кори за баница": [("кори", "баница", "400")],
-        "Био фъстъчено масло": [("фъстъчено", "масло", "250"), ("peanut", "butter", "250")],
-        # Zelen продукт #15 - Био локум роза
-        "Био локум роза": [("локум", "роза", "140"), ("локум", "rose", "140")],
-        "Био слънчогледово масло": [("слънчогледово", "масло", "500"), ("слънчогледово", "олио", "500"), ("олио", "готвене", "500")],
-        "Био тунквана вафла Chocobiotic": [("chocobiotic", "40"), ("тунквана", "вафла", "40")],
-        # Сироп от бъз - Кашон го нарича "Сироп от плод на бъз"
-        "Био сироп от бъз": [("сироп", "бъз", "750"), ("сироп", "плод", "бъз", "750")],
-        "Био прясно мляко 3,6%": [("прясно", "мляко", "1л"), ("прясно", "мляко", "1l")],
-        "Био солети от лимец": [("солети", "лимец", "50")],
-        # Zelen продукт #21 - Био бисквити с масло и какао
-        "Био бисквити с масло и какао": [("бисквити", "масло", "какао", "150"), ("бисквити", "какао", "150"), ("обикновени", "бисквити", "150")],
-        # Пълнозърнести солети - Кашон го нарича "Солети пълнозърнести"
-        "Био пълнозърнести солети": [("пълнозърнести", "солети", "60"), ("солети", "пълнозърнести", "60")],
-        # Пълномаслено мляко - Кашон го нарича "По-кисело кисело мляко"
-        "Био кисело пълномаслено мляко": [("пълномаслено", "мляко", "400"), ("по-кисело", "мляко", "400"), ("по-кисело", "кисело", "400")],
-        # Извара - ВАЖНО: търсим "извара" БЕЗ "сирене" за да не се бърка с крема сирене
-        "Био извара": [("извара", "500"), ("извара", "harmonica")],
-        # Студено пресовано масло - различно от обикновеното слънчогледово
-        "Био студено пресовано слънчогледово масло": [("студено", "пресовано", "500"), ("студено", "пресовано", "слънчогледово")],
-        "Био кисело мляко 2%": [("кисело", "мляко", "2%", "400"), ("кисело", "мляко", "2.0", "400")],
-        "Био кефир": [("кефир", "500")],
-    }
-    
-    for product in PRODUCTS:
-        name = product['name']
-        ref_price = product['ref_price_bgn']
-        keywords_list = keywords_map.get(name, [])
+    normalized = normalize_text(page_text)
+    occurrences = get_keyword_automaton().find_all(normalized.lower)
+    price_index = PriceIndex(page_text)
+    
+    for record in get_catalog():
+        name = record.name
+        ref_price = record.ref_price_bgn
+        if product_names is not None and name not in product_names:
+            continue
         
-        for keywords in keywords_list:
-            # Проверяваме дали ВСИЧКИ ключови думи са в текста (с fuzzy matching)
-            all_found = all(
-                kw in page_lower or fuzzy_match(page_lower, kw) 
-                for kw in keywords
-            )
-            
-            if not all_found:
+        for keywords in record.fallback_keywords:
+            # Проверяваме дали ВСИЧКИ ключови думи са в текста (кирилица или латиница)
+            if not all(kw in occurrences for kw in keywords):
                 continue
             
-            # Намираме позицията на първата ключова дума
-            idx = page_lower.find(keywords[0])
-            if idx == -1:
-                # Опитваме с fuzzy
-                for i, char in enumerate(page_lower):
-                    if page_lower[i:i+len(keywords[0])] == keywords[0]:
-                        idx = i
-                        break
-                if idx == -1:
-                    continue
-            
-            # Извличаме контекст (по-голям за по-добро намиране на цена)
-            context = page_text[max(0, idx-100):idx+200]
+            # Срещанията на първата ключова дума, около които са и останалите
+            positions = occurrences[keywords[0]]
+            local = [
+                idx for idx in positions
+                if all(_has_occurrence_near(occurrences[kw], idx) for kw in keywords[1:])
+            ]
             
             # Търсим цена - избираме НАЙ-БЛИЗКАТА до референцията
-            price_matches = re.findall(r'(\d+)[,.](\d{2})', context)
             best_price = None
+            best_currency = None
             best_deviation = float('inf')
             
-            for m in price_matches:
-                try:
-                    price = float(f"{m[0]}.{m[1]}")
+            for idx in (local or positions):
+                # Позиция в оригиналния текст
+                idx = normalized.to_original(idx)
+                window = price_index.in_window(
+                    max(0, idx - FALLBACK_CONTEXT_BEFORE), idx + FALLBACK_CONTEXT_AFTER
+                )
+                for price, currency in window:
                     # Проверка: ±50% от референтната (стеснен диапазон)
-                    if 0.5 * ref_price <= price <= 1.5 * ref_price:
+                    compared = price_in_bgn(price, currency)
+                    if 0.5 * ref_price <= compared <= 1.5 * ref_price:
                         # Избираме цената с най-малко отклонение
-                        deviation = abs(price - ref_price) / ref_price
+                        deviation = abs(compared - ref_price) / ref_price
                         if deviation < best_deviation:
                             best_deviation = deviation
                             best_price = price
-                except:
-                    continue
+                            best_currency = currency
             
             if best_price is not None:
                 prices[name] = best_price
+                if currencies is not None:
+                    currencies[name] = best_currency
             
             if name in prices:
                 break
@@ -1541,12 +3661,81 @@ def click_load_more_until_done(page, selector, max_clicks=20):
     page.evaluate("window.scrollTo(0, 0)")
     page.wait_for_timeout(500)
     
-    return clicks
+    return clicks
+
+
+def save_page_text(store_key, body_text):
+    """Пази текста на страницата в PAGE_TEXT_DIR (за командата extract)."""
+    if not PAGE_TEXT_DIR:
+        return
+    try:
+        os.makedirs(PAGE_TEXT_DIR, exist_ok=True)
+        with open(os.path.join(PAGE_TEXT_DIR, f"{store_key}.txt"), 'w', encoding='utf-8') as f:
+            f.write(body_text)
+    except OSError as e:
+        print(f"  Текстът на страницата не е запазен: {str(e)[:50]}")
+
+
+def extract_text_prices(body_text, store_name, sources=None, use_claude=True, currencies=None, product_names=None):
+    """
+    Цените от текста на страницата: двуфазен Claude анализ и fallback
+    за липсващите продукти.
+    
+    Ако е подаден sources (dict), в него се записва източникът на всяка
+    цена: "claude" или "fallback". Ако е подаден currencies (dict) -
+    валутата на всяка цена ("BGN"/"EUR", None ако няма означение).
+    product_names ограничава съпоставянето до избраните продукти.
+    """
+    prices = {}
+    if sources is None:
+        sources = {}
+    if currencies is None:
+        currencies = {}
+    
+    # Двуфазен Claude анализ
+    if use_claude:
+        try:
+            claude_prices = extract_prices_with_claude_two_phase(body_text, store_name, currencies, product_names)
+            print(f"  Claude (двуфазен): {len(claude_prices)} продукта")
+            prices.update(claude_prices)
+            sources.update(dict.fromkeys(claude_prices, "claude"))
+        except Exception as e:
+            print(f"  Claude грешка: {str(e)[:50]}")
+    
+    # Fallback само за липсващи продукти
+    try:
+        print(f"  Fallback търсене...")
+        fallback_currencies = {}
+        fallback_prices = extract_prices_with_fallback(body_text, fallback_currencies, product_names)
+        added = 0
+        for name, price in fallback_prices.items():
+            if name not in prices:
+                prices[name] = price
+                sources[name] = "fallback"
+                currencies[name] = fallback_currencies.get(name)
+                added += 1
+        print(f"    Fallback добави: {added} продукта")
+    except Exception as e:
+        print(f"  Fallback грешка: {str(e)[:50]}")
+    
+    return prices
 
 
-def scrape_store(page, store_key, store_config, vision_client=None):
-    """Извлича цени от един магазин с двуфазен Claude анализ, pagination, load-more и визуална верификация."""
+def scrape_store(page, store_key, store_config, vision_client=None, sources=None, currencies=None, product_names=None):
+    """
+    Извлича цени от един магазин с двуфазен Claude анализ, pagination, load-more и визуална верификация.
+    
+    Ако е подаден sources (dict), в него се записва източникът на всяка
+    цена: "claude", "fallback" или "vision". Ако е подаден currencies
+    (dict) - валутата на всяка цена (None ако няма означение).
+    product_names (частично стартиране) ограничава съпоставянето и
+    визуалната проверка до избраните продукти.
+    """
     prices = {}
+    if sources is None:
+        sources = {}
+    if currencies is None:
+        currencies = {}
     url = store_config['url']
     store_name = store_config['name_in_sheet']
     scroll_times = store_config.get('scroll_times', 10)
@@ -1645,26 +3834,8 @@ def scrape_store(page, store_key, store_config, vision_client=None):
         print(f"  [DEBUG] Малко текст! Първи 300 символа:")
         print(f"  {body_text[:300]}")
     
-    # Двуфазен Claude анализ
-    try:
-        claude_prices = extract_prices_with_claude_two_phase(body_text, store_name)
-        print(f"  Claude (двуфазен): {len(claude_prices)} продукта")
-        prices.update(claude_prices)
-    except Exception as e:
-        print(f"  Claude грешка: {str(e)[:50]}")
-    
-    # Fallback само за липсващи продукти
-    try:
-        print(f"  Fallback търсене...")
-        fallback_prices = extract_prices_with_fallback(body_text)
-        added = 0
-        for name, price in fallback_prices.items():
-            if name not in prices:
-                prices[name] = price
-                added += 1
-        print(f"    Fallback добави: {added} продукта")
-    except Exception as e:
-        print(f"  Fallback грешка: {str(e)[:50]}")
+    save_page_text(store_key, body_text)
+    prices.update(extract_text_prices(body_text, store_name, sources, currencies=currencies, product_names=product_names))
     
     # Визуална верификация (ако е активирана и има клиент)
     if ENABLE_VISUAL_VERIFICATION and vision_client:
@@ -1682,25 +3853,26 @@ def scrape_store(page, store_key, store_config, vision_client=None):
                 scroll_for_all_products(page, 5)
             
             # Верифицираме до 5 продукта визуално
-            visual_results = visual_verify_products(page, vision_client, store_name, prices, max_verify=5)
+            visual_results = visual_verify_products(page, vision_client, store_name, prices, max_verify=5,
+                                                    product_names=product_names)
             
             # Интегрираме резултатите
             visual_confirmed = 0
             visual_corrected = 0
+            catalog = get_catalog()
             for product_id, visual_data in visual_results.items():
-                product_name = None
-                for p in PRODUCTS:
-                    if p['id'] == product_id:
-                        product_name = p['name']
-                        break
+                product_name = catalog.name_of(product_id)
                 
-                if product_name:
+                if product_name and (product_names is None or product_name in product_names):
                     visual_price = visual_data.get('price')
+                    visual_currency = visual_data.get('currency')
                     text_price = prices.get(product_name)
                     
                     if text_price and visual_price:
-                        # Проверяваме дали цените съвпадат (с толеранс от 5%)
-                        diff_pct = abs(visual_price - text_price) / text_price * 100 if text_price > 0 else 100
+                        # Проверяваме дали цените съвпадат (с толеранс от 5%), в BGN равностойност
+                        text_bgn = price_in_bgn(text_price, currencies.get(product_name))
+                        visual_bgn = price_in_bgn(visual_price, visual_currency)
+                        diff_pct = abs(visual_bgn - text_bgn) / text_bgn * 100 if text_bgn > 0 else 100
                         if diff_pct < 5:
                             visual_confirmed += 1
                         else:
@@ -1709,8 +3881,10 @@ def scrape_store(page, store_key, store_config, vision_client=None):
                     elif visual_price and not text_price:
                         # Намерихме цена визуално, която липсваше от текста
                         prices[product_name] = visual_price
+                        sources[product_name] = "vision"
+                        currencies[product_name] = visual_currency
                         visual_corrected += 1
-                        print(f"      [VISION] Добавен #{product_id} {product_name}: {visual_price:.2f} лв")
+                        print(f"      [VISION] Добавен #{product_id} {product_name}: {format_price_label(f'{visual_price:.2f}', visual_currency)}")
             
             if visual_confirmed > 0 or visual_corrected > 0:
                 print(f"      [VISION] Потвърдени: {visual_confirmed}, Коригирани: {visual_corrected}")
@@ -1718,31 +3892,261 @@ def scrape_store(page, store_key, store_config, vision_client=None):
         except Exception as e:
             print(f"  [VISION] Грешка: {str(e)[:50]}")
     
+    # Продукти, които не се продават в магазина, са грешни съвпадения
+    for name in get_catalog().unavailable_names(store_key):
+        currencies.pop(name, None)
+        if prices.pop(name, None) is not None:
+            print(f"  [КАТАЛОГ] Премахнат {name} - не се продава в {store_name}")
+    
     print(f"  Общо намерени: {len(prices)} продукта")
     return prices
 
 
-def collect_prices():
+# =============================================================================
+# МАТРИЦА НА ЦЕНИТЕ (продукти × магазини)
+# =============================================================================
+
+class PriceMatrix:
+    """
+    Нормализираните цени от едно стартиране като NumPy масив продукти × магазини.
+    
+    - raw: суровите цени (NaN = няма цена)
+    - currency: изричната валута на всяка цена ("BGN"/"EUR", None - без означение)
+    - prices: цените в BGN (EUR цените са конвертирани; цените без означение -
+      по близостта до референцията)
+    - valid: маска на наличните цени
+    
+    Всички статистики се изчисляват векторно с едно минаване:
+    средна, медиана, MAD, отклонения от средната, робастни z-оценки,
+    флагове за аномалии и покритие по продукти/магазини.
+    """
+    
+    def __init__(self, records, store_keys, raw, currency=None):
+        import numpy as np
+        self.records = list(records)
+        self.store_keys = list(store_keys)
+        self.store_index = {key: j for j, key in enumerate(self.store_keys)}
+        self.raw = np.asarray(raw, dtype=float)
+        if currency is None:
+            currency = np.full(self.raw.shape, None, dtype=object)
+        self.currency = np.asarray(currency, dtype=object)
+        self._compute()
+    
+    @classmethod
+    def from_store_prices(cls, all_prices, records, store_keys, currencies=None):
+        """
+        Строи матрицата от {store_key: {име на продукт: цена}}.
+        Обхождат се само намерените цени, не всички двойки продукт × магазин.
+        
+        currencies: {store_key: {име на продукт: "BGN"/"EUR"/None}} -
+        валутата на всяка цена; липсващите се определят по референцията.
+        """
+        import numpy as np
+        records = list(records)
+        store_keys = list(store_keys)
+        currencies = currencies or {}
+        row_index = {record.name: i for i, record in enumerate(records)}
+        raw = np.full((len(records), len(store_keys)), np.nan)
+        currency = np.full(raw.shape, None, dtype=object)
+        for j, store_key in enumerate(store_keys):
+            store_currencies = currencies.get(store_key) or {}
+            for name, price in (all_prices.get(store_key) or {}).items():
+                i = row_index.get(name)
+                if i is not None and price is not None:
+                    raw[i, j] = price
+                    currency[i, j] = store_currencies.get(name)
+        return cls(records, store_keys, raw, currency)
+    
+    def _compute(self):
+        import numpy as np
+        raw = self.raw
+        self.valid = ~np.isnan(raw)
+        
+        # Референтни цени и грамаж като колони
+        ref_bgn = np.array([r.ref_price_bgn for r in self.records], dtype=float)[:, None]
+        sizes = np.array([r.weight_value[0] if r.weight_value else np.nan for r in self.records])[:, None]
+        self.ref_bgn = ref_bgn[:, 0]
+        
+        # Изричната валута на цената е с предимство; за цените без означение -
+        # по референцията (като detect_currency_by_reference, но за цялата матрица)
+        ref_eur = ref_bgn / EUR_BGN_RATE
+        explicit_eur = self.currency == "EUR"
+        explicit = explicit_eur | (self.currency == "BGN")
+        with np.errstate(invalid='ignore'):
+            by_reference = np.abs(raw - ref_eur) / ref_eur < np.abs(raw - ref_bgn) / ref_bgn
+        self.eur_mask = self.valid & np.where(explicit, explicit_eur, by_reference)
+        self.prices = np.round(np.where(self.eur_mask, raw * EUR_BGN_RATE, raw), 2)
+        
+        # Покритие
+        self.product_coverage = self.valid.sum(axis=1)
+        self.store_coverage = self.valid.sum(axis=0)
+        has_data = self.product_coverage > 0
+        
+        # Средна и медиана по продукт (редовете без цени остават NaN)
+        totals = np.where(self.valid, self.prices, 0.0).sum(axis=1)
+        self.mean = np.full(len(self.records), np.nan)
+        np.divide(totals, self.product_coverage, out=self.mean, where=has_data)
+        self.median = np.full(len(self.records), np.nan)
+        self.mad = np.full(len(self.records), np.nan)
+        if has_data.any():
+            self.median[has_data] = np.nanmedian(self.prices[has_data], axis=1)
+            abs_dev = np.abs(self.prices[has_data] - self.median[has_data, None])
+            self.mad[has_data] = np.nanmedian(abs_dev, axis=1)
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Отклонение от средната пазарна цена в % (+ по-скъпо, - по-евтино)
+            self.deviation_pct = (self.prices - self.mean[:, None]) / self.mean[:, None] * 100
+            # Робастна z-оценка (модифицирана z по Iglewicz-Hoaglin); при MAD = 0 - NaN
+            scaled_mad = np.where(self.mad > 0, self.mad * 1.4826, np.nan)[:, None]
+            self.robust_z = (self.prices - self.median[:, None]) / scaled_mad
+            self.unit_prices = np.round(self.prices * 1000 / sizes, 2)
+        
+        abs_deviation = np.where(self.valid, np.abs(self.deviation_pct), -1.0)
+        self.anomaly = self.valid & (abs_deviation > ALERT_THRESHOLD)
+        self.robust_anomaly = self.valid & (np.abs(np.nan_to_num(self.robust_z)) > ROBUST_Z_THRESHOLD)
+        self.has_anomaly = self.anomaly.any(axis=1)
+        
+        # Магазин с максимално отклонение (по абсолютна стойност)
+        self.max_deviation_col = np.where(has_data, abs_deviation.argmax(axis=1), -1)
+    
+    def currency_corrections(self):
+        """Брой EUR цени, конвертирани към BGN, и брой BGN цени."""
+        eur = int(self.eur_mask.sum())
+        return {"EUR->BGN": eur, "BGN": int(self.valid.sum()) - eur}
+    
+    def coverage_by_store(self):
+        """{store_key: брой намерени продукти}"""
+        return {key: int(self.store_coverage[j]) for j, key in enumerate(self.store_keys)}
+    
+    def to_results(self):
+        """
+        Съвместим изглед - списък от речници във формата, който очакват
+        Google Sheets, имейлът и историята.
+        """
+        results = PriceResults()
+        results.matrix = self
+        for i, record in enumerate(self.records):
+            valid_row = self.valid[i]
+            prices = {}
+            deviations = {}
+            unit_prices = {}
+            robust_outliers = []
+            for j, store_key in enumerate(self.store_keys):
+                if valid_row[j]:
+                    prices[store_key] = float(self.prices[i, j])
+                    deviations[store_key] = round(float(self.deviation_pct[i, j]), 1)
+                    unit_prices[store_key] = float(self.unit_prices[i, j]) if record.weight_value else None
+                    if self.robust_anomaly[i, j]:
+                        robust_outliers.append(store_key)
+                else:
+                    prices[store_key] = None
+                    deviations[store_key] = None
+                    unit_prices[store_key] = None
+            
+            if self.product_coverage[i]:
+                avg_bgn = float(self.mean[i])
+                max_col = int(self.max_deviation_col[i])
+                max_deviation = round(float(self.deviation_pct[i, max_col]), 1)
+                max_deviation_store = self.store_keys[max_col]
+                median_bgn = round(float(self.median[i]), 2)
+                status = "ВНИМАНИЕ" if self.has_anomaly[i] else "OK"
+            else:
+                avg_bgn = max_deviation = max_deviation_store = median_bgn = None
+                status = "НЯМА ДАННИ"
+            
+            results.append({
+                "name": record.name,
+                "weight": record.weight,
+                "ref_bgn": record.ref_price_bgn,
+                "ref_eur": record.ref_price_eur,
+                "prices": prices,  # Цени по магазини (BGN)
+                "store_deviations": deviations,  # Отклонения по магазини (%)
+                "avg_bgn": round(avg_bgn, 2) if avg_bgn else None,
+                "avg_eur": round(avg_bgn / EUR_BGN_RATE, 2) if avg_bgn else None,
+                "max_deviation": max_deviation,
+                "max_deviation_store": max_deviation_store,
+                "has_anomaly": bool(self.has_anomaly[i]),
+                "status": status,
+                "unit": UNIT_PRICE_LABELS.get(record.weight_value[1]) if record.weight_value else None,
+                "unit_prices": unit_prices,  # Цена за кг/л по магазини (BGN)
+                "ref_unit_bgn": record.ref_unit_price_bgn,
+                "avg_unit_bgn": unit_price(avg_bgn, record.weight_value) if avg_bgn else None,
+                "median_bgn": median_bgn,
+                "coverage": int(self.product_coverage[i]),
+                "robust_outliers": robust_outliers,  # Магазини с |робастна z| > ROBUST_Z_THRESHOLD
+            })
+        return results
+
+
+class PriceResults(list):
+    """Списък с резултати, който пази и матрицата, от която е построен."""
+    matrix = None
+
+
+def store_coverage(results):
+    """
+    Брой намерени продукти по магазин.
+    Използва матрицата ако я има, иначе брои от речниците.
+    """
+    matrix = getattr(results, 'matrix', None)
+    if matrix is not None:
+        return matrix.coverage_by_store()
+    return {key: len([r for r in results if r['prices'].get(key)]) for key in STORES}
+
+
+def collect_prices(stores=None, products=None, skip_vision=False):
     """
     Събира цени от всички магазини с интелигентна валутна детекция.
     
+    Частично стартиране (stores - ключове от STORES, products - ID от каталога)
+    скрейпва само избраните магазини и пази само избраните продукти; резултатът
+    се наслагва върху последното стартиране от локалната история, така че
+    Sheets и имейлът получават пълната таблица.
+    
     Процес:
     1. Скрейпва всеки магазин и запазва суровите цени
     2. Детектира валутата на всеки магазин от текста
     3. Нормализира всички цени към BGN (за преходния период)
     4. Изчислява средни стойности и отклонения спрямо BGN референцията
     
+    Всяка цена носи собствената си валута от извличането; валутата,
+    детектирана за страницата, се ползва само за цените без означение.
+    
     ВАЖНО: Браузърът се рестартира между магазините за да освобождава памет
     и да предотврати "Page crashed" грешки при дълги сесии.
     
     За магазини с Cloudflare защита се използва playwright-stealth.
     """
+    import numpy as np
     all_prices = {}
     store_currencies = {}
+    store_price_currencies = {}
     store_raw_texts = {}
+    store_sources = {}
+    failed_stores = []
+    started_at = datetime.now()
+    store_keys = list(stores or STORES)
+    scope = None
+    if stores or products:
+        scope = {"stores": store_keys, "products": sorted(products) if products else None}
+    product_names = {get_catalog().name_of(product_id) for product_id in products} if products else None
+    enable_vision = ENABLE_VISUAL_VERIFICATION and not skip_vision
+    
+    # Историята се проверява преди скрейпването - частично стартиране без
+    # предишно състояние би публикувало таблица само с избраните магазини
+    history = get_history_store()
+    if not check_history_state(history) and scope:
+        raise RuntimeError("Частично стартиране изисква предишно стартиране в локалната история")
+    
+    from playwright.sync_api import sync_playwright
+    if STEALTH_AVAILABLE:
+        from playwright_stealth import stealth_sync
+    else:
+        print("  [WARN] playwright-stealth не е инсталиран, Cloudflare сайтове може да не работят")
     
     # Обработваме всеки магазин с отделен браузър
-    for key, config in STORES.items():
+    for key in store_keys:
+        config = STORES[key]
         store_name = config['name_in_sheet']
         needs_stealth = config.get('needs_stealth', False)
         
@@ -1768,7 +4172,7 @@ def collect_prices():
                     java_script_enabled=True
                 )
                 
-                if not ENABLE_VISUAL_VERIFICATION:
+                if not enable_vision:
                     context.route("**/*.{png,jpg,jpeg,gif,webp,svg}", lambda r: r.abort())
                 
                 page = context.new_page()
@@ -1779,21 +4183,32 @@ def collect_prices():
                     print(f"  [STEALTH] Активиран за {store_name}")
                 
                 vision_client = None
-                if ENABLE_VISUAL_VERIFICATION and CLAUDE_AVAILABLE:
+                if enable_vision and CLAUDE_AVAILABLE:
                     vision_client = get_claude_client()
-                    if key == list(STORES.keys())[0]:  # Само за първия магазин
+                    if key == store_keys[0]:  # Само за първия магазин
                         print("  [VISION] Claude Vision активиран")
                 
-                prices = scrape_store(page, key, config, vision_client)
+                store_sources[key] = {}
+                price_currencies = store_price_currencies[key] = {}
+                prices = scrape_store(page, key, config, vision_client, sources=store_sources[key],
+                                      currencies=price_currencies, product_names=product_names)
                 
                 try:
                     page_text = page.content()
                     store_raw_texts[key] = page_text
                     
-                    detected_currency = detect_currency_from_text(page_text)
+                    # Първо по валутите на самите цени, после по индикатори в текста
+                    detected_currency = (
+                        dominant_price_currency(scan_prices(page_text))
+                        or detect_currency_from_text(page_text)
+                    )
                     if detected_currency:
                         store_currencies[key] = detected_currency
                         print(f"  [ВАЛУТА] {store_name}: Детектирана {detected_currency}")
+                        # Валутата на страницата е само резервна - за цените без собствено означение
+                        for name in prices:
+                            if not price_currencies.get(name):
+                                price_currencies[name] = detected_currency
                     else:
                         store_currencies[key] = config.get('expected_currency', 'BGN')
                         print(f"  [ВАЛУТА] {store_name}: Приета {store_currencies[key]} (по подразбиране)")
@@ -1817,6 +4232,7 @@ def collect_prices():
             print(f"  ✗ Критична грешка: {str(e)[:80]}")
             all_prices[key] = {}
             store_currencies[key] = config.get('expected_currency', 'BGN')
+            failed_stores.append(key)
     
     print("\n  [ВАЛУТА] Обобщение:")
     for store_key, currency in store_currencies.items():
@@ -1824,105 +4240,1304 @@ def collect_prices():
         print(f"    • {store_name}: {currency}")
     print()
     
+    # Частично стартиране - наслагване върху последното състояние от историята
+    base_run = None
+    if scope and failed_stores:
+        # Магазин с грешка не е пре-скрейпнат - клетките му остават от
+        # предишното стартиране, вместо да се публикуват празни
+        scope = dict(scope, stores=[key for key in scope['stores'] if key not in failed_stores])
+        print(f"  [ЧАСТИЧНО] Без промяна (грешка при скрейпване): {', '.join(failed_stores)}")
+        if not scope['stores']:
+            raise RuntimeError("Частичното стартиране не успя за нито един от избраните магазини")
+    if scope:
+        base_run = history.get_run()
+        base_currencies = {}
+        all_prices = merge_run_prices(history.run_prices(base_run['id'], base_currencies), all_prices, scope)
+        store_price_currencies = merge_run_prices(base_currencies, store_price_currencies, scope)
+        print(f"  [ЧАСТИЧНО] Наслагване върху стартиране #{base_run['id']} от {base_run['started_at']}")
+    
     # Обработка на резултатите - нормализация на ниво продукт
     # v9.0: Новата логика - средната цена се изчислява от реалните пазарни цени
-    results = []
-    currency_corrections = {"EUR->BGN": 0, "BGN": 0}
-    
-    for product in PRODUCTS:
-        name = product['name']
-        ref_bgn = product['ref_price_bgn']
-        ref_eur = product['ref_price_eur']
-        
-        # Събираме и нормализираме цените за този продукт
-        normalized_prices = {}
-        for store_key in STORES:
-            raw_price = all_prices.get(store_key, {}).get(name)
-            if raw_price is not None:
-                # Детектираме валутата чрез сравнение с референтната цена
-                detected = detect_currency_by_reference(raw_price, ref_bgn)
-                if detected == "EUR":
-                    normalized_prices[store_key] = round(raw_price * EUR_BGN_RATE, 2)
-                    currency_corrections["EUR->BGN"] += 1
-                else:
-                    normalized_prices[store_key] = round(raw_price, 2)
-                    currency_corrections["BGN"] += 1
+    matrix = PriceMatrix.from_store_prices(all_prices, get_catalog(), STORES, store_price_currencies)
+    results = matrix.to_results()
+    currency_corrections = matrix.currency_corrections()
+    
+    # Показваме статистика за валутните корекции
+    print(f"  [ВАЛУТА] Корекции: {currency_corrections['EUR->BGN']} EUR→BGN, {currency_corrections['BGN']} BGN (без промяна)")
+    
+    # Локална история - всички цени на стартирането в една транзакция
+    if history:
+        try:
+            run_id = history.record_run(matrix, store_currencies, store_sources, started_at,
+                                        scope=scope, base_run_id=base_run['id'] if base_run else None)
+            recorded = sum(
+                1 for i, j in zip(*np.nonzero(matrix.valid))
+                if in_run_scope(scope, matrix.store_keys[j], matrix.records[i].id)
+            )
+            print(f"  [ИСТОРИЯ] Стартиране #{run_id}: {recorded} цени записани")
+        except sqlite3.Error as e:
+            print(f"  [ИСТОРИЯ] Грешка при запис: {str(e)[:50]}")
+    
+    return results
+
+
+# =============================================================================
+# ИСТОРИЯ НА ЦЕНИТЕ (SQLite)
+# =============================================================================
+
+def in_run_scope(scope, store_key, product_id):
+    """Дали клетката магазин × продукт е в обхвата на стартирането (scope None - всичко)."""
+    if not scope:
+        return True
+    return store_key in scope['stores'] and (scope.get('products') is None or product_id in scope['products'])
+
+
+def merge_run_prices(base_prices, new_prices, scope):
+    """
+    Наслагва цените на частично стартиране върху предишното състояние.
+    
+    Клетките в обхвата се заменят изцяло - продукт, който вече не е намерен
+    в пре-скрейпнатия магазин, не запазва старата си цена.
+    """
+    catalog = get_catalog()
+    merged = {}
+    for store_key, prices in base_prices.items():
+        merged[store_key] = {
+            name: price for name, price in prices.items()
+            if not in_run_scope(scope, store_key, getattr(catalog.find(name), 'id', None))
+        }
+    for store_key, prices in new_prices.items():
+        merged.setdefault(store_key, {}).update(prices)
+    return merged
+
+
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at TEXT NOT NULL,
+    finished_at TEXT NOT NULL,
+    store_currencies TEXT NOT NULL,
+    sheets_synced INTEGER NOT NULL DEFAULT 0,
+    base_run_id INTEGER REFERENCES runs(id),
+    scope TEXT
+);
+CREATE TABLE IF NOT EXISTS observations (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    product_id INTEGER NOT NULL,
+    store TEXT NOT NULL,
+    observed_at TEXT NOT NULL,
+    raw_price REAL NOT NULL,
+    currency TEXT NOT NULL,
+    price_bgn REAL NOT NULL,
+    price_eur REAL NOT NULL,
+    source TEXT,
+    PRIMARY KEY (run_id, product_id, store)
+);
+CREATE INDEX IF NOT EXISTS idx_observations_product_store_date
+    ON observations (product_id, store, observed_at);
+CREATE INDEX IF NOT EXISTS idx_observations_store_date
+    ON observations (store, observed_at);
+"""
+
+
+class HistoryStore:
+    """
+    Локалната история на цените - SQLite база в WAL режим.
+    
+    - runs: едно стартиране (време, валута по магазин, синхронизиран ли е с Sheets).
+      Частично стартиране (само някои магазини/продукти) има scope
+      {"stores": [...], "products": [id, ...] или null} и base_run_id -
+      стартирането, върху което се наслагва (run_prices ги обединява)
+    - observations: една цена за продукт × магазин × стартиране - суровата
+      цена, валутата ѝ, нормализираните BGN/EUR и източника (claude,
+      fallback, vision)
+    
+    Това е основният запис на историята; табовете "История_*" в Google
+    Sheets се синхронизират от него (unsynced_runs / mark_synced).
+    Времената са ISO низове (YYYY-MM-DDTHH:MM:SS) и се сравняват лексикографски.
+    
+    Всяка нишка има своя връзка (self.conn) - публикуването в Sheets
+    чете и отбелязва историята от нишката на изхода "sheets".
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        if path == ':memory:':
+            # Споделена база в паметта - всички връзки на обекта виждат едни и същи данни
+            self._uri = f"file:harmonica_history_{id(self)}?mode=memory&cache=shared"
+            self.existed = False
+        else:
+            self.existed = os.path.exists(path)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._uri = None
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.conn.executescript(_HISTORY_SCHEMA)
+        # Бази отпреди частичните стартирания
+        columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(runs)")}
+        for column, definition in (("base_run_id", "INTEGER REFERENCES runs(id)"), ("scope", "TEXT")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE runs ADD COLUMN {column} {definition}")
+    
+    @property
+    def conn(self):
+        """SQLite връзката на текущата нишка (създава се при първо използване)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self._uri:
+                conn = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
             else:
-                normalized_prices[store_key] = None
+                conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    def close(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+    
+    def record_run(self, matrix, store_currencies=None, sources=None, started_at=None, scope=None, base_run_id=None):
+        """
+        Записва всички налични цени от PriceMatrix в една транзакция.
+        При частично стартиране се записват само клетките в scope - останалите
+        са пренесени от base_run_id и вече са в историята.
         
-        valid_prices = [p for p in normalized_prices.values() if p is not None]
+        Args:
+            matrix: PriceMatrix на стартирането
+            store_currencies: {store_key: валута, детектирана за магазина}
+            sources: {store_key: {име на продукт: източник}}
+            started_at: datetime на началото (по подразбиране - сега)
+            scope: {"stores": [...], "products": [...] или None}; None за пълно стартиране
+            base_run_id: стартирането, върху което се наслагва частичното
         
-        # v9.0: Нова логика за средна цена и отклонения
-        # Средната цена е от реалните пазарни цени на магазините
-        store_deviations = {}  # Отклонение на всеки магазин от средната
-        max_deviation = None
-        max_deviation_store = None
-        has_anomaly = False  # Има ли магазин с отклонение >10%
+        Returns:
+            id на стартирането
+        """
+        import numpy as np
+        finished_at = datetime.now().isoformat(timespec='seconds')
+        started_at = started_at.isoformat(timespec='seconds') if started_at else finished_at
+        sources = sources or {}
         
-        if valid_prices:
-            # Средната цена е от реалните цени на магазините
-            avg_bgn = sum(valid_prices) / len(valid_prices)
-            avg_eur = avg_bgn / EUR_BGN_RATE
-            
-            # Изчисляваме отклонението на всеки магазин от средната пазарна цена
-            for store_key in STORES:
-                store_price = normalized_prices.get(store_key)
-                if store_price is not None:
-                    # Отклонение: положително = по-скъпо от средното, отрицателно = по-евтино
-                    deviation_pct = ((store_price - avg_bgn) / avg_bgn) * 100
-                    store_deviations[store_key] = round(deviation_pct, 1)
-                    
-                    # Проверяваме за аномалия (>10% отклонение)
-                    if abs(deviation_pct) > ALERT_THRESHOLD:
-                        has_anomaly = True
-                    
-                    # Търсим максималното отклонение (по абсолютна стойност)
-                    if max_deviation is None or abs(deviation_pct) > abs(max_deviation):
-                        max_deviation = deviation_pct
-                        max_deviation_store = store_key
-                else:
-                    store_deviations[store_key] = None
-            
-            # Статусът е ВНИМАНИЕ ако поне един магазин има отклонение >10%
-            status = "ВНИМАНИЕ" if has_anomaly else "OK"
+        rows = []
+        product_idx, store_idx = np.nonzero(matrix.valid)
+        for i, j in zip(product_idx.tolist(), store_idx.tolist()):
+            record = matrix.records[i]
+            store_key = matrix.store_keys[j]
+            if not in_run_scope(scope, store_key, record.id):
+                continue
+            price_bgn = float(matrix.prices[i, j])
+            rows.append((
+                record.id,
+                store_key,
+                started_at,
+                float(matrix.raw[i, j]),
+                "EUR" if matrix.eur_mask[i, j] else "BGN",
+                price_bgn,
+                round(price_bgn / EUR_BGN_RATE, 2),
+                (sources.get(store_key) or {}).get(record.name),
+            ))
+        
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO runs (started_at, finished_at, store_currencies, base_run_id, scope) VALUES (?, ?, ?, ?, ?)",
+                (started_at, finished_at, json.dumps(store_currencies or {}), base_run_id,
+                 json.dumps(scope) if scope else None)
+            )
+            run_id = cursor.lastrowid
+            self.conn.executemany(
+                "INSERT INTO observations (run_id, product_id, store, observed_at, raw_price, currency,"
+                " price_bgn, price_eur, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id,) + row for row in rows]
+            )
+        return run_id
+    
+    def last_weeks(self, product_id, weeks=4, store=None, now=None):
+        """
+        Цените на продукта за последните N седмици.
+        
+        Returns:
+            list от dict {"observed_at", "store", "price_bgn", "price_eur"} по време
+        """
+        since = ((now or datetime.now()) - timedelta(weeks=weeks)).isoformat(timespec='seconds')
+        query = (
+            "SELECT observed_at, store, price_bgn, price_eur FROM observations"
+            " WHERE product_id = ? AND observed_at >= ?"
+        )
+        params = [product_id, since]
+        if store:
+            query += " AND store = ?"
+            params.append(store)
+        query += " ORDER BY observed_at, store"
+        return [dict(row) for row in self.conn.execute(query, params)]
+    
+    def week_over_week(self, product_id=None, now=None):
+        """
+        Промяна на цената седмица за седмица: последната цена от последните
+        7 дни спрямо последната от предходните 7, за всеки продукт × магазин.
+        
+        Returns:
+            list от dict {"product_id", "store", "price_bgn", "previous_bgn", "change_pct"}
+        """
+        now = now or datetime.now()
+        week_start = (now - timedelta(days=7)).isoformat(timespec='seconds')
+        previous_start = (now - timedelta(days=14)).isoformat(timespec='seconds')
+        query = """
+            WITH ranked AS (
+                SELECT product_id, store, price_bgn, observed_at >= :week_start AS current_week,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY product_id, store, observed_at >= :week_start
+                           ORDER BY observed_at DESC
+                       ) AS rank
+                FROM observations
+                WHERE observed_at >= :previous_start AND observed_at <= :now
+                  AND (:product_id IS NULL OR product_id = :product_id)
+            )
+            SELECT cur.product_id, cur.store, cur.price_bgn, prev.price_bgn AS previous_bgn
+            FROM ranked AS cur
+            JOIN ranked AS prev
+              ON prev.product_id = cur.product_id AND prev.store = cur.store
+             AND prev.current_week = 0 AND prev.rank = 1
+            WHERE cur.current_week = 1 AND cur.rank = 1
+            ORDER BY cur.product_id, cur.store
+        """
+        params = {
+            "week_start": week_start,
+            "previous_start": previous_start,
+            "now": now.isoformat(timespec='seconds'),
+            "product_id": product_id,
+        }
+        changes = []
+        for row in self.conn.execute(query, params):
+            change = dict(row)
+            previous = change['previous_bgn']
+            change['change_pct'] = round((change['price_bgn'] - previous) / previous * 100, 1) if previous else None
+            changes.append(change)
+        return changes
+    
+    def store_series(self, store, product_id, since=None):
+        """Цените на продукта в един магазин по време: list от (observed_at, price_bgn)."""
+        query = "SELECT observed_at, price_bgn FROM observations WHERE product_id = ? AND store = ?"
+        params = [product_id, store]
+        if since:
+            query += " AND observed_at >= ?"
+            params.append(since.isoformat(timespec='seconds'))
+        query += " ORDER BY observed_at"
+        return [(row['observed_at'], row['price_bgn']) for row in self.conn.execute(query, params)]
+    
+    def product_summary(self, now=None):
+        """
+        Плъзгащи се статистики по продукт от средната цена на всяко
+        стартиране (по всички магазини) за последните 13 седмици.
+        
+        Частичното стартиране се брои с пълната таблица след наслагването
+        (run_prices), а не само със скрейпнатите в него клетки - иначе
+        средната му цена би била само от пре-скрейпнатите магазини.
+        
+        Returns:
+            dict {product_id: {"last_bgn", "avg_4w", "avg_13w", "min_13w",
+            "max_13w", "change_7d_pct", "runs"}}
+        """
+        import numpy as np
+        now = now or datetime.now()
+        since = (now - timedelta(weeks=13)).isoformat(timespec='seconds')
+        since_4w = (now - timedelta(weeks=4)).isoformat(timespec='seconds')
+        week_ago = (now - timedelta(days=7)).isoformat(timespec='seconds')
+        
+        catalog = get_catalog()
+        series = {}
+        for run in self.conn.execute(
+            "SELECT id, started_at FROM runs WHERE started_at >= ? AND started_at <= ? ORDER BY started_at, id",
+            (since, now.isoformat(timespec='seconds'))
+        ).fetchall():
+            currencies = {}
+            prices = self.run_prices(run['id'], currencies)
+            matrix = PriceMatrix.from_store_prices(prices, catalog, STORES, currencies)
+            for i in np.flatnonzero(matrix.product_coverage).tolist():
+                series.setdefault(matrix.records[i].id, []).append((run['started_at'], float(matrix.mean[i])))
+        
+        summary = {}
+        for product_id, points in series.items():
+            prices = np.array([price for _, price in points])
+            recent = [price for observed_at, price in points if observed_at >= since_4w]
+            previous = [price for observed_at, price in points if observed_at < week_ago]
+            last = prices[-1]
+            change = None
+            if previous and points[-1][0] >= week_ago:
+                change = round(float((last - previous[-1]) / previous[-1] * 100), 1)
+            summary[product_id] = {
+                "last_bgn": round(float(last), 2),
+                "avg_4w": round(float(np.mean(recent)), 2) if recent else None,
+                "avg_13w": round(float(prices.mean()), 2),
+                "min_13w": round(float(prices.min()), 2),
+                "max_13w": round(float(prices.max()), 2),
+                "change_7d_pct": change,
+                "runs": len(points),
+            }
+        return summary
+    
+    def run_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+    
+    def get_run(self, run_id=None):
+        """Стартиране по id (последното по подразбиране); None ако няма."""
+        if run_id is None:
+            row = self.conn.execute("SELECT * FROM runs ORDER BY started_at DESC, id DESC LIMIT 1").fetchone()
         else:
-            avg_bgn = avg_eur = max_deviation = None
-            status = "НЯМА ДАННИ"
-        
-        results.append({
-            "name": name,
-            "weight": product['weight'],
-            "ref_bgn": ref_bgn,
-            "ref_eur": ref_eur,
-            "prices": normalized_prices,  # Цени по магазини (BGN)
-            "store_deviations": store_deviations,  # Отклонения по магазини (%)
-            "avg_bgn": round(avg_bgn, 2) if avg_bgn else None,
-            "avg_eur": round(avg_eur, 2) if avg_eur else None,
-            "max_deviation": round(max_deviation, 1) if max_deviation is not None else None,
-            "max_deviation_store": max_deviation_store,
-            "has_anomaly": has_anomaly,
-            "status": status
+            row = self.conn.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def unsynced_runs(self):
+        """Стартиранията, които още не са добавени в историята в Google Sheets."""
+        return [dict(row) for row in self.conn.execute(
+            "SELECT id, started_at FROM runs WHERE sheets_synced = 0 ORDER BY id"
+        )]
+    
+    def mark_synced(self, run_ids):
+        with self.conn:
+            self.conn.executemany("UPDATE runs SET sheets_synced = 1 WHERE id = ?", [(run_id,) for run_id in run_ids])
+    
+    def run_prices(self, run_id, currencies=None):
+        """
+        Суровите цени на стартиране във формата на collect_prices: {store_key: {име: цена}}.
+        Частичните стартирания се наслагват върху веригата от base_run_id.
+        
+        Ако е подаден currencies (dict), в него се попълва записаната валута
+        на всяка цена във същия формат: {store_key: {име: "BGN"/"EUR"}}.
+        """
+        catalog = get_catalog()
+        chain = []
+        run = self.get_run(run_id)
+        while run:
+            chain.append(run)
+            run = self.get_run(run['base_run_id']) if run['scope'] and run['base_run_id'] else None
+        
+        all_prices = {}
+        all_currencies = {}
+        for run in reversed(chain):
+            run_prices = {}
+            run_currencies = {}
+            for row in self.conn.execute(
+                "SELECT product_id, store, raw_price, currency FROM observations WHERE run_id = ?", (run['id'],)
+            ):
+                record = catalog.get(row['product_id'])
+                if record:
+                    run_prices.setdefault(row['store'], {})[record.name] = row['raw_price']
+                    run_currencies.setdefault(row['store'], {})[record.name] = row['currency']
+            scope = json.loads(run['scope']) if run['scope'] else None
+            if scope:
+                all_prices = merge_run_prices(all_prices, run_prices, scope)
+                all_currencies = merge_run_prices(all_currencies, run_currencies, scope)
+            else:
+                all_prices, all_currencies = run_prices, run_currencies
+        if currencies is not None:
+            currencies.update(all_currencies)
+        return all_prices
+    
+    def results_for_run(self, run_id):
+        """Резултатите на стартиране (като collect_prices), изчислени наново от наблюденията."""
+        currencies = {}
+        prices = self.run_prices(run_id, currencies)
+        matrix = PriceMatrix.from_store_prices(prices, get_catalog(), STORES, currencies)
+        return matrix.to_results()
+
+
+_HISTORY_STORE = None
+
+
+def check_history_state(history):
+    """
+    Проверява локалната история преди стартиране. Липсваща или празна база
+    (напр. изгубен кеш/artifact в CI) не се приема мълчаливо за първо
+    стартиране - предупреждението се вижда и в GitHub Actions.
+    
+    Returns:
+        True ако историята има поне едно стартиране
+    """
+    if history is None:
+        message = f"Локалната история не може да се отвори ({HISTORY_DB_PATH})"
+    elif history.run_count():
+        run = history.get_run()
+        print(f"  [ИСТОРИЯ] {history.run_count()} стартирания, последно #{run['id']} от {run['started_at']}")
+        return True
+    elif history.existed:
+        message = f"Локалната история е празна ({HISTORY_DB_PATH})"
+    else:
+        message = f"Локалната история липсва ({HISTORY_DB_PATH})"
+    print(f"  [ИСТОРИЯ] ВНИМАНИЕ: {message} - седмичните сравнения, обобщението"
+          f" и частичните стартирания започват отначало")
+    if os.environ.get('GITHUB_ACTIONS'):
+        print(f"::warning title=Price history::{message}")
+    return False
+
+
+def get_history_store():
+    """Връща локалната история (None ако базата не може да се отвори)."""
+    global _HISTORY_STORE
+    if _HISTORY_STORE is None:
+        try:
+            _HISTORY_STORE = HistoryStore(HISTORY_DB_PATH)
+        except sqlite3.Error as e:
+            print(f"  [ИСТОРИЯ] Базата не е достъпна: {str(e)[:50]}")
+            return None
+    return _HISTORY_STORE
+
+
+# =============================================================================
+# GOOGLE SHEETS
+# =============================================================================
+
+def get_sheets_client():
+    """
+    gspread клиент от GOOGLE_CREDENTIALS.
+
+    HARMONICA_FAKE_SHEETS (":memory:" или път до JSON) подменя клиента с
+    fake_sheets.FakeSheetsClient за офлайн тестове.
+    """
+    fake_state = os.environ.get('HARMONICA_FAKE_SHEETS')
+    if fake_state:
+        from fake_sheets import FakeSheetsClient
+        return FakeSheetsClient(state_path=None if fake_state == ':memory:' else fake_state)
+
+    creds_json = os.environ.get('GOOGLE_CREDENTIALS')
+    if not creds_json:
+        raise ValueError("GOOGLE_CREDENTIALS не е зададена")
+    
+    import gspread
+    from google.oauth2.service_account import Credentials
+    
+    creds_dict = json.loads(creds_json)
+    scopes = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+    creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
+    client = gspread.authorize(creds)
+    # Без таймаут увиснала заявка държи изхода "sheets" до края на процеса
+    client.set_timeout(SHEETS_REQUEST_TIMEOUT)
+    return client
+
+
+def sheets_error_status(error):
+    """HTTP статусът на грешка от gspread (None за други грешки)."""
+    from gspread.exceptions import APIError
+    if isinstance(error, APIError):
+        return getattr(error, 'code', None)
+    return None
+
+
+def is_retryable_sheets_error(error):
+    """429 (квота), 5xx и мрежови грешки са временни и се повтарят."""
+    status = sheets_error_status(error)
+    if status is not None:
+        return status in SHEETS_RETRY_STATUSES
+    # requests.exceptions.ConnectionError/Timeout наследяват OSError
+    return isinstance(error, OSError)
+
+
+class SheetsGateway:
+    """
+    Единствената точка за заявки към Google Sheets в едно стартиране.
+    
+    - Записите се натрупват и се изпращат във flush() с минимален брой
+      извиквания: values.batchClear, един batchUpdate (структура и формати)
+      и по един values.batchUpdate за всяка value_input_option.
+    - Всяко извикване минава през локален брояч за последната минута
+      (SHEETS_QUOTA_PER_MINUTE за четене и запис) - при достигане на
+      лимита се изчаква, преди Sheets да върне 429.
+    - 429, 5xx и мрежови грешки се повтарят с експоненциално изчакване
+      с jitter (до SHEETS_MAX_RETRIES пъти, Retry-After се спазва).
+    """
+    
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self.windows = {"read": deque(), "write": deque()}
+        self.stats = {"read": 0, "write": 0, "retries": 0, "throttled_s": 0.0}
+        self._worksheets = None
+        self._reset_pending()
+    
+    @classmethod
+    def open(cls, client, spreadsheet_id):
+        """Отваря таблицата (с повторения) и връща gateway за нея."""
+        gateway = cls(None)
+        gateway.spreadsheet = gateway.call("read", client.open_by_key, spreadsheet_id)
+        return gateway
+    
+    def _reset_pending(self):
+        self.clear_ranges = []
+        self.requests = []
+        self.value_updates = {}  # value_input_option -> [{"range", "values"}]
+        self.callbacks = []
+    
+    def _throttle(self, kind):
+        """Изчаква, ако в последните 60 секунди вече са направени лимита заявки."""
+        window = self.windows[kind]
+        limit = SHEETS_QUOTA_PER_MINUTE[kind]
+        now = time.monotonic()
+        while window and now - window[0] >= 60:
+            window.popleft()
+        if len(window) >= limit:
+            wait = 60 - (now - window[0])
+            print(f"  [SHEETS] Лимит {limit}/мин ({kind}) - изчакване {wait:.1f}s")
+            time.sleep(wait)
+            self.stats["throttled_s"] += wait
+            now = time.monotonic()
+            while window and now - window[0] >= 60:
+                window.popleft()
+        window.append(now)
+    
+    def call(self, kind, fn, *args, **kwargs):
+        """
+        Изпълнява едно извикване към API-то с квота и повторения.
+        
+        Args:
+            kind: "read" или "write" (Sheets брои квотите поотделно)
+        """
+        for attempt in range(SHEETS_MAX_RETRIES + 1):
+            self._throttle(kind)
+            self.stats[kind] += 1
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt == SHEETS_MAX_RETRIES or not is_retryable_sheets_error(e):
+                    raise
+                # Експоненциално изчакване с пълен jitter
+                delay = random.uniform(0, min(SHEETS_RETRY_MAX_DELAY, SHEETS_RETRY_BASE_DELAY * 2 ** attempt))
+                response = getattr(e, 'response', None)
+                retry_after = getattr(response, 'headers', {}).get('Retry-After') if response is not None else None
+                if retry_after and str(retry_after).isdigit():
+                    delay = max(delay, float(retry_after))
+                self.stats["retries"] += 1
+                print(f"  [SHEETS] {sheets_error_status(e) or type(e).__name__} - повторение след {delay:.1f}s "
+                      f"({attempt + 1}/{SHEETS_MAX_RETRIES})")
+                time.sleep(delay)
+    
+    # -------------------------------------------------------------------------
+    # Листове
+    # -------------------------------------------------------------------------
+    
+    def worksheet(self, title):
+        """Лист по име (None ако няма). Всички листове се четат с една заявка."""
+        if self._worksheets is None:
+            self._worksheets = {ws.title: ws for ws in self.call("read", self.spreadsheet.worksheets)}
+        return self._worksheets.get(title)
+    
+    def add_worksheet(self, title, rows, cols):
+        """
+        Създава лист. Създаването не е идемпотентно: ако 5xx/429 дойде след
+        като листът вече е създаден, повторението първо чете листовете
+        и връща съществуващия, вместо да получи "already exists".
+        """
+        attempts = 0
+        
+        def create():
+            nonlocal attempts
+            attempts += 1
+            if attempts > 1:
+                existing = {ws.title: ws for ws in self.call("read", self.spreadsheet.worksheets)}.get(title)
+                if existing is not None:
+                    return existing
+            return self.spreadsheet.add_worksheet(title, rows=rows, cols=cols)
+        
+        sheet = self.call("write", create)
+        if self._worksheets is not None:
+            self._worksheets[title] = sheet
+        return sheet
+    
+    def fetch_sheet_metadata(self, params=None):
+        return self.call("read", self.spreadsheet.fetch_sheet_metadata, params=params)
+    
+    # -------------------------------------------------------------------------
+    # Натрупване на записи
+    # -------------------------------------------------------------------------
+    
+    def clear(self, sheet):
+        """Изчиства стойностите на листа (преди записите в същия flush)."""
+        from gspread.utils import absolute_range_name
+        self.clear_ranges.append(absolute_range_name(sheet.title))
+    
+    def update_values(self, sheet, range_name, values, value_input_option='RAW'):
+        from gspread.utils import absolute_range_name
+        self.value_updates.setdefault(value_input_option, []).append({
+            "range": absolute_range_name(sheet.title, range_name),
+            "values": values,
         })
     
-    # Показваме статистика за валутните корекции
-    print(f"  [ВАЛУТА] Корекции: {currency_corrections['EUR->BGN']} EUR→BGN, {currency_corrections['BGN']} BGN (без промяна)")
+    def add_requests(self, requests):
+        """Заявки за spreadsheets.batchUpdate (формати, редове, метаданни)."""
+        self.requests.extend(requests)
+    
+    def after_flush(self, callback):
+        """callback() се извиква само ако flush() изпрати всичко успешно."""
+        self.callbacks.append(callback)
+    
+    def savepoint(self):
+        """Текущото състояние на натрупаните записи (за rollback)."""
+        return (
+            len(self.clear_ranges),
+            len(self.requests),
+            {option: len(data) for option, data in self.value_updates.items()},
+            len(self.callbacks),
+        )
+    
+    def rollback(self, savepoint):
+        """Отказва записите, натрупани след savepoint (не са изпратени)."""
+        clear_count, request_count, value_counts, callback_count = savepoint
+        del self.clear_ranges[clear_count:]
+        del self.requests[request_count:]
+        for option in list(self.value_updates):
+            del self.value_updates[option][value_counts.get(option, 0):]
+            if not self.value_updates[option]:
+                del self.value_updates[option]
+        del self.callbacks[callback_count:]
+    
+    def flush(self):
+        """
+        Изпраща натрупаното: изчистване, batchUpdate, после стойностите.
+        
+        Returns:
+            брой направени извиквания за запис
+        """
+        writes = self.stats["write"]
+        try:
+            if self.clear_ranges:
+                self.call("write", self.spreadsheet.values_batch_clear, body={"ranges": self.clear_ranges})
+            if self.requests:
+                self.call("write", self.spreadsheet.batch_update, {"requests": self.requests})
+            for value_input_option, data in self.value_updates.items():
+                self.call("write", self.spreadsheet.values_batch_update,
+                          {"valueInputOption": value_input_option, "data": data})
+            callbacks = self.callbacks
+        finally:
+            self._reset_pending()
+        for callback in callbacks:
+            callback()
+        return self.stats["write"] - writes
+
+
+TRACKER_SHEET_NAME = "Ценови Тракер"
+TRACKER_HEADER_ROWS = 4  # Редове 1-4: заглавие, метаданни, празен, заглавия на колоните
+TRACKER_FORMAT_ROWS = 200  # Редове с форматиране и условни правила (с резерв за нови продукти)
+TRACKER_FORMAT_METADATA_KEY = "harmonica_tracker_format"
+
+# Колона на всеки магазин в "Ценови Тракер" (F-N)
+TRACKER_STORE_COLUMNS = {
+    'eBag': 5,       # F
+    'Kashon': 6,    # G
+    'Balev': 7,     # H
+    'Metro': 8,     # I
+    'Zelen': 9,     # J
+    'Randi': 10,    # K
+    'BioMarket': 11, # L
+    'BeFit': 12,    # M
+    'Laika': 13     # N
+}
+
+# Полетата на форматирането, които скриптът управлява във всяка клетка
+_MANAGED_FORMAT_FIELDS = "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)"
+
+
+def format_deviation(max_deviation):
+    """v9.1: Посоката на максималното отклонение с ↓/↑."""
+    if max_deviation is None:
+        return ''
+    return f"↓{abs(max_deviation)}%" if max_deviation < 0 else f"↑{max_deviation}%"
+
+
+def build_tracker_values(results, now):
+    """
+    Стойностите на "Ценови Тракер" като list от редове.
+    
+    Формат v7.7: Двойна валутна поддръжка (BGN + EUR) за преходния период
+    """
+    store_names = [s['name_in_sheet'] for s in STORES.values()]
+    
+    all_data = []
+    
+    # Ред 1: Заглавие
+    all_data.append(['HARMONICA - Ценови Тракер v9.1', '', '', '', '', '', '', '', '', '', '', '', '', '', '', '', '', ''])
+    
+    # Ред 2: Метаданни
+    all_data.append([
+        f'Актуализация: {now}', '', 
+        f'Курс: 1 EUR = {EUR_BGN_RATE} BGN', '',
+        f'Магазини: {", ".join(store_names)}', '', '', '', '', '', '', '', '', '', '', '', '', ''
+    ])
+    
+    # Ред 3: Празен
+    all_data.append([''] * 18)
+    
+    # Ред 4: Заглавия (18 колони) - BGN е основна, 9 магазина
+    headers = ['№', 'Продукт', 'Грамаж', 'Реф.BGN', 'Реф.EUR', 'eBag', 'Кашон', 'Balev', 'Metro', 'Zelen', 'Randi', 'Bio-Market', 'BeFit', 'Laika', 'Ср.BGN', 'Ср.EUR', 'Откл.%', 'Статус']
+    all_data.append(headers)
+    
+    # Ред 5+: Данни
+    for i, r in enumerate(results, 1):
+        row = [
+            i,
+            r['name'],
+            r['weight'],
+            r['ref_bgn'],
+            r['ref_eur'],
+            r['prices'].get('eBag', '') or '',
+            r['prices'].get('Kashon', '') or '',
+            r['prices'].get('Balev', '') or '',
+            r['prices'].get('Metro', '') or '',
+            r['prices'].get('Zelen', '') or '',
+            r['prices'].get('Randi', '') or '',
+            r['prices'].get('BioMarket', '') or '',
+            r['prices'].get('BeFit', '') or '',
+            r['prices'].get('Laika', '') or '',
+            r['avg_bgn'] if r['avg_bgn'] else '',
+            r['avg_eur'] if r['avg_eur'] else '',
+            format_deviation(r['max_deviation']),
+            r['status']
+        ]
+        all_data.append(row)
+    
+    return all_data
+
+
+def _paint(formats, rows, cols, fmt):
+    """
+    Прилага fmt върху клетките (като repeatCell): всяко поле от fmt
+    заменя изцяло същото поле в клетката.
+    """
+    for row_idx in rows:
+        for col_idx in cols:
+            formats.setdefault((row_idx, col_idx), {}).update(fmt)
+
+
+def build_tracker_static_formats():
+    """
+    Статичното форматиране на "Ценови Тракер" (слоевете от v8.7), което
+    не зависи от резултатите: заглавия, базов вид и подравняване на
+    TRACKER_FORMAT_ROWS реда, ширини на колоните.
+    
+    Returns:
+        tuple (formats, widths): formats е dict {(ред, колона): формат}
+        с 0-базирани индекси, widths - list с ширина за всяка колона
+    """
+    # Форматиране v8.7 - 18 колони с 9 магазина
+    # A=№, B=Продукт, C=Грамаж, D=Реф.BGN, E=Реф.EUR, F=eBag, G=Кашон, H=Balev, I=Metro, J=Zelen, K=Randi, L=Bio-Market, M=BeFit, N=Laika, O=Ср.BGN, P=Ср.EUR, Q=Откл.%, R=Статус
+    formats = {}
+    data_rows = range(TRACKER_HEADER_ROWS, TRACKER_FORMAT_ROWS)
+    
+    # 0. Базово форматиране на data редовете - изчиства и старото оцветяване по редове
+    _paint(formats, data_rows, range(18), {
+        "backgroundColor": {"red": 1, "green": 1, "blue": 1},
+        "textFormat": {"bold": False, "italic": False, "fontSize": 10, "foregroundColor": {"red": 0, "green": 0, "blue": 0}}
+    })
+    
+    # 1. Заглавен ред (A1:R1) - тъмно зелено
+    _paint(formats, [0], range(18), {
+        "backgroundColor": {"red": 0.13, "green": 0.35, "blue": 0.22},
+        "textFormat": {"bold": True, "fontSize": 14, "foregroundColor": {"red": 1, "green": 1, "blue": 1}},
+        "horizontalAlignment": "CENTER"
+    })
+    
+    # 2. Метаданни ред (A2:R2) - светло зелено
+    _paint(formats, [1], range(18), {
+        "backgroundColor": {"red": 0.92, "green": 0.97, "blue": 0.92},
+        "textFormat": {"italic": True, "fontSize": 10}
+    })
+    
+    # 3. Заглавия колони A-E (№, Продукт, Грамаж, Реф.BGN, Реф.EUR) и
+    # 5. O-R (Ср.BGN, Ср.EUR, Откл.%, Статус) - базово зелено
+    header_format = {
+        "textFormat": {"bold": True, "foregroundColor": {"red": 1, "green": 1, "blue": 1}},
+        "horizontalAlignment": "CENTER"
+    }
+    _paint(formats, [3], list(range(0, 5)) + list(range(14, 18)),
+           dict(header_format, backgroundColor={"red": 0.2, "green": 0.5, "blue": 0.3}))
+    
+    # 4. Магазини заглавия F-N (9 магазина) - различни нюанси зелено
+    store_colors = [
+        (5, {"red": 0.56, "green": 0.77, "blue": 0.49}),   # F: eBag
+        (6, {"red": 0.42, "green": 0.68, "blue": 0.42}),   # G: Кашон
+        (7, {"red": 0.30, "green": 0.58, "blue": 0.35}),   # H: Balev
+        (8, {"red": 0.20, "green": 0.48, "blue": 0.28}),   # I: Metro
+        (9, {"red": 0.45, "green": 0.70, "blue": 0.55}),   # J: Zelen
+        (10, {"red": 0.35, "green": 0.62, "blue": 0.45}),  # K: Randi
+        (11, {"red": 0.50, "green": 0.73, "blue": 0.52}),  # L: Bio-Market
+        (12, {"red": 0.40, "green": 0.65, "blue": 0.48}),  # M: BeFit
+        (13, {"red": 0.32, "green": 0.60, "blue": 0.40}),  # N: Laika
+    ]
+    for col_idx, bg_color in store_colors:
+        _paint(formats, [3], [col_idx], dict(header_format, backgroundColor=bg_color))
+    
+    # 7. Подравняване на данните
+    # A (№) и C (Грамаж) - център, B (Продукт) - ляво, D-N (Реф. и магазини)
+    # и O-Q (Ср.BGN, Ср.EUR, Откл.%) - дясно, R (Статус) - център
+    for cols, alignment in [([0, 2], "CENTER"), ([1], "LEFT"), (list(range(3, 17)), "RIGHT"), ([17], "CENTER")]:
+        _paint(formats, data_rows, cols, {"horizontalAlignment": alignment})
+    
+    # 10. Ширини на колоните (18 колони за 9 магазина)
+    # A: №, B: Продукт, C: Грамаж, D-E: Реф., F-N: магазини, O-P: Ср., Q: Откл.%, R: Статус
+    widths = [35, 270, 60, 65, 65, 50, 50, 50, 50, 50, 50, 55, 50, 50, 60, 60, 55, 80]
+    
+    return formats, widths
+
+
+def _conditional_rule(sheet_id, column_spans, formula, fmt):
+    """Условно правило CUSTOM_FORMULA за data редовете на колоните column_spans."""
+    return {
+        "ranges": [
+            {"sheetId": sheet_id, "startRowIndex": TRACKER_HEADER_ROWS, "endRowIndex": TRACKER_FORMAT_ROWS,
+             "startColumnIndex": start_col, "endColumnIndex": end_col}
+            for start_col, end_col in column_spans
+        ],
+        "booleanRule": {
+            "condition": {"type": "CUSTOM_FORMULA", "values": [{"userEnteredValue": formula}]},
+            "format": fmt
+        }
+    }
+
+
+def build_tracker_conditional_rules(sheet_id):
+    """
+    Оцветяването по статус и по отклонение като условни правила на листа.
+    
+    Формулите са за първия data ред (ред 5) и се изместват за останалите.
+    При няколко съвпадащи правила Sheets прилага първото, затова
+    редът следва приоритета на слоевете от v9.0: аномалии, статус, фон на магазините.
+    """
+    first_row = TRACKER_HEADER_ROWS + 1
+    status = f'$R{first_row}'
+    rules = []
+    
+    # 9. v9.0: Ценови аномалии (>ALERT_THRESHOLD% отклонение от средната цена)
+    # Средната се смята от цените F-N (Ср.BGN е закръглена), отклонението - до 0.1%
+    average = f'AVERAGE($F{first_row}:$N{first_row})'
+    deviation = f'ROUND((F{first_row}-{average})/{average}*100,1)'
+    has_prices = f'ISNUMBER(F{first_row})'
+    # По-скъпо от средната - червено
+    rules.append(_conditional_rule(sheet_id, [(5, 14)], f'=AND({has_prices},{deviation}>{ALERT_THRESHOLD})', {
+        "backgroundColor": {"red": 1, "green": 0.85, "blue": 0.85},
+        "textFormat": {"bold": True, "foregroundColor": {"red": 0.7, "green": 0, "blue": 0}}
+    }))
+    # По-евтино от средната - синьо/зелено
+    rules.append(_conditional_rule(sheet_id, [(5, 14)], f'=AND({has_prices},{deviation}<-{ALERT_THRESHOLD})', {
+        "backgroundColor": {"red": 0.85, "green": 0.95, "blue": 1},
+        "textFormat": {"bold": True, "foregroundColor": {"red": 0, "green": 0.4, "blue": 0.7}}
+    }))
+    
+    # 8. Статус
+    # OK - зелен статус (R) и светлозелени средни цени (O-P)
+    rules.append(_conditional_rule(sheet_id, [(17, 18)], f'={status}="OK"', {
+        "backgroundColor": {"red": 0.85, "green": 0.95, "blue": 0.85},
+        "textFormat": {"bold": True, "foregroundColor": {"red": 0, "green": 0.5, "blue": 0}}
+    }))
+    rules.append(_conditional_rule(sheet_id, [(14, 16)], f'={status}="OK"', {
+        "backgroundColor": {"red": 0.9, "green": 0.97, "blue": 0.9},
+        "textFormat": {"foregroundColor": {"red": 0.1, "green": 0.4, "blue": 0.1}}
+    }))
+    # ВНИМАНИЕ - червен статус (R), средни цени (O-P), Откл.% (Q) и лек червен фон на A-E
+    rules.append(_conditional_rule(sheet_id, [(17, 18)], f'={status}="ВНИМАНИЕ"', {
+        "backgroundColor": {"red": 1, "green": 0.85, "blue": 0.85},
+        "textFormat": {"bold": True, "foregroundColor": {"red": 0.8, "green": 0, "blue": 0}}
+    }))
+    rules.append(_conditional_rule(sheet_id, [(14, 16)], f'={status}="ВНИМАНИЕ"', {
+        "backgroundColor": {"red": 1, "green": 0.92, "blue": 0.92},
+        "textFormat": {"foregroundColor": {"red": 0.7, "green": 0.1, "blue": 0.1}}
+    }))
+    rules.append(_conditional_rule(sheet_id, [(16, 17)], f'={status}="ВНИМАНИЕ"', {
+        "backgroundColor": {"red": 1, "green": 0.92, "blue": 0.92},
+        "textFormat": {"bold": True, "foregroundColor": {"red": 0.7, "green": 0, "blue": 0}}
+    }))
+    rules.append(_conditional_rule(sheet_id, [(0, 5)], f'={status}="ВНИМАНИЕ"', {
+        "backgroundColor": {"red": 1, "green": 0.95, "blue": 0.95}
+    }))
+    # НЯМА ДАННИ - сив ред
+    rules.append(_conditional_rule(sheet_id, [(0, 18)], f'={status}="НЯМА ДАННИ"', {
+        "backgroundColor": {"red": 0.95, "green": 0.95, "blue": 0.95},
+        "textFormat": {"italic": True, "foregroundColor": {"red": 0.5, "green": 0.5, "blue": 0.5}}
+    }))
+    
+    # 6. Фон на магазин колоните (F-N) - леки нюанси зелено, само за редове с продукт
+    store_data_colors = [
+        (5, {"red": 0.92, "green": 0.97, "blue": 0.90}),   # F: eBag
+        (6, {"red": 0.88, "green": 0.95, "blue": 0.87}),   # G: Кашон
+        (7, {"red": 0.84, "green": 0.93, "blue": 0.84}),   # H: Balev
+        (8, {"red": 0.80, "green": 0.91, "blue": 0.81}),   # I: Metro
+        (9, {"red": 0.90, "green": 0.96, "blue": 0.88}),   # J: Zelen
+        (10, {"red": 0.86, "green": 0.94, "blue": 0.85}),  # K: Randi
+        (11, {"red": 0.88, "green": 0.95, "blue": 0.86}),  # L: Bio-Market
+        (12, {"red": 0.84, "green": 0.93, "blue": 0.83}),  # M: BeFit
+        (13, {"red": 0.82, "green": 0.92, "blue": 0.82}),  # N: Laika
+    ]
+    for col_idx, bg_color in store_data_colors:
+        rules.append(_conditional_rule(sheet_id, [(col_idx, col_idx + 1)], f'=$B{first_row}<>""', {
+            "backgroundColor": bg_color
+        }))
+    
+    return rules
+
+
+def apply_tracker_formatting(gateway, sheet, force=False):
+    """
+    Прилага форматирането на "Ценови Тракер" само ако версията му е променена.
+    
+    Статичните формати, условните правила и ширините се хешират; хешът се
+    пази в developer metadata на листа (TRACKER_FORMAT_METADATA_KEY). При
+    съвпадение не се изпраща нищо, иначе старите условни правила се
+    заменят и всичко се добавя в batchUpdate на gateway.
+    
+    Returns:
+        брой операции (0 ако форматирането е актуално)
+    """
+    formats, widths = build_tracker_static_formats()
+    layout_requests = diff_sheet_formats({}, formats, sheet.id)
+    layout_requests += [
+        {"addConditionalFormatRule": {"rule": rule, "index": index}}
+        for index, rule in enumerate(build_tracker_conditional_rules(sheet.id))
+    ]
+    layout_requests += diff_column_widths([], widths, sheet.id)
+    fingerprint = hashlib.sha256(json.dumps(layout_requests, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    
+    metadata = gateway.fetch_sheet_metadata(
+        params={"fields": "sheets(properties(sheetId,gridProperties),conditionalFormats,developerMetadata)"}
+    )
+    sheet_metadata = next(
+        (s for s in metadata.get('sheets', []) if s.get('properties', {}).get('sheetId') == sheet.id), {}
+    )
+    stored = [
+        m for m in sheet_metadata.get('developerMetadata', [])
+        if m.get('metadataKey') == TRACKER_FORMAT_METADATA_KEY
+    ]
+    if stored and stored[0].get('metadataValue') == fingerprint and not force:
+        return 0
+    
+    # Листът трябва да побира TRACKER_FORMAT_ROWS реда и 18 колони
+    requests = []
+    grid = sheet_metadata.get('properties', {}).get('gridProperties', {})
+    for dimension, count, needed in (("ROWS", grid.get('rowCount', sheet.row_count), TRACKER_FORMAT_ROWS),
+                                     ("COLUMNS", grid.get('columnCount', sheet.col_count), len(widths))):
+        if count < needed:
+            requests.append({"appendDimension": {"sheetId": sheet.id, "dimension": dimension, "length": needed - count}})
+    
+    # Старите условни правила се изтриват (индексите се изместват след всяко изтриване)
+    requests += [
+        {"deleteConditionalFormatRule": {"sheetId": sheet.id, "index": 0}}
+        for _ in sheet_metadata.get('conditionalFormats', [])
+    ]
+    requests += layout_requests
+    if stored:
+        requests.append({
+            "updateDeveloperMetadata": {
+                "dataFilters": [{"developerMetadataLookup": {"metadataId": stored[0]['metadataId']}}],
+                "developerMetadata": {"metadataValue": fingerprint},
+                "fields": "metadataValue"
+            }
+        })
+    else:
+        requests.append({
+            "createDeveloperMetadata": {
+                "developerMetadata": {
+                    "metadataKey": TRACKER_FORMAT_METADATA_KEY,
+                    "metadataValue": fingerprint,
+                    "location": {"sheetId": sheet.id},
+                    "visibility": "DOCUMENT"
+                }
+            }
+        })
+    
+    gateway.add_requests(requests)
+    return len(requests)
+
+
+def coalesce_cells(cells):
+    """
+    Обединява клетки в правоъгълни диапазони: последователните колони
+    в ред стават отсечки, а еднаквите отсечки в съседни редове - един диапазон.
+    
+    Returns:
+        list от (start_row, end_row, start_col, end_col), 0-базирани, краят не е включен
+    """
+    by_row = {}
+    for row_idx, col_idx in cells:
+        by_row.setdefault(row_idx, []).append(col_idx)
+    
+    ranges = []
+    open_ranges = {}  # (start_col, end_col) -> [start_row, end_row]
+    for row_idx in sorted(by_row):
+        runs = []
+        for col_idx in sorted(by_row[row_idx]):
+            if runs and runs[-1][1] == col_idx:
+                runs[-1][1] = col_idx + 1
+            else:
+                runs.append([col_idx, col_idx + 1])
+        
+        still_open = {}
+        for start_col, end_col in runs:
+            span = open_ranges.pop((start_col, end_col), None)
+            if span and span[1] == row_idx:
+                span[1] = row_idx + 1
+            else:
+                if span:
+                    ranges.append((span[0], span[1], start_col, end_col))
+                span = [row_idx, row_idx + 1]
+            still_open[(start_col, end_col)] = span
+        ranges.extend((span[0], span[1], cols[0], cols[1]) for cols, span in open_ranges.items())
+        open_ranges = still_open
+    ranges.extend((span[0], span[1], cols[0], cols[1]) for cols, span in open_ranges.items())
+    return ranges
+
+
+def range_to_a1(start_row, end_row, start_col, end_col):
+    """0-базиран диапазон (краят не е включен) -> A1 нотация."""
+    from gspread.utils import rowcol_to_a1
+    start = rowcol_to_a1(start_row + 1, start_col + 1)
+    end = rowcol_to_a1(end_row, end_col)
+    return start if start == end else start + ':' + end
+
+
+def diff_sheet_values(old_values, new_values):
+    """
+    Промените спрямо последно записаните стойности, обединени в диапазони.
+    Редовете/клетките, които вече ги няма, се изчистват с ''.
+    
+    Returns:
+        list от {"range": A1, "values": редове} за worksheet.batch_update
+    """
+    rows = max(len(old_values), len(new_values))
+    cols = max([len(row) for row in old_values] + [len(row) for row in new_values] + [0])
+    
+    def padded(values):
+        return [list(row) + [''] * (cols - len(row)) for row in values] + [[''] * cols] * (rows - len(values))
+    
+    old_grid, new_grid = padded(old_values), padded(new_values)
+    changed = [
+        (row_idx, col_idx)
+        for row_idx in range(rows)
+        for col_idx in range(cols)
+        if old_grid[row_idx][col_idx] != new_grid[row_idx][col_idx]
+    ]
+    return [
+        {
+            "range": range_to_a1(start_row, end_row, start_col, end_col),
+            "values": [row[start_col:end_col] for row in new_grid[start_row:end_row]],
+        }
+        for start_row, end_row, start_col, end_col in coalesce_cells(changed)
+    ]
+
+
+def diff_sheet_formats(old_formats, new_formats, sheet_id):
+    """
+    repeatCell заявки само за клетките с променено форматиране.
+    Клетките с еднакъв нов формат се обединяват в диапазони; клетките,
+    които вече не се управляват (изтрити редове), се връщат към подразбиране.
+    """
+    groups = {}
+    for cell in set(old_formats) | set(new_formats):
+        fmt = new_formats.get(cell, {})
+        if old_formats.get(cell) != fmt:
+            key = json.dumps(fmt, sort_keys=True)
+            groups.setdefault(key, (fmt, []))[1].append(cell)
+    
+    requests = []
+    for fmt, cells in groups.values():
+        for start_row, end_row, start_col, end_col in coalesce_cells(cells):
+            requests.append({
+                "repeatCell": {
+                    "range": {"sheetId": sheet_id, "startRowIndex": start_row, "endRowIndex": end_row, "startColumnIndex": start_col, "endColumnIndex": end_col},
+                    "cell": {"userEnteredFormat": fmt},
+                    "fields": _MANAGED_FORMAT_FIELDS
+                }
+            })
+    return requests
+
+
+def diff_column_widths(old_widths, new_widths, sheet_id):
+    """updateDimensionProperties за променените ширини (съседните еднакви - заедно)."""
+    requests = []
+    for col_idx, width in enumerate(new_widths):
+        if col_idx < len(old_widths) and old_widths[col_idx] == width:
+            continue
+        last = requests[-1]["updateDimensionProperties"] if requests else None
+        if last and last["range"]["endIndex"] == col_idx and last["properties"]["pixelSize"] == width:
+            last["range"]["endIndex"] = col_idx + 1
+            continue
+        requests.append({
+            "updateDimensionProperties": {
+                "range": {"sheetId": sheet_id, "dimension": "COLUMNS", "startIndex": col_idx, "endIndex": col_idx + 1},
+                "properties": {"pixelSize": width},
+                "fields": "pixelSize"
+            }
+        })
+    return requests
+
+
+def _snapshot_key(spreadsheet_id, sheet):
+    return f"{spreadsheet_id}/{sheet.id}"
+
+
+def load_sheet_snapshot(spreadsheet_id, sheet):
+    """
+    Локалното състояние на листа или None ако няма снимка за този лист:
+    {"values": ...} за листовете, записвани с diff, {"rows": ...} за
+    табовете с история.
+    """
+    try:
+        with open(SHEETS_SNAPSHOT_PATH, encoding='utf-8') as f:
+            entry = json.load(f).get(_snapshot_key(spreadsheet_id, sheet))
+    except (OSError, ValueError):
+        return None
+    return entry or None
+
+
+def save_sheet_snapshot(spreadsheet_id, sheet, snapshot):
+    """Записва състоянието на листа в SHEETS_SNAPSHOT_PATH (атомарно)."""
+    try:
+        with open(SHEETS_SNAPSHOT_PATH, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    data[_snapshot_key(spreadsheet_id, sheet)] = snapshot
+    try:
+        os.makedirs(os.path.dirname(SHEETS_SNAPSHOT_PATH) or '.', exist_ok=True)
+        tmp_path = SHEETS_SNAPSHOT_PATH + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, SHEETS_SNAPSHOT_PATH)
+    except OSError as e:
+        print(f"  Снимката на листа не е записана: {str(e)[:50]}")
+
+
+def write_sheet_values(gateway, spreadsheet_id, sheet, values, full=False):
+    """
+    Добавя в gateway записа на стойностите на листа - само промените
+    спрямо снимката. Без снимка (или при full) листът се изчиства и
+    записва изцяло от A1. Снимката се обновява след успешен flush.
     
-    return results
+    Returns:
+        tuple (клетки, диапазони)
+    """
+    snapshot = None if full else load_sheet_snapshot(spreadsheet_id, sheet)
+    if snapshot is None or 'values' not in snapshot:
+        gateway.clear(sheet)
+        if snapshot is not None:
+            # Изчистването може да мине, а записът не - старата снимка вече не важи
+            save_sheet_snapshot(spreadsheet_id, sheet, None)
+        print(f"  Лист '{sheet.title}' - пълен запис")
+        value_updates = [{"range": "A1", "values": values}]
+    else:
+        value_updates = diff_sheet_values(snapshot['values'], values)
+    for update in value_updates:
+        gateway.update_values(sheet, update['range'], update['values'])
+    gateway.after_flush(lambda: save_sheet_snapshot(spreadsheet_id, sheet, {"values": values}))
+    cells = sum(len(update['values']) * len(update['values'][0]) for update in value_updates if update['values'])
+    return cells, len(value_updates)
 
 
-# =============================================================================
-# GOOGLE SHEETS
-# =============================================================================
+def history_tab_name(moment):
+    """Таб с историята за момента: "История_2026_Q4" (по тримесечия) или "История_2026"."""
+    if HISTORY_PARTITION == "quarter":
+        return f"История_{moment.year}_Q{(moment.month - 1) // 3 + 1}"
+    return f"История_{moment.year}"
 
-def get_sheets_client():
-    creds_json = os.environ.get('GOOGLE_CREDENTIALS')
-    if not creds_json:
-        raise ValueError("GOOGLE_CREDENTIALS не е зададена")
+
+def append_history_rows(gateway, spreadsheet_id, tab_name, hist_rows):
+    """
+    Добавя редове в таб с история на изричен диапазон след последния ред.
     
-    creds_dict = json.loads(creds_json)
-    scopes = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-    creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-    return gspread.authorize(creds)
+    Броят редове на таба се пази локално (в снимката), така че
+    листът не се чете. Без локален брой (нов кеш) броят се чете
+    веднъж от колона A. Записът отива в общия flush на gateway-а,
+    заедно с отбелязването на синхронизираните стартирания.
+    """
+    hist = gateway.worksheet(tab_name)
+    if hist is None:
+        hist = gateway.add_worksheet(tab_name, rows=HISTORY_TAB_ROWS, cols=len(HISTORY_HEADERS))
+        print(f"  ✓ Създаден нов таб '{tab_name}'")
+        rows = 0
+    else:
+        rows = (load_sheet_snapshot(spreadsheet_id, hist) or {}).get('rows')
+        if rows is None or SHEETS_FORCE_FULL_WRITE:
+            rows = len(gateway.call("read", hist.col_values, 1))
+    
+    # Празен таб (нов или от прекъснат запис) - заглавен ред
+    if rows == 0:
+        gateway.update_values(hist, 'A1', [HISTORY_HEADERS])
+        gateway.add_requests([{
+            "updateSheetProperties": {
+                "properties": {"sheetId": hist.id, "gridProperties": {"frozenRowCount": 1}},
+                "fields": "gridProperties.frozenRowCount"
+            }
+        }])
+        rows = 1
+    
+    needed = rows + len(hist_rows)
+    if needed > hist.row_count:
+        gateway.add_requests([{
+            "appendDimension": {"sheetId": hist.id, "dimension": "ROWS", "length": needed - hist.row_count + HISTORY_TAB_ROWS}
+        }])
+    gateway.update_values(hist, f"A{rows + 1}", hist_rows, value_input_option='USER_ENTERED')
+    gateway.after_flush(lambda: save_sheet_snapshot(spreadsheet_id, hist, {"rows": needed}))
+    print(f"  ✓ {tab_name}: {len(hist_rows)} записа (общо {needed - 1})")
+
+
+HISTORY_SUMMARY_HEADERS = ['№', 'Продукт', 'Грамаж', 'Последна Ср.BGN', 'Ср. 4 седм.', 'Ср. 13 седм.', 'Мин 13 седм.', 'Макс 13 седм.', 'Промяна 7 дни %', 'Стартирания']
+
+
+def build_history_summary_values(history, now=None):
+    """Стойностите на таба с обобщението от локалната история (product_summary)."""
+    now = now or datetime.now()
+    values = [
+        [f'HARMONICA - История (обобщение) · Актуализация: {now.strftime("%d.%m.%Y %H:%M")}'] + [''] * (len(HISTORY_SUMMARY_HEADERS) - 1),
+        HISTORY_SUMMARY_HEADERS,
+    ]
+    summary = history.product_summary(now=now)
+    for i, record in enumerate(get_catalog(), 1):
+        stats = summary.get(record.id)
+        if not stats:
+            values.append([i, record.name, record.weight] + [''] * 7)
+            continue
+        values.append([
+            i, record.name, record.weight,
+            stats['last_bgn'],
+            stats['avg_4w'] if stats['avg_4w'] is not None else '',
+            stats['avg_13w'],
+            stats['min_13w'],
+            stats['max_13w'],
+            stats['change_7d_pct'] if stats['change_7d_pct'] is not None else '',
+            stats['runs'],
+        ])
+    return values
+
+
+HISTORY_HEADERS = ['Дата', 'Час', 'Продукт', 'Грамаж', 'eBag', 'Кашон', 'Balev', 'Metro', 'Zelen', 'Randi', 'Bio-Market', 'BeFit', 'Laika', 'Ср.BGN', 'Ср.EUR', 'Откл.%', 'Статус']
+
+
+def build_history_rows(results, moment):
+    """Редовете за таба с история (history_tab_name) за едно стартиране."""
+    date_str = moment.strftime("%d.%m.%Y")
+    time_str = moment.strftime("%H:%M")
+    
+    hist_rows = []
+    for r in results:
+        hist_rows.append([
+            date_str, time_str, r['name'], r['weight'],
+            r['prices'].get('eBag', '') or '',
+            r['prices'].get('Kashon', '') or '',
+            r['prices'].get('Balev', '') or '',
+            r['prices'].get('Metro', '') or '',
+            r['prices'].get('Zelen', '') or '',
+            r['prices'].get('Randi', '') or '',
+            r['prices'].get('BioMarket', '') or '',
+            r['prices'].get('BeFit', '') or '',
+            r['prices'].get('Laika', '') or '',
+            r['avg_bgn'] if r['avg_bgn'] else '',
+            r['avg_eur'] if r['avg_eur'] else '',
+            # v9.1: Посока на отклонението
+            format_deviation(r['max_deviation']),
+            r['status']
+        ])
+    return hist_rows
 
 
 def update_google_sheets(results):
@@ -1931,509 +5546,135 @@ def update_google_sheets(results):
     
     Формат v7.7: Двойна валутна поддръжка (BGN + EUR) за преходния период
     Колони: №, Продукт, Грамаж, Реф.BGN, Реф.EUR, eBag, Кашон, Balev, Metro, Ср.BGN, Ср.EUR, Откл.%, Статус
+    
+    Записват се само промените спрямо локалната снимка на последния запис
+    (SHEETS_SNAPSHOT_PATH): променените клетки, обединени в диапазони. Без
+    снимка (или при SHEETS_FORCE_FULL_WRITE) листът се изчиства и записва изцяло.
+    Оцветяването по статус и отклонение е с условни правила на листа, които
+    се изпращат само при промяна на версията на форматирането.
+    
+    Всички заявки минават през SheetsGateway: записите се изпращат накрая
+    с няколко batch извиквания, а локалните снимки и синхронизацията на
+    историята се отбелязват само след успешен запис.
+    
+    Грешка в историята или обобщението не спира записа на тракера, но
+    функцията завършва с RuntimeError - изходът "sheets" не е успешен.
     """
     spreadsheet_id = os.environ.get('SPREADSHEET_ID')
     if not spreadsheet_id:
         print("SPREADSHEET_ID не е зададен")
         return
     
+    failures = []
     try:
         gc = get_sheets_client()
-        spreadsheet = gc.open_by_key(spreadsheet_id)
-        
-        try:
-            sheet = spreadsheet.worksheet("Ценови Тракер")
-        except:
-            sheet = spreadsheet.add_worksheet("Ценови Тракер", rows=30, cols=15)
+        gateway = SheetsGateway.open(gc, spreadsheet_id)
         
-        sheet.clear()
-        print("  Лист изчистен")
+        sheet = gateway.worksheet(TRACKER_SHEET_NAME)
+        created = sheet is None
+        if created:
+            sheet = gateway.add_worksheet(TRACKER_SHEET_NAME, rows=TRACKER_FORMAT_ROWS, cols=18)
         
         now = datetime.now().strftime("%d.%m.%Y %H:%M")
-        store_names = [s['name_in_sheet'] for s in STORES.values()]
-        
-        all_data = []
-        
-        # Ред 1: Заглавие
-        all_data.append(['HARMONICA - Ценови Тракер v9.1', '', '', '', '', '', '', '', '', '', '', '', '', '', '', '', '', ''])
+        all_data = build_tracker_values(results, now)
         
-        # Ред 2: Метаданни
-        all_data.append([
-            f'Актуализация: {now}', '', 
-            f'Курс: 1 EUR = {EUR_BGN_RATE} BGN', '',
-            f'Магазини: {", ".join(store_names)}', '', '', '', '', '', '', '', '', '', '', '', '', ''
-        ])
-        
-        # Ред 3: Празен
-        all_data.append([''] * 18)
-        
-        # Ред 4: Заглавия (18 колони) - BGN е основна, 9 магазина
-        headers = ['№', 'Продукт', 'Грамаж', 'Реф.BGN', 'Реф.EUR', 'eBag', 'Кашон', 'Balev', 'Metro', 'Zelen', 'Randi', 'Bio-Market', 'BeFit', 'Laika', 'Ср.BGN', 'Ср.EUR', 'Откл.%', 'Статус']
-        all_data.append(headers)
-        
-        # Ред 5+: Данни
-        for i, r in enumerate(results, 1):
-            row = [
-                i,
-                r['name'],
-                r['weight'],
-                r['ref_bgn'],
-                r['ref_eur'],
-                r['prices'].get('eBag', '') or '',
-                r['prices'].get('Kashon', '') or '',
-                r['prices'].get('Balev', '') or '',
-                r['prices'].get('Metro', '') or '',
-                r['prices'].get('Zelen', '') or '',
-                r['prices'].get('Randi', '') or '',
-                r['prices'].get('BioMarket', '') or '',
-                r['prices'].get('BeFit', '') or '',
-                r['prices'].get('Laika', '') or '',
-                r['avg_bgn'] if r['avg_bgn'] else '',
-                r['avg_eur'] if r['avg_eur'] else '',
-                # v9.1: Показваме посоката на максималното отклонение с ↓/↑
-                (f"↓{abs(r['max_deviation'])}%" if r['max_deviation'] < 0 else f"↑{r['max_deviation']}%") if r['max_deviation'] is not None else '',
-                r['status']
-            ]
-            all_data.append(row)
-        
-        sheet.update(values=all_data, range_name='A1')
-        print(f"  ✓ Записани {len(all_data)} реда")
+        cells, ranges = write_sheet_values(gateway, spreadsheet_id, sheet, all_data, full=SHEETS_FORCE_FULL_WRITE or created)
+        print(f"  ✓ Ценови Тракер: {cells} клетки в {ranges} диапазона ({len(all_data)} реда)")
         
-        # Форматиране v8.7 - 18 колони с 9 магазина
-        # A=№, B=Продукт, C=Грамаж, D=Реф.BGN, E=Реф.EUR, F=eBag, G=Кашон, H=Balev, I=Metro, J=Zelen, K=Randi, L=Bio-Market, M=BeFit, N=Laika, O=Ср.BGN, P=Ср.EUR, Q=Откл.%, R=Статус
+        # Форматиране - само при нова версия на оформлението
         try:
-            last_row = 4 + len(results)
-            format_requests = []
-            
-            # 0. ИЗЧИСТВАНЕ на форматирането за data редовете (ред 5 до края)
-            # Това гарантира, че старо форматиране от предишни изпълнения няма да остане
-            format_requests.append({
-                "repeatCell": {
-                    "range": {"sheetId": sheet.id, "startRowIndex": 4, "endRowIndex": last_row, "startColumnIndex": 0, "endColumnIndex": 18},
-                    "cell": {
-                        "userEnteredFormat": {
-                            "backgroundColor": {"red": 1, "green": 1, "blue": 1},
-                            "textFormat": {"bold": False, "italic": False, "fontSize": 10, "foregroundColor": {"red": 0, "green": 0, "blue": 0}}
-                        }
-                    },
-                    "fields": "userEnteredFormat(backgroundColor,textFormat)"
-                }
-            })
-            
-            # 1. Заглавен ред (A1:R1) - тъмно зелено
-            format_requests.append({
-                "repeatCell": {
-                    "range": {"sheetId": sheet.id, "startRowIndex": 0, "endRowIndex": 1, "startColumnIndex": 0, "endColumnIndex": 18},
-                    "cell": {
-                        "userEnteredFormat": {
-                            "backgroundColor": {"red": 0.13, "green": 0.35, "blue": 0.22},
-                            "textFormat": {"bold": True, "fontSize": 14, "foregroundColor": {"red": 1, "green": 1, "blue": 1}},
-                            "horizontalAlignment": "CENTER"
-                        }
-                    },
-                    "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)"
-                }
-            })
-            
-            # 2. Метаданни ред (A2:R2) - светло зелено
-            format_requests.append({
-                "repeatCell": {
-                    "range": {"sheetId": sheet.id, "startRowIndex": 1, "endRowIndex": 2, "startColumnIndex": 0, "endColumnIndex": 18},
-                    "cell": {
-                        "userEnteredFormat": {
-                            "backgroundColor": {"red": 0.92, "green": 0.97, "blue": 0.92},
-                            "textFormat": {"italic": True, "fontSize": 10}
-                        }
-                    },
-                    "fields": "userEnteredFormat(backgroundColor,textFormat)"
-                }
-            })
-            
-            # 3. Заглавия колони A-E (№, Продукт, Грамаж, Реф.BGN, Реф.EUR) - базово зелено
-            format_requests.append({
-                "repeatCell": {
-                    "range": {"sheetId": sheet.id, "startRowIndex": 3, "endRowIndex": 4, "startColumnIndex": 0, "endColumnIndex": 5},
-                    "cell": {
-                        "userEnteredFormat": {
-                            "backgroundColor": {"red": 0.2, "green": 0.5, "blue": 0.3},
-                            "textFormat": {"bold": True, "foregroundColor": {"red": 1, "green": 1, "blue": 1}},
-                            "horizontalAlignment": "CENTER"
-                        }
-                    },
-                    "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)"
-                }
-            })
-            
-            # 4. Магазини заглавия F-N (9 магазина) - различни нюанси зелено
-            store_colors = [
-                (5, {"red": 0.56, "green": 0.77, "blue": 0.49}),   # F: eBag
-                (6, {"red": 0.42, "green": 0.68, "blue": 0.42}),   # G: Кашон
-                (7, {"red": 0.30, "green": 0.58, "blue": 0.35}),   # H: Balev
-                (8, {"red": 0.20, "green": 0.48, "blue": 0.28}),   # I: Metro
-                (9, {"red": 0.45, "green": 0.70, "blue": 0.55}),   # J: Zelen
-                (10, {"red": 0.35, "green": 0.62, "blue": 0.45}),  # K: Randi
-                (11, {"red": 0.50, "green": 0.73, "blue": 0.52}),  # L: Bio-Market
-                (12, {"red": 0.40, "green": 0.65, "blue": 0.48}),  # M: BeFit
-                (13, {"red": 0.32, "green": 0.60, "blue": 0.40}),  # N: Laika
-            ]
-            for col_idx, bg_color in store_colors:
-                format_requests.append({
-                    "repeatCell": {
-                        "range": {"sheetId": sheet.id, "startRowIndex": 3, "endRowIndex": 4, "startColumnIndex": col_idx, "endColumnIndex": col_idx + 1},
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": bg_color,
-                                "textFormat": {"bold": True, "foregroundColor": {"red": 1, "green": 1, "blue": 1}},
-                                "horizontalAlignment": "CENTER"
-                            }
-                        },
-                        "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)"
-                    }
-                })
-            
-            # 5. Обобщение заглавия O-R (Ср.BGN, Ср.EUR, Откл.%, Статус) - базово зелено
-            format_requests.append({
-                "repeatCell": {
-                    "range": {"sheetId": sheet.id, "startRowIndex": 3, "endRowIndex": 4, "startColumnIndex": 14, "endColumnIndex": 18},
-                    "cell": {
-                        "userEnteredFormat": {
-                            "backgroundColor": {"red": 0.2, "green": 0.5, "blue": 0.3},
-                            "textFormat": {"bold": True, "foregroundColor": {"red": 1, "green": 1, "blue": 1}},
-                            "horizontalAlignment": "CENTER"
-                        }
-                    },
-                    "fields": "userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)"
-                }
-            })
-            
-            # 6. Фон на магазин колоните (F-N, 9 магазина) - леки нюанси зелено
-            store_data_colors = [
-                (5, {"red": 0.92, "green": 0.97, "blue": 0.90}),   # F: eBag
-                (6, {"red": 0.88, "green": 0.95, "blue": 0.87}),   # G: Кашон
-                (7, {"red": 0.84, "green": 0.93, "blue": 0.84}),   # H: Balev
-                (8, {"red": 0.80, "green": 0.91, "blue": 0.81}),   # I: Metro
-                (9, {"red": 0.90, "green": 0.96, "blue": 0.88}),   # J: Zelen
-                (10, {"red": 0.86, "green": 0.94, "blue": 0.85}),  # K: Randi
-                (11, {"red": 0.88, "green": 0.95, "blue": 0.86}),  # L: Bio-Market
-                (12, {"red": 0.84, "green": 0.93, "blue": 0.83}),  # M: BeFit
-                (13, {"red": 0.82, "green": 0.92, "blue": 0.82}),  # N: Laika
-            ]
-            for col_idx, bg_color in store_data_colors:
-                format_requests.append({
-                    "repeatCell": {
-                        "range": {"sheetId": sheet.id, "startRowIndex": 4, "endRowIndex": last_row, "startColumnIndex": col_idx, "endColumnIndex": col_idx + 1},
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": bg_color,
-                                "horizontalAlignment": "RIGHT"
-                            }
-                        },
-                        "fields": "userEnteredFormat(backgroundColor,horizontalAlignment)"
-                    }
-                })
-            
-            # 7. Подравняване на данните
-            # A (№) - център
-            format_requests.append({
-                "repeatCell": {
-                    "range": {"sheetId": sheet.id, "startRowIndex": 4, "endRowIndex": last_row, "startColumnIndex": 0, "endColumnIndex": 1},
-                    "cell": {"userEnteredFormat": {"horizontalAlignment": "CENTER"}},
-                    "fields": "userEnteredFormat(horizontalAlignment)"
-                }
-            })
-            # B (Продукт) - ляво
-            format_requests.append({
-                "repeatCell": {
-                    "range": {"sheetId": sheet.id, "startRowIndex": 4, "endRowIndex": last_row, "startColumnIndex": 1, "endColumnIndex": 2},
-                    "cell": {"userEnteredFormat": {"horizontalAlignment": "LEFT"}},
-                    "fields": "userEnteredFormat(horizontalAlignment)"
-                }
-            })
-            # C (Грамаж) - център
-            format_requests.append({
-                "repeatCell": {
-                    "range": {"sheetId": sheet.id, "startRowIndex": 4, "endRowIndex": last_row, "startColumnIndex": 2, "endColumnIndex": 3},
-                    "cell": {"userEnteredFormat": {"horizontalAlignment": "CENTER"}},
-                    "fields": "userEnteredFormat(horizontalAlignment)"
-                }
-            })
-            # D-E (Реф.BGN, Реф.EUR) - дясно
-            format_requests.append({
-                "repeatCell": {
-                    "range": {"sheetId": sheet.id, "startRowIndex": 4, "endRowIndex": last_row, "startColumnIndex": 3, "endColumnIndex": 5},
-                    "cell": {"userEnteredFormat": {"horizontalAlignment": "RIGHT"}},
-                    "fields": "userEnteredFormat(horizontalAlignment)"
-                }
-            })
-            # O-Q (Ср.BGN, Ср.EUR, Откл.%) - дясно
-            format_requests.append({
-                "repeatCell": {
-                    "range": {"sheetId": sheet.id, "startRowIndex": 4, "endRowIndex": last_row, "startColumnIndex": 14, "endColumnIndex": 17},
-                    "cell": {"userEnteredFormat": {"horizontalAlignment": "RIGHT"}},
-                    "fields": "userEnteredFormat(horizontalAlignment)"
-                }
-            })
-            # R (Статус) - център
-            format_requests.append({
-                "repeatCell": {
-                    "range": {"sheetId": sheet.id, "startRowIndex": 4, "endRowIndex": last_row, "startColumnIndex": 17, "endColumnIndex": 18},
-                    "cell": {"userEnteredFormat": {"horizontalAlignment": "CENTER"}},
-                    "fields": "userEnteredFormat(horizontalAlignment)"
-                }
-            })
-            
-            # 8. Conditional formatting за статус
-            ok_rows = []
-            warning_rows = []
-            no_data_rows = []
-            
-            for i, r in enumerate(results):
-                row_idx = 4 + i
-                if r['status'] == 'OK':
-                    ok_rows.append(row_idx)
-                elif r['status'] == 'ВНИМАНИЕ':
-                    warning_rows.append(row_idx)
-                else:
-                    no_data_rows.append(row_idx)
-            
-            # OK редове - зелен статус (колона R=17)
-            for row_idx in ok_rows:
-                format_requests.append({
-                    "repeatCell": {
-                        "range": {"sheetId": sheet.id, "startRowIndex": row_idx, "endRowIndex": row_idx + 1, "startColumnIndex": 17, "endColumnIndex": 18},
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": {"red": 0.85, "green": 0.95, "blue": 0.85},
-                                "textFormat": {"bold": True, "foregroundColor": {"red": 0, "green": 0.5, "blue": 0}}
-                            }
-                        },
-                        "fields": "userEnteredFormat(backgroundColor,textFormat)"
-                    }
-                })
-                # Средни цени O-P - светло зелено
-                format_requests.append({
-                    "repeatCell": {
-                        "range": {"sheetId": sheet.id, "startRowIndex": row_idx, "endRowIndex": row_idx + 1, "startColumnIndex": 14, "endColumnIndex": 16},
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": {"red": 0.9, "green": 0.97, "blue": 0.9},
-                                "textFormat": {"foregroundColor": {"red": 0.1, "green": 0.4, "blue": 0.1}}
-                            }
-                        },
-                        "fields": "userEnteredFormat(backgroundColor,textFormat)"
-                    }
-                })
-            
-            # ВНИМАНИЕ редове - червен статус и фон
-            for row_idx in warning_rows:
-                # Статус R - червено
-                format_requests.append({
-                    "repeatCell": {
-                        "range": {"sheetId": sheet.id, "startRowIndex": row_idx, "endRowIndex": row_idx + 1, "startColumnIndex": 17, "endColumnIndex": 18},
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": {"red": 1, "green": 0.85, "blue": 0.85},
-                                "textFormat": {"bold": True, "foregroundColor": {"red": 0.8, "green": 0, "blue": 0}}
-                            }
-                        },
-                        "fields": "userEnteredFormat(backgroundColor,textFormat)"
-                    }
-                })
-                # Средни цени O-P - светло червено
-                format_requests.append({
-                    "repeatCell": {
-                        "range": {"sheetId": sheet.id, "startRowIndex": row_idx, "endRowIndex": row_idx + 1, "startColumnIndex": 14, "endColumnIndex": 16},
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": {"red": 1, "green": 0.92, "blue": 0.92},
-                                "textFormat": {"foregroundColor": {"red": 0.7, "green": 0.1, "blue": 0.1}}
-                            }
-                        },
-                        "fields": "userEnteredFormat(backgroundColor,textFormat)"
-                    }
-                })
-                # Откл.% Q - червен фон
-                format_requests.append({
-                    "repeatCell": {
-                        "range": {"sheetId": sheet.id, "startRowIndex": row_idx, "endRowIndex": row_idx + 1, "startColumnIndex": 16, "endColumnIndex": 17},
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": {"red": 1, "green": 0.92, "blue": 0.92},
-                                "textFormat": {"bold": True, "foregroundColor": {"red": 0.7, "green": 0, "blue": 0}}
-                            }
-                        },
-                        "fields": "userEnteredFormat(backgroundColor,textFormat)"
-                    }
-                })
-                # Ред A-E - лек червен фон
-                format_requests.append({
-                    "repeatCell": {
-                        "range": {"sheetId": sheet.id, "startRowIndex": row_idx, "endRowIndex": row_idx + 1, "startColumnIndex": 0, "endColumnIndex": 5},
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": {"red": 1, "green": 0.95, "blue": 0.95}
-                            }
-                        },
-                        "fields": "userEnteredFormat(backgroundColor)"
-                    }
-                })
-            
-            # НЯМА ДАННИ редове - сиво
-            for row_idx in no_data_rows:
-                format_requests.append({
-                    "repeatCell": {
-                        "range": {"sheetId": sheet.id, "startRowIndex": row_idx, "endRowIndex": row_idx + 1, "startColumnIndex": 0, "endColumnIndex": 18},
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": {"red": 0.95, "green": 0.95, "blue": 0.95},
-                                "textFormat": {"italic": True, "foregroundColor": {"red": 0.5, "green": 0.5, "blue": 0.5}}
-                            }
-                        },
-                        "fields": "userEnteredFormat(backgroundColor,textFormat)"
-                    }
-                })
-            
-            # 9. v9.0: Оцветяване на клетките с ценови аномалии (>10% отклонение от средната)
-            # Mapping на store keys към column indices
-            store_column_map = {
-                'eBag': 5,       # F
-                'Kashon': 6,    # G
-                'Balev': 7,     # H
-                'Metro': 8,     # I
-                'Zelen': 9,     # J
-                'Randi': 10,    # K
-                'BioMarket': 11, # L
-                'BeFit': 12,    # M
-                'Laika': 13     # N
-            }
-            
-            for i, r in enumerate(results):
-                row_idx = 4 + i
-                store_deviations = r.get('store_deviations', {})
-                
-                for store_key, col_idx in store_column_map.items():
-                    deviation = store_deviations.get(store_key)
-                    if deviation is not None and abs(deviation) > ALERT_THRESHOLD:
-                        if deviation > 0:
-                            # По-скъпо от средната - червено
-                            format_requests.append({
-                                "repeatCell": {
-                                    "range": {"sheetId": sheet.id, "startRowIndex": row_idx, "endRowIndex": row_idx + 1, "startColumnIndex": col_idx, "endColumnIndex": col_idx + 1},
-                                    "cell": {
-                                        "userEnteredFormat": {
-                                            "backgroundColor": {"red": 1, "green": 0.85, "blue": 0.85},
-                                            "textFormat": {"bold": True, "foregroundColor": {"red": 0.7, "green": 0, "blue": 0}}
-                                        }
-                                    },
-                                    "fields": "userEnteredFormat(backgroundColor,textFormat)"
-                                }
-                            })
-                        else:
-                            # По-евтино от средната - синьо/зелено
-                            format_requests.append({
-                                "repeatCell": {
-                                    "range": {"sheetId": sheet.id, "startRowIndex": row_idx, "endRowIndex": row_idx + 1, "startColumnIndex": col_idx, "endColumnIndex": col_idx + 1},
-                                    "cell": {
-                                        "userEnteredFormat": {
-                                            "backgroundColor": {"red": 0.85, "green": 0.95, "blue": 1},
-                                            "textFormat": {"bold": True, "foregroundColor": {"red": 0, "green": 0.4, "blue": 0.7}}
-                                        }
-                                    },
-                                    "fields": "userEnteredFormat(backgroundColor,textFormat)"
-                                }
-                            })
-            
-            # 10. Ширини на колоните (18 колони за 9 магазина)
-            column_widths = [
-                (0, 35),    # A: №
-                (1, 270),   # B: Продукт
-                (2, 60),    # C: Грамаж
-                (3, 65),    # D: Реф.BGN
-                (4, 65),    # E: Реф.EUR
-                (5, 50),    # F: eBag
-                (6, 50),    # G: Кашон
-                (7, 50),    # H: Balev
-                (8, 50),    # I: Metro
-                (9, 50),    # J: Zelen
-                (10, 50),   # K: Randi
-                (11, 55),   # L: Bio-Market
-                (12, 50),   # M: BeFit
-                (13, 50),   # N: Laika
-                (14, 60),   # O: Ср.BGN
-                (15, 60),   # P: Ср.EUR
-                (16, 55),   # Q: Откл.%
-                (17, 80),   # R: Статус
-            ]
-            for col_idx, width in column_widths:
-                format_requests.append({
-                    "updateDimensionProperties": {
-                        "range": {"sheetId": sheet.id, "dimension": "COLUMNS", "startIndex": col_idx, "endIndex": col_idx + 1},
-                        "properties": {"pixelSize": width},
-                        "fields": "pixelSize"
-                    }
-                })
-            
-            spreadsheet.batch_update({"requests": format_requests})
-            print(f"  ✓ Форматиране приложено ({len(format_requests)} операции в 1 batch)")
+            operations = apply_tracker_formatting(gateway, sheet, force=SHEETS_FORCE_FULL_WRITE)
+            if operations:
+                print(f"  ✓ Форматиране: {operations} операции")
+            else:
+                print("  ✓ Форматирането е актуално")
             
         except Exception as e:
             print(f"  Форматиране предупреждение: {str(e)[:80]}")
         
-        # История - годишни табове
+        # История - табове по тримесечие/година, синхронизирани от локалната история (SQLite).
+        # При грешка в който и да е таб историята се отказва изцяло - иначе
+        # вече натрупаните табове биха се записали без mark_synced и редовете
+        # им биха се добавили повторно при следващия опит.
+        history = get_history_store()
+        history_savepoint = gateway.savepoint()
         try:
-            current_year = datetime.now().year
-            history_tab_name = f"История_{current_year}"
-            
-            try:
-                hist = spreadsheet.worksheet(history_tab_name)
-            except:
-                hist = spreadsheet.add_worksheet(history_tab_name, rows=2000, cols=18)
-                hist.update(values=[['Дата', 'Час', 'Продукт', 'Грамаж', 'eBag', 'Кашон', 'Balev', 'Metro', 'Zelen', 'Randi', 'Bio-Market', 'BeFit', 'Laika', 'Ср.BGN', 'Ср.EUR', 'Откл.%', 'Статус']], range_name='A1')
-                hist.freeze(rows=1)
-                print(f"  ✓ Създаден нов таб '{history_tab_name}'")
+            if history:
+                pending = history.unsynced_runs()
+                runs = [
+                    (datetime.fromisoformat(run['started_at']), history.results_for_run(run['id']))
+                    for run in pending
+                ]
+            else:
+                pending = []
+                runs = [(datetime.now(), results)]
             
-            date_str = datetime.now().strftime("%d.%m.%Y")
-            time_str = datetime.now().strftime("%H:%M")
+            # Всяко стартиране отива в таба на своето тримесечие/година (автоматична ротация)
+            rows_by_tab = {}
+            for moment, run_results in runs:
+                rows_by_tab.setdefault(history_tab_name(moment), []).extend(build_history_rows(run_results, moment))
             
-            hist_rows = []
-            for r in results:
-                hist_rows.append([
-                    date_str, time_str, r['name'], r['weight'],
-                    r['prices'].get('eBag', '') or '',
-                    r['prices'].get('Kashon', '') or '',
-                    r['prices'].get('Balev', '') or '',
-                    r['prices'].get('Metro', '') or '',
-                    r['prices'].get('Zelen', '') or '',
-                    r['prices'].get('Randi', '') or '',
-                    r['prices'].get('BioMarket', '') or '',
-                    r['prices'].get('BeFit', '') or '',
-                    r['prices'].get('Laika', '') or '',
-                    r['avg_bgn'] if r['avg_bgn'] else '',
-                    r['avg_eur'] if r['avg_eur'] else '',
-                    # v9.1: Посока на отклонението
-                    (f"↓{abs(r['max_deviation'])}%" if r['max_deviation'] < 0 else f"↑{r['max_deviation']}%") if r['max_deviation'] is not None else '',
-                    r['status']
-                ])
+            for tab_name, hist_rows in rows_by_tab.items():
+                append_history_rows(gateway, spreadsheet_id, tab_name, hist_rows)
             
-            hist.append_rows(hist_rows, value_input_option='USER_ENTERED')
-            print(f"  ✓ {history_tab_name}: {len(hist_rows)} записа")
+            if pending:
+                gateway.after_flush(lambda: history.mark_synced([run['id'] for run in pending]))
+                if len(pending) > 1:
+                    print(f"  ✓ История: {len(pending)} стартирания за синхронизиране")
+            elif history:
+                print("  История: няма нови стартирания за синхронизиране")
         except Exception as e:
+            gateway.rollback(history_savepoint)
             print(f"  История грешка: {str(e)[:50]}")
+            failures.append(f"история: {type(e).__name__}: {str(e)[:80]}")
+        
+        # Обобщение на историята по продукти (плъзгащи се статистики от SQLite)
+        try:
+            if history:
+                summary_sheet = gateway.worksheet(HISTORY_SUMMARY_SHEET_NAME)
+                created = summary_sheet is None
+                if created:
+                    summary_sheet = gateway.add_worksheet(HISTORY_SUMMARY_SHEET_NAME, rows=40, cols=len(HISTORY_SUMMARY_HEADERS))
+                summary_values = build_history_summary_values(history)
+                cells, ranges = write_sheet_values(gateway, spreadsheet_id, summary_sheet, summary_values, full=SHEETS_FORCE_FULL_WRITE or created)
+                print(f"  ✓ {HISTORY_SUMMARY_SHEET_NAME}: {cells} клетки в {ranges} диапазона")
+        except Exception as e:
+            print(f"  Обобщение грешка: {str(e)[:50]}")
+            failures.append(f"обобщение: {type(e).__name__}: {str(e)[:80]}")
         
+        # Всички записи наведнъж - стойностите, форматите и историята
+        gateway.flush()
+        stats = gateway.stats
+        print(f"  [SHEETS] Заявки: {stats['read']} четене, {stats['write']} запис, {stats['retries']} повторения")
+        
+        if failures:
+            raise RuntimeError("; ".join(failures))
         print("\n✓ Google Sheets актуализиран")
         
     except Exception as e:
         print(f"\n✗ Грешка: {str(e)}")
+        raise
 
 
 # =============================================================================
 # ИМЕЙЛ
 # =============================================================================
 
+class SinkDeliveryError(Exception):
+    """
+    Грешка, след като изходът вече е започнал да доставя (напр. SMTP DATA) -
+    run_sink не я повтаря, за да не се изпрати отчетът два пъти.
+    """
+
+
 def send_email_report(results, alerts):
     """
     Изпраща седмичен имейл отчет - винаги, независимо от резултатите.
     Използва HTML форматиране за по-добра четимост.
+    
+    Повтарят се само грешките при свързване и вход; грешка по време на
+    send_message е SinkDeliveryError, а грешка при затварянето на връзката
+    след изпращане не проваля отчета.
     """
     gmail_user = os.environ.get('GMAIL_USER')
     gmail_pass = os.environ.get('GMAIL_APP_PASSWORD')
@@ -2454,10 +5695,11 @@ def send_email_report(results, alerts):
     warning_count = len(alerts)
     
     # Покритие по магазини
-    store_coverage = {}
-    for store_key, store_config in STORES.items():
-        count = len([r for r in results if r['prices'].get(store_key)])
-        store_coverage[store_config['name_in_sheet']] = count
+    coverage = store_coverage(results)
+    store_coverage_by_name = {
+        store_config['name_in_sheet']: coverage.get(store_key, 0)
+        for store_key, store_config in STORES.items()
+    }
     
     # Определяме темата на имейла
     if warning_count > 0:
@@ -2590,7 +5832,7 @@ def send_email_report(results, alerts):
             <h2>Покритие по магазини</h2>
     """)
     
-    for store_name, count in store_coverage.items():
+    for store_name, count in store_coverage_by_name.items():
         percentage = (count / total_products) * 100
         html_parts.append(f"""
             <div class="coverage-label"><strong>{store_name}</strong>: {count}/{total_products} продукта ({percentage:.0f}%)</div>
@@ -2620,6 +5862,9 @@ def send_email_report(results, alerts):
     html_content = "".join(html_parts)
     
     # Изпращане
+    import smtplib
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
     try:
         msg = MIMEMultipart('alternative')
         msg['From'] = gmail_user
@@ -2629,21 +5874,184 @@ def send_email_report(results, alerts):
         # Добавяме HTML версия
         msg.attach(MIMEText(html_content, 'html', 'utf-8'))
         
-        with smtplib.SMTP('smtp.gmail.com', 587) as server:
+        server = smtplib.SMTP('smtp.gmail.com', 587, timeout=PUBLISH_SINK_TIMEOUTS["email"])
+        try:
             server.starttls()
             server.login(gmail_user, gmail_pass)
-            server.send_message(msg)
+            try:
+                server.send_message(msg)
+            except Exception as e:
+                # Сървърът може вече да е приел писмото - не се изпраща повторно
+                raise SinkDeliveryError(f"{type(e).__name__}: {e}") from e
+        finally:
+            try:
+                server.quit()
+            except Exception:
+                server.close()
         
         print(f"Имейл изпратен до {recipients}")
     except Exception as e:
         print(f"Имейл грешка: {str(e)[:50]}")
+        raise
 
 
 # =============================================================================
-# MAIN
+# ПУБЛИКУВАНЕ
+# =============================================================================
+
+def export_results_json(results, alerts, path=None):
+    """Записва резултатите в JSON (атомарно) за други инструменти и табла."""
+    path = path or EXPORT_JSON_PATH
+    data = {
+        "generated_at": datetime.now().isoformat(timespec='seconds'),
+        "base_currency": BASE_CURRENCY,
+        "eur_bgn_rate": EUR_BGN_RATE,
+        "alerts": [r['name'] for r in alerts],
+        "results": list(results),
+    }
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+    print(f"JSON експорт: {path}")
+
+
+def publish_sinks(results, alerts, only=None):
+    """
+    Изходите за публикуване: [(име, функция)], с None за неконфигуриран изход.
+    only ограничава изходите до изброените имена.
+    
+    Локалната история (SQLite) не е сред тях - записва се още в
+    collect_prices, защото Sheets синхронизира табовете с история от нея.
+    """
+    sheets_ready = bool(os.environ.get('SPREADSHEET_ID'))
+    email_ready = bool(os.environ.get('GMAIL_USER') and os.environ.get('GMAIL_APP_PASSWORD'))
+    sinks = [
+        ("sheets", (lambda: update_google_sheets(results)) if sheets_ready else None),
+        ("email", (lambda: send_email_report(results, alerts)) if email_ready else None),
+        ("export", lambda: export_results_json(results, alerts)),
+    ]
+    return [(name, fn) for name, fn in sinks if not only or name in only]
+
+
+def run_sink(name, fn, deadline):
+    """
+    Изпълнява един изход с до PUBLISH_SINK_RETRIES[name] повторения.
+    Нов опит започва само ако изчакването преди него не минава крайния срок;
+    SinkDeliveryError (доставката е започнала) не се повтаря.
+    
+    Returns:
+        {"status": "ok"|"error", "attempts", "seconds", "error"}
+    """
+    started = time.monotonic()
+    retries = PUBLISH_SINK_RETRIES.get(name, 0)
+    for attempt in range(retries + 1):
+        try:
+            fn()
+            return {"status": "ok", "attempts": attempt + 1, "seconds": time.monotonic() - started, "error": None}
+        except SinkDeliveryError as e:
+            return {"status": "error", "attempts": attempt + 1, "seconds": time.monotonic() - started,
+                    "error": f"{type(e).__name__}: {str(e)[:80]}"}
+        except Exception as e:
+            # Експоненциално изчакване с пълен jitter
+            delay = random.uniform(0, PUBLISH_RETRY_BASE_DELAY * 2 ** attempt)
+            if attempt == retries or time.monotonic() + delay >= deadline:
+                return {"status": "error", "attempts": attempt + 1, "seconds": time.monotonic() - started,
+                        "error": f"{type(e).__name__}: {str(e)[:80]}"}
+            print(f"[PUBLISH] {name}: {type(e).__name__} - нов опит след {delay:.1f}s")
+            time.sleep(delay)
+
+
+def start_sink_thread(name, fn, deadline):
+    """
+    Стартира run_sink в daemon нишка и връща Future с резултата.
+    Daemon нишките не се чакат при изход от процеса (за разлика от
+    работните нишки на ThreadPoolExecutor), така че блокирал изход
+    не задържа CLI-то след таймаута си.
+    """
+    future = concurrent.futures.Future()
+    
+    def target():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(run_sink(name, fn, deadline))
+        except BaseException as e:
+            future.set_exception(e)
+    
+    threading.Thread(target=target, name=f"publish-{name}", daemon=True).start()
+    return future
+
+
+def publish_results(results, alerts, only=None):
+    """
+    Публикува резултатите във всички изходи паралелно (по нишка на изход),
+    така че времето след събирането е това на най-бавния изход, а не сумата.
+    
+    Изход, който не приключи до PUBLISH_SINK_TIMEOUTS[name], се отчита като
+    "timeout" и се изоставя: нишката му не може да бъде прекъсната, но е
+    daemon и не задържа изхода от процеса - при приключване на командата
+    незавършеният запис просто спира.
+    
+    Returns:
+        {име: {"status": "ok"|"error"|"timeout"|"skipped", "attempts", "seconds", "error"}}
+    """
+    started = time.monotonic()
+    sinks = publish_sinks(results, alerts, only)
+    outcomes = {}
+    pending = []
+    for name, fn in sinks:
+        if fn is None:
+            outcomes[name] = {"status": "skipped", "attempts": 0, "seconds": 0.0, "error": None}
+            continue
+        deadline = started + PUBLISH_SINK_TIMEOUTS.get(name, 60)
+        pending.append((deadline, name, start_sink_thread(name, fn, deadline)))
+    
+    # Всички тръгват едновременно - изчакваме ги по реда на крайните срокове
+    for deadline, name, future in sorted(pending, key=lambda item: item[0]):
+        try:
+            outcomes[name] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            outcomes[name] = {"status": "timeout", "attempts": None, "seconds": time.monotonic() - started,
+                              "error": f"над {PUBLISH_SINK_TIMEOUTS.get(name, 60)}s"}
+    
+    labels = {"ok": "OK", "error": "ГРЕШКА", "timeout": "ТАЙМАУТ", "skipped": "пропуснат (не е конфигуриран)"}
+    print(f"\n[PUBLISH] Изходи за {time.monotonic() - started:.1f}s:")
+    for name, _ in sinks:
+        outcome = outcomes[name]
+        line = f"  {name}: {labels[outcome['status']]}"
+        if outcome['status'] != "skipped":
+            line += f" ({outcome['seconds']:.1f}s"
+            line += f", {outcome['attempts']} опита)" if outcome['attempts'] and outcome['attempts'] > 1 else ")"
+        if outcome['error']:
+            line += f" - {outcome['error']}"
+        print(line)
+    return outcomes
+
+
+# =============================================================================
+# CLI
 # =============================================================================
 
-def main():
+# Модулите, които командите без браузър и мрежа не трябва да зареждат
+HEAVY_MODULES = ["playwright.sync_api", "playwright_stealth", "gspread", "google.oauth2.service_account",
+                 "anthropic", "numpy", "scipy.sparse", "PIL.Image", "smtplib"]
+
+# Пакет в requirements.txt -> модул (за doctor)
+REQUIRED_PACKAGES = {
+    "numpy": "numpy",
+    "playwright": "playwright",
+    "playwright-stealth": "playwright_stealth",
+    "gspread": "gspread",
+    "google-auth": "google.oauth2",
+    "anthropic": "anthropic",
+    "scipy": "scipy",
+    "Pillow": "PIL",
+}
+
+
+def print_banner():
     print("=" * 60)
     print("HARMONICA PRICE TRACKER v9.1")
     print("27 продукта, 9 магазина")
@@ -2658,17 +6066,10 @@ def main():
     print("Vision: " + ("Активна" if ENABLE_VISUAL_VERIFICATION else "Изключена"))
     print("Stealth: " + ("Наличен" if STEALTH_AVAILABLE else "Не е наличен"))
     print("=" * 60)
-    
-    results = collect_prices()
-    update_google_sheets(results)
-    
-    # v9.0: Използваме has_anomaly вместо deviation
-    alerts = [r for r in results if r.get('has_anomaly', False)]
-    
-    # Винаги изпращаме имейл отчет
-    send_email_report(results, alerts)
-    
-    # Обобщение
+
+
+def print_run_summary(results):
+    """Обобщението в края на стартирането: покритие по магазини и статуси."""
     print("\n" + "="*60)
     print("ОБОБЩЕНИЕ")
     print("="*60)
@@ -2693,8 +6094,326 @@ def main():
     
     print("\nОбщо покритие: " + str(total) + "/" + str(len(results)) + " продукта")
     print("Статус: " + str(ok_count) + " OK, " + str(warning_count) + " ВНИМАНИЕ, " + str(no_data) + " НЯМА ДАННИ")
+
+
+def load_run_results(run_id=None):
+    """
+    Резултатите на стартиране от локалната история (последното по подразбиране).
+    
+    Returns:
+        tuple (run dict, results) или (None, None) ако няма история
+    """
+    history = get_history_store()
+    run = history.get_run(run_id) if history else None
+    if not run:
+        print("Няма записано стартиране в историята" + (f" с id {run_id}" if run_id else "") + f" ({HISTORY_DB_PATH})")
+        return None, None
+    return run, history.results_for_run(run['id'])
+
+
+def parse_store_list(value):
+    """"eBag,kashon" -> ключове от STORES (по ключ или име в таблицата, без значение от регистъра)."""
+    lookup = {}
+    for key, config in STORES.items():
+        lookup[key.lower()] = key
+        lookup[config['name_in_sheet'].lower()] = key
+    keys = []
+    for part in filter(None, (part.strip() for part in value.split(','))):
+        key = lookup.get(part.lower())
+        if not key:
+            raise argparse.ArgumentTypeError(f"непознат магазин '{part}' (възможни: {', '.join(STORES)})")
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def parse_product_list(value):
+    """"3,7" -> ID от каталога."""
+    ids = []
+    for part in filter(None, (part.strip() for part in value.split(','))):
+        if not part.isdigit() or not get_catalog().get(int(part)):
+            raise argparse.ArgumentTypeError(f"непознат продукт '{part}' (ID от 1 до {len(get_catalog())})")
+        ids.append(int(part))
+    return ids
+
+
+def cmd_scrape(args):
+    """Скрейпване на магазините (всички или избраните) и публикуване."""
+    print_banner()
+    if args.stores or args.products:
+        print(f"Частично стартиране: магазини {', '.join(args.stores or STORES)}"
+              f"; продукти {', '.join(map(str, args.products)) if args.products else 'всички'}")
+    try:
+        results = collect_prices(stores=args.stores, products=args.products, skip_vision=args.skip_vision)
+    except RuntimeError as e:
+        print(f"\n✗ {e}")
+        return 1
+    
+    # v9.0: Използваме has_anomaly вместо deviation
+    alerts = [r for r in results if r.get('has_anomaly', False)]
+    
+    # Sheets, имейл (винаги, независимо от резултатите) и JSON експорт - паралелно
+    if args.no_publish:
+        print("\nБез публикуване (--no-publish) - по-късно: scraper.py publish")
+    else:
+        publish_results(results, alerts)
+    
+    print_run_summary(results)
     print("\nГотово!")
+    return 0
+
+
+def cmd_extract(args):
+    """Извлича цени от запазен текст на страница (без браузър)."""
+    paths = args.files
+    if not paths:
+        if not PAGE_TEXT_DIR or not os.path.isdir(PAGE_TEXT_DIR):
+            print(f"Няма запазени страници в {PAGE_TEXT_DIR or '(PAGE_TEXT_DIR е изключен)'}")
+            return 1
+        paths = sorted(
+            os.path.join(PAGE_TEXT_DIR, name) for name in os.listdir(PAGE_TEXT_DIR) if name.endswith('.txt')
+        )
+    
+    use_claude = not args.no_claude and CLAUDE_AVAILABLE and bool(os.environ.get('ANTHROPIC_API_KEY'))
+    catalog = get_catalog()
+    all_prices = {}
+    for path in paths:
+        store_key = args.store or os.path.splitext(os.path.basename(path))[0]
+        if store_key not in STORES:
+            print(f"Непознат магазин '{store_key}' за {path} (--store)")
+            return 1
+        store_name = STORES[store_key]['name_in_sheet']
+        with open(path, encoding='utf-8') as f:
+            body_text = f.read()
+        
+        print(f"\n{store_name}: {len(body_text)} символа от {path}")
+        sources = {}
+        currencies = {}
+        prices = extract_text_prices(body_text, store_name, sources, use_claude=use_claude, currencies=currencies)
+        for name in catalog.unavailable_names(store_key):
+            prices.pop(name, None)
+        records = {name: catalog.find(name) for name in prices}
+        for name, price in sorted(prices.items(), key=lambda item: records[item[0]].id if records[item[0]] else 0):
+            product_id = records[name].id if records[name] else '?'
+            print(f"    #{product_id} {name[:40]}: {price:.2f} {currencies.get(name) or '?'} ({sources.get(name, '?')})")
+        print(f"  Общо намерени: {len(prices)} продукта")
+        all_prices[store_key] = prices
+    
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(all_prices, f, ensure_ascii=False, indent=1)
+        print(f"\nJSON: {args.json}")
+    return 0
+
+
+def cmd_publish(args):
+    """Публикува записано стартиране от историята отново (без скрейпване)."""
+    run, results = load_run_results(args.run)
+    if results is None:
+        return 1
+    print(f"Стартиране #{run['id']} от {run['started_at']}")
+    alerts = [r for r in results if r.get('has_anomaly', False)]
+    outcomes = publish_results(results, alerts, only=args.sinks)
+    return 0 if all(outcome['status'] in ("ok", "skipped") for outcome in outcomes.values()) else 1
+
+
+def cmd_report(args):
+    """Обобщение на записано стартиране и промените седмица за седмица."""
+    run, results = load_run_results(args.run)
+    if results is None:
+        return 1
+    print(f"Стартиране #{run['id']} от {run['started_at']}")
+    print_run_summary(results)
+    
+    catalog = get_catalog()
+    moment = datetime.fromisoformat(run['started_at'])
+    changes = [
+        change for change in get_history_store().week_over_week(now=moment)
+        if change['change_pct'] is not None and abs(change['change_pct']) >= args.threshold
+    ]
+    changes.sort(key=lambda change: -abs(change['change_pct']))
+    print(f"\nПромени спрямо предходната седмица (над {args.threshold:g}%): {len(changes)}")
+    for change in changes[:args.limit]:
+        name = catalog.name_of(change['product_id']) or change['product_id']
+        store_name = STORES.get(change['store'], {}).get('name_in_sheet', change['store'])
+        print(f"  {'↑' if change['change_pct'] > 0 else '↓'} {store_name}: {str(name)[:35]} "
+              f"{change['previous_bgn']:.2f} -> {change['price_bgn']:.2f} лв ({change['change_pct']:+.1f}%)")
+    return 0
+
+
+def _time_subprocess(code, repeat):
+    """Най-доброто и медианното време (секунди) за нов Python процес, изпълняващ code."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def cmd_bench(args):
+    """
+    Време за студен старт: празен интерпретатор, import scraper, CLI без
+    команда за скрейпване и всяка тежка зависимост поотделно. Всяко измерване
+    е в нов процес, за да не се брои вече зареденият sys.modules.
+    """
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    cases = [
+        ("python (празен)", "pass"),
+        (f"import {module}", f"import {module}"),
+        (f"{module} report --help", f"import sys, {module}; sys.argv = ['{module}', 'report', '--help']\n"
+                                    f"try:\n    {module}.main()\nexcept SystemExit:\n    pass"),
+    ]
+    cases += [(f"import {name}", f"import {name}") for name in HEAVY_MODULES if _module_available(name.split('.')[0])]
+    
+    print(f"Студен старт ({args.repeat} повторения, най-добро / медиана):")
+    baseline = None
+    for label, code in cases:
+        best, median = _time_subprocess(code, args.repeat)
+        if baseline is None:
+            baseline = best
+        print(f"  {label:<38} {best * 1000:7.0f} ms / {median * 1000:7.0f} ms  (+{(best - baseline) * 1000:.0f} ms)")
+    
+    # Кои тежки модули зарежда самият import
+    probe = subprocess.run(
+        [sys.executable, "-c", f"import sys, json, {module}; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), check=True, capture_output=True, text=True
+    )
+    loaded = json.loads(probe.stdout.strip().splitlines()[-1])
+    print(f"\nТежки модули след import {module}: {', '.join(loaded) if loaded else 'няма'}")
+    return 1 if loaded else 0
+
+
+def cmd_doctor(args):
+    """Проверка на средата: зависимости, браузър, променливи и локалното състояние."""
+    from importlib import metadata
+    problems = 0
+    
+    def check(ok, label, detail="", required=True):
+        nonlocal problems
+        mark = "✓" if ok else ("✗" if required else "-")
+        if not ok and required:
+            problems += 1
+        print(f"  {mark} {label}" + (f": {detail}" if detail else ""))
+    
+    print(f"Python {sys.version.split()[0]} ({sys.executable})")
+    
+    print("\nЗависимости:")
+    for package, module in REQUIRED_PACKAGES.items():
+        available = _module_available(module.split('.')[0]) and _module_available(module)
+        try:
+            version = metadata.version(package) if available else "не е инсталиран"
+        except metadata.PackageNotFoundError:
+            version = "инсталиран"
+        check(available, package, version)
+    
+    browsers_path = os.environ.get('PLAYWRIGHT_BROWSERS_PATH') or os.path.expanduser('~/.cache/ms-playwright')
+    chromium = sorted(name for name in os.listdir(browsers_path) if name.startswith('chromium')) if os.path.isdir(browsers_path) else []
+    check(bool(chromium), "Chromium за Playwright", ", ".join(chromium) or f"няма в {browsers_path} (playwright install chromium)")
+    
+    print("\nПроменливи на средата:")
+    check(bool(os.environ.get('ANTHROPIC_API_KEY')), "ANTHROPIC_API_KEY",
+          "ANTHROPIC_BASE_URL=" + os.environ['ANTHROPIC_BASE_URL'] if os.environ.get('ANTHROPIC_BASE_URL') else "")
+    if os.environ.get('HARMONICA_FAKE_SHEETS'):
+        check(True, "Google Sheets", f"fake ({os.environ['HARMONICA_FAKE_SHEETS']})")
+    else:
+        try:
+            creds = json.loads(os.environ.get('GOOGLE_CREDENTIALS') or 'null')
+            check(isinstance(creds, dict) and 'client_email' in creds, "GOOGLE_CREDENTIALS",
+                  creds.get('client_email', 'няма client_email') if isinstance(creds, dict) else "не е зададена")
+        except ValueError:
+            check(False, "GOOGLE_CREDENTIALS", "невалиден JSON")
+    check(bool(os.environ.get('SPREADSHEET_ID')), "SPREADSHEET_ID")
+    check(bool(os.environ.get('GMAIL_USER') and os.environ.get('GMAIL_APP_PASSWORD')), "GMAIL_USER / GMAIL_APP_PASSWORD")
+    check(bool(os.environ.get('ALERT_EMAIL')), "ALERT_EMAIL", "по подразбиране GMAIL_USER", required=False)
+    
+    print("\nКаталог:")
+    try:
+        catalog = get_catalog()
+        check(True, "Продукти", str(len(catalog)))
+        for record in catalog.unindexed():
+            check(False, f"#{record.id} {record.name}", "без вид или грамаж (няма в индекса)", required=False)
+    except ValueError as e:
+        check(False, "Продукти", str(e))
+    
+    print("\nЛокално състояние:")
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        check(os.access(CACHE_DIR, os.W_OK), "Кеш директория", os.path.abspath(CACHE_DIR))
+    except OSError as e:
+        check(False, "Кеш директория", str(e)[:60])
+    history = get_history_store()
+    if history:
+        run = history.get_run()
+        check(True, "История", f"последно стартиране {run['started_at']}, несинхронизирани: {len(history.unsynced_runs())}"
+              if run else "няма стартирания")
+    else:
+        check(False, "История", HISTORY_DB_PATH)
+    
+    print(f"\n{'Всичко е наред' if not problems else f'Проблеми: {problems}'}")
+    return 1 if problems else 0
+
+
+def build_cli_parser():
+    parser = argparse.ArgumentParser(
+        prog="scraper.py",
+        description="Harmonica Price Tracker. Без команда се изпълнява scrape."
+    )
+    commands = parser.add_subparsers(dest="command", metavar="команда")
+    
+    scrape = commands.add_parser("scrape", help="скрейпване на всички магазини и публикуване (по подразбиране)")
+    scrape.add_argument("--stores", type=parse_store_list, metavar="eBag,Kashon",
+                        help="само тези магазини - резултатът се наслагва върху последното стартиране")
+    scrape.add_argument("--products", type=parse_product_list, metavar="3,7",
+                        help="само тези продукти (ID от каталога) - останалите се пренасят")
+    scrape.add_argument("--skip-vision", action="store_true", help="без визуална верификация")
+    scrape.add_argument("--no-publish", action="store_true", help="без Sheets, имейл и JSON експорт")
+    scrape.set_defaults(handler=cmd_scrape)
+    
+    extract = commands.add_parser("extract", help="цени от запазен текст на страница (без браузър)")
+    extract.add_argument("files", nargs="*", help=f"текстови файлове (по подразбиране {PAGE_TEXT_DIR}/*.txt)")
+    extract.add_argument("--store", choices=list(STORES), help="магазин (по подразбиране - от името на файла)")
+    extract.add_argument("--no-claude", action="store_true", help="само локалното fallback търсене")
+    extract.add_argument("--json", metavar="ПЪТ", help="запис на намерените цени в JSON")
+    extract.set_defaults(handler=cmd_extract)
+    
+    publish = commands.add_parser("publish", help="повторно публикуване на стартиране от историята")
+    publish.add_argument("--run", type=int, help="id на стартирането (по подразбиране последното)")
+    publish.add_argument("--sinks", nargs="+", choices=list(PUBLISH_SINK_TIMEOUTS), help="само тези изходи")
+    publish.set_defaults(handler=cmd_publish)
+    
+    report = commands.add_parser("report", help="обобщение на стартиране от историята")
+    report.add_argument("--run", type=int, help="id на стартирането (по подразбиране последното)")
+    report.add_argument("--threshold", type=float, default=ALERT_THRESHOLD, help="минимална промяна за седмица в %% (по подразбиране %(default)s)")
+    report.add_argument("--limit", type=int, default=20, help="максимум показани промени")
+    report.set_defaults(handler=cmd_report)
+    
+    bench = commands.add_parser("bench", help="време за студен старт и импортиране на зависимостите")
+    bench.add_argument("--repeat", type=int, default=5, help="повторения на измерване")
+    bench.set_defaults(handler=cmd_bench)
+    
+    doctor = commands.add_parser("doctor", help="проверка на зависимостите, браузъра и променливите")
+    doctor.set_defaults(handler=cmd_doctor)
+    return parser
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def main(argv=None):
+    args = build_cli_parser().parse_args(argv)
+    if args.command is None:
+        args = build_cli_parser().parse_args(["scrape"])
+    try:
+        return args.handler(args)
+    finally:
+        # Затварянето прехвърля WAL журнала в основния файл на базата (за artifact-а в CI)
+        if _HISTORY_STORE is not None:
+            _HISTORY_STORE.close()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
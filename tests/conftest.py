@@ -0,0 +1,42 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scraper  # noqa: E402
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    """Локалното състояние (история, снимки, експорт) във временна директория."""
+    monkeypatch.setattr(scraper, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(scraper, "HISTORY_DB_PATH", str(tmp_path / "history.sqlite"))
+    monkeypatch.setattr(scraper, "SHEETS_SNAPSHOT_PATH", str(tmp_path / "sheets_snapshot.json"))
+    monkeypatch.setattr(scraper, "EXPORT_JSON_PATH", str(tmp_path / "latest_results.json"))
+    monkeypatch.setattr(scraper, "PAGE_TEXT_DIR", str(tmp_path / "pages"))
+    monkeypatch.setattr(scraper, "_HISTORY_STORE", None)
+    for name in ("SPREADSHEET_ID", "GOOGLE_CREDENTIALS", "GMAIL_USER", "GMAIL_APP_PASSWORD", "HARMONICA_FAKE_SHEETS"):
+        monkeypatch.delenv(name, raising=False)
+    yield tmp_path
+    if scraper._HISTORY_STORE is not None:
+        scraper._HISTORY_STORE.close()
+        scraper._HISTORY_STORE = None
+
+
+def sample_store_prices(seed, coverage=0.8):
+    """Случайни цени около референтните: {store_key: {име: цена}}."""
+    rng = random.Random(seed)
+    return {
+        store_key: {
+            record.name: round(record.ref_price_bgn * rng.uniform(0.9, 1.2), 2)
+            for record in scraper.get_catalog() if rng.random() < coverage
+        }
+        for store_key in scraper.STORES
+    }
+
+
+def sample_matrix(seed):
+    return scraper.PriceMatrix.from_store_prices(sample_store_prices(seed), scraper.get_catalog(), scraper.STORES)
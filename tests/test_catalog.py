@@ -0,0 +1,24 @@
+import pytest
+
+import scraper
+
+
+def test_catalog_builds_silently(capsys):
+    catalog = scraper.ProductCatalog(scraper.PRODUCTS)
+
+    assert len(catalog) == len(scraper.PRODUCTS)
+    assert capsys.readouterr().out == ""
+
+
+def test_unknown_keyword_id_is_an_error(monkeypatch):
+    monkeypatch.setitem(scraper.PRODUCT_KEYWORDS, 999, ["несъществуващ"])
+
+    with pytest.raises(ValueError, match="PRODUCT_KEYWORDS"):
+        scraper.ProductCatalog(scraper.PRODUCTS)
+
+
+def test_unknown_store_in_not_available_is_an_error(monkeypatch):
+    monkeypatch.setitem(scraper.PRODUCTS_NOT_AVAILABLE, "NoSuchStore", [scraper.PRODUCTS[0]['id']])
+
+    with pytest.raises(ValueError, match="NoSuchStore"):
+        scraper.ProductCatalog(scraper.PRODUCTS)
@@ -0,0 +1,22 @@
+import json
+import os
+import subprocess
+import sys
+
+import scraper
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loaded_heavy_modules(code):
+    probe = subprocess.run(
+        [sys.executable, "-c", code + f"\nimport json, sys; print(json.dumps([m for m in {scraper.HEAVY_MODULES!r} if m in sys.modules]))"],
+        cwd=ROOT, check=True, capture_output=True, text=True
+    )
+    return json.loads(probe.stdout.strip().splitlines()[-1])
+
+
+def test_import_and_help_load_no_heavy_modules():
+    assert "numpy" in scraper.HEAVY_MODULES
+    assert loaded_heavy_modules("import scraper") == []
+    assert loaded_heavy_modules("import scraper\ntry:\n    scraper.build_cli_parser().parse_args(['--help'])\nexcept SystemExit:\n    pass") == []
@@ -0,0 +1,58 @@
+import pytest
+
+import scraper
+
+GOAT_CHEESE = "Био сирене козе"
+YOGURT = "Био кисело мляко 3,6%"
+
+# 7,50 € е по-близо до BGN референцията (10.99) отколкото до EUR (5.62),
+# така че само изричната валута я разпознава като EUR
+MIXED_PAGE = """
+Harmonica Био козе сирене 200г
+7,50 €
+Harmonica Био кисело мляко 3,6% 400г
+2,79 лв.
+"""
+
+
+def test_fallback_keeps_each_price_currency():
+    currencies = {}
+    prices = scraper.extract_prices_with_fallback(MIXED_PAGE, currencies)
+
+    assert prices[GOAT_CHEESE] == 7.50
+    assert currencies[GOAT_CHEESE] == "EUR"
+    assert prices[YOGURT] == 2.79
+    assert currencies[YOGURT] == "BGN"
+
+
+def test_phase1_product_currency():
+    assert scraper.normalize_phase1_product({"name": "Айран", "price": "1.53 €"})["currency"] == "EUR"
+    assert scraper.normalize_phase1_product({"name": "Айран", "price": 2.99, "currency": "лв."})["currency"] == "BGN"
+    assert scraper.normalize_phase1_product({"name": "Айран", "price": 2.99})["currency"] is None
+
+
+def test_explicit_currency_overrides_reference_guess():
+    prices = {"eBag": {GOAT_CHEESE: 7.50, YOGURT: 2.79}}
+    guessed = scraper.PriceMatrix.from_store_prices(prices, scraper.get_catalog(), ["eBag"])
+    explicit = scraper.PriceMatrix.from_store_prices(
+        prices, scraper.get_catalog(), ["eBag"], {"eBag": {GOAT_CHEESE: "EUR"}}
+    )
+
+    row = next(i for i, record in enumerate(explicit.records) if record.name == GOAT_CHEESE)
+    assert guessed.prices[row, 0] == 7.50
+    assert explicit.prices[row, 0] == pytest.approx(7.50 * scraper.EUR_BGN_RATE, abs=0.01)
+    assert explicit.currency_corrections()["EUR->BGN"] == 1
+
+
+def test_history_round_trip_keeps_currency(state):
+    prices = {"eBag": {GOAT_CHEESE: 7.50, YOGURT: 2.79}}
+    currencies = {"eBag": {GOAT_CHEESE: "EUR", YOGURT: "BGN"}}
+    matrix = scraper.PriceMatrix.from_store_prices(prices, scraper.get_catalog(), scraper.STORES, currencies)
+    history = scraper.get_history_store()
+    run_id = history.record_run(matrix)
+
+    stored = {}
+    assert history.run_prices(run_id, stored) == prices
+    assert stored == currencies
+    results = {r['name']: r for r in history.results_for_run(run_id)}
+    assert results[GOAT_CHEESE]['prices']['eBag'] == pytest.approx(14.67, abs=0.01)
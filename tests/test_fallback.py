@@ -0,0 +1,36 @@
+import scraper
+
+
+def test_automaton_reports_overlapping_keywords():
+    automaton = scraper.KeywordAutomaton(["he", "she", "his", "hers"])
+
+    assert automaton.find_all("ushers") == {"she": [1], "he": [2], "hers": [2]}
+
+
+def test_automaton_maps_transliteration_to_the_keyword():
+    automaton = scraper.KeywordAutomaton(["сирене", "рене", "козе"])
+    text = "козе сирене / sirene"
+
+    # "рене" е вътре в "сирене" - и двете срещания се отчитат, и на латиница
+    assert automaton.find_all(text) == {"козе": [0], "сирене": [5, 14], "рене": [7, 16]}
+    restored = scraper.KeywordAutomaton.from_dict(automaton.to_dict())
+    assert restored.find_all(text) == automaton.find_all(text)
+
+
+PRICED_PAGE = "Сирене 10,49 лв.   Мляко 2,79 лв.   Тахан 3,99 €"
+
+
+def test_price_index_window_by_offset():
+    index = scraper.PriceIndex(PRICED_PAGE)
+
+    assert index.in_window(0, 16) == [(10.49, "BGN")]
+    # Цена, която излиза извън края на прозореца, не се брои
+    assert index.in_window(0, 15) == []
+    assert index.in_window(8, 48) == [(2.79, "BGN"), (3.99, "EUR")]
+    assert index.in_window(PRICED_PAGE.index("Тахан"), len(PRICED_PAGE)) == [(3.99, "EUR")]
+
+
+def test_price_index_skips_old_and_twin_prices():
+    index = scraper.PriceIndex("Сирене стара цена 12,99 лв. 10,49 лв. / 5,36 €")
+
+    assert index.in_window(0, 100) == [(10.49, "BGN")]
@@ -0,0 +1,39 @@
+import sqlite3
+
+import pytest
+
+import scraper
+
+from conftest import sample_matrix
+
+
+def test_missing_history_is_reported(state, capsys, monkeypatch):
+    monkeypatch.setenv("GITHUB_ACTIONS", "true")
+    history = scraper.get_history_store()
+
+    assert not history.existed
+    assert scraper.check_history_state(history) is False
+    output = capsys.readouterr().out
+    assert "история липсва" in output.lower()
+    assert "::warning" in output
+
+
+def test_empty_history_is_reported(state, capsys):
+    sqlite3.connect(scraper.HISTORY_DB_PATH).close()
+    history = scraper.get_history_store()
+
+    assert history.existed
+    assert scraper.check_history_state(history) is False
+    assert "история е празна" in capsys.readouterr().out.lower()
+
+
+def test_history_with_runs_is_ok(state):
+    history = scraper.get_history_store()
+    history.record_run(sample_matrix(0))
+
+    assert scraper.check_history_state(history) is True
+
+
+def test_partial_run_requires_previous_run(state):
+    with pytest.raises(RuntimeError):
+        scraper.collect_prices(stores=["eBag"])
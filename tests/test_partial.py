@@ -0,0 +1,96 @@
+import json
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+import scraper
+
+GOAT_CHEESE = "Био сирене козе"
+YOGURT = "Био кисело мляко 3,6%"
+
+PAGE = """
+Harmonica Био козе сирене 200г
+10,49 лв.
+Harmonica Био кисело мляко 3,6% 400г
+2,79 лв.
+"""
+
+
+def record(history, prices, started_at, scope=None, base_run_id=None):
+    matrix = scraper.PriceMatrix.from_store_prices(prices, scraper.get_catalog(), scraper.STORES)
+    return history.record_run(matrix, started_at=started_at, scope=scope, base_run_id=base_run_id)
+
+
+def test_summary_uses_merged_partial_runs(state):
+    history = scraper.get_history_store()
+    now = datetime(2026, 10, 19, 12, 0)
+    base = record(history, {"eBag": {GOAT_CHEESE: 10.00}, "Kashon": {GOAT_CHEESE: 12.00}}, now - timedelta(days=14))
+    scope = {"stores": ["eBag"], "products": None}
+    merged = scraper.merge_run_prices(history.run_prices(base), {"eBag": {GOAT_CHEESE: 11.00}}, scope)
+    record(history, merged, now - timedelta(days=1), scope=scope, base_run_id=base)
+
+    summary = history.product_summary(now=now)[scraper.get_catalog().find(GOAT_CHEESE).id]
+
+    # Частичното стартиране е пълната таблица: (11 + 12) / 2, не само eBag
+    assert summary["last_bgn"] == pytest.approx(11.50)
+    assert summary["change_7d_pct"] == pytest.approx(4.5)
+    assert summary["runs"] == 2
+
+
+def test_text_prices_only_for_selected_products():
+    sources = {}
+    prices = scraper.extract_text_prices(PAGE, "eBag", sources, use_claude=False, product_names={YOGURT})
+
+    assert prices == {YOGURT: 2.79}
+
+
+def test_vision_ranks_unselected_products_as_foreign():
+    cards = [{"name": "Harmonica Био сирене козе 200г", "price": 10.49},
+             {"name": "Harmonica Био кисело мляко 3,6% 400г", "price": 2.79}]
+
+    ranked = scraper.rank_vision_candidates(cards, {}, product_names={YOGURT})
+
+    assert [card['priority'] for card in ranked] == [0, 3]
+    assert ranked[0]['name'].startswith("Harmonica Био кисело мляко")
+
+
+def fake_scrape(prices_by_store, failing):
+    def scrape(page, key, config, vision_client=None, sources=None, currencies=None, product_names=None):
+        if key in failing:
+            raise RuntimeError("page crashed")
+        return dict(prices_by_store.get(key, {}))
+    return scrape
+
+
+@pytest.fixture
+def offline_browser(monkeypatch):
+    from unittest import mock
+    monkeypatch.setitem(sys.modules, "playwright.sync_api", mock.MagicMock())
+    monkeypatch.setattr(scraper, "STEALTH_AVAILABLE", False)
+    monkeypatch.setattr(scraper, "ENABLE_VISUAL_VERIFICATION", False)
+    monkeypatch.setattr(scraper.time, "sleep", lambda seconds: None)
+
+
+def test_failed_store_keeps_base_cells(state, offline_browser, monkeypatch):
+    history = scraper.get_history_store()
+    base = record(history, {"eBag": {GOAT_CHEESE: 10.00}, "Kashon": {GOAT_CHEESE: 12.00}}, datetime.now())
+    monkeypatch.setattr(scraper, "scrape_store", fake_scrape({"eBag": {GOAT_CHEESE: 11.00}}, {"Kashon"}))
+
+    results = {r['name']: r for r in scraper.collect_prices(stores=["eBag", "Kashon"], skip_vision=True)}
+
+    prices = {key: price for key, price in results[GOAT_CHEESE]['prices'].items() if price is not None}
+    assert prices == {"eBag": 11.00, "Kashon": 12.00}
+    run = history.get_run()
+    assert run['base_run_id'] == base
+    assert json.loads(run['scope'])['stores'] == ["eBag"]
+
+
+def test_partial_run_aborts_when_every_store_fails(state, offline_browser, monkeypatch):
+    history = scraper.get_history_store()
+    record(history, {"eBag": {GOAT_CHEESE: 10.00}}, datetime.now())
+    monkeypatch.setattr(scraper, "scrape_store", fake_scrape({}, {"eBag"}))
+
+    with pytest.raises(RuntimeError):
+        scraper.collect_prices(stores=["eBag"], skip_vision=True)
+    assert history.run_count() == 1
@@ -0,0 +1,161 @@
+from datetime import datetime, timedelta
+
+import scraper
+from fake_sheets import FakeSheetsClient
+
+from conftest import sample_matrix
+
+
+def test_publish_syncs_history_from_sink_thread(state, monkeypatch):
+    # Историята се създава в главната нишка, както в collect_prices
+    history = scraper.get_history_store()
+    started = datetime(2026, 9, 7, 9, 0)
+    for week in range(2):
+        history.record_run(sample_matrix(week), started_at=started + timedelta(weeks=week))
+    results = history.results_for_run(history.get_run()['id'])
+
+    client = FakeSheetsClient()
+    monkeypatch.setenv("SPREADSHEET_ID", "fake")
+    monkeypatch.setattr(scraper, "get_sheets_client", lambda: client)
+
+    outcomes = scraper.publish_results(results, [], only=["sheets"])
+
+    assert outcomes["sheets"]["status"] == "ok", outcomes["sheets"]["error"]
+    assert history.unsynced_runs() == []
+    spreadsheet = client.open_by_key("fake")
+    titles = [sheet.title for sheet in spreadsheet.worksheets()]
+    assert scraper.history_tab_name(started) in titles
+    assert scraper.HISTORY_SUMMARY_SHEET_NAME in titles
+    history_tab = spreadsheet.worksheet(scraper.history_tab_name(started))
+    assert len(history_tab.values()) == 1 + 2 * len(scraper.get_catalog())
+
+
+def test_history_failure_fails_sheets_sink(state, monkeypatch):
+    history = scraper.get_history_store()
+    history.record_run(sample_matrix(0))
+    results = history.results_for_run(history.get_run()['id'])
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("history unavailable")
+
+    monkeypatch.setenv("SPREADSHEET_ID", "fake")
+    monkeypatch.setattr(scraper, "get_sheets_client", lambda: FakeSheetsClient())
+    monkeypatch.setattr(scraper, "PUBLISH_SINK_RETRIES", {"sheets": 0})
+    monkeypatch.setattr(history, "unsynced_runs", broken)
+
+    outcomes = scraper.publish_results(results, [], only=["sheets"])
+
+    assert outcomes["sheets"]["status"] == "error"
+    assert "history unavailable" in outcomes["sheets"]["error"]
+
+
+def test_failed_history_tab_does_not_write_earlier_tabs(state, monkeypatch):
+    # Две стартирания в различни тримесечия - два таба с история
+    history = scraper.get_history_store()
+    first, second = datetime(2026, 9, 28, 9, 0), datetime(2026, 10, 5, 9, 0)
+    history.record_run(sample_matrix(0), started_at=first)
+    history.record_run(sample_matrix(1), started_at=second)
+    results = history.results_for_run(history.get_run()['id'])
+
+    append = scraper.append_history_rows
+
+    def fail_second_tab(gateway, spreadsheet_id, tab_name, hist_rows):
+        if tab_name == scraper.history_tab_name(second):
+            raise RuntimeError("quota")
+        append(gateway, spreadsheet_id, tab_name, hist_rows)
+
+    client = FakeSheetsClient()
+    monkeypatch.setenv("SPREADSHEET_ID", "fake")
+    monkeypatch.setattr(scraper, "get_sheets_client", lambda: client)
+    monkeypatch.setattr(scraper, "PUBLISH_SINK_RETRIES", {"sheets": 0})
+    monkeypatch.setattr(scraper, "append_history_rows", fail_second_tab)
+
+    outcomes = scraper.publish_results(results, [], only=["sheets"])
+
+    assert outcomes["sheets"]["status"] == "error"
+    assert len(history.unsynced_runs()) == 2
+    first_tab = client.open_by_key("fake").worksheet(scraper.history_tab_name(first))
+    assert first_tab.values() == []
+
+
+class FakeSMTP:
+    sent = []
+    fail_login = 0
+    fail_send = False
+    fail_quit = False
+
+    def __init__(self, host, port, timeout=None):
+        pass
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        if FakeSMTP.fail_login:
+            FakeSMTP.fail_login -= 1
+            raise OSError("connection reset")
+
+    def send_message(self, msg):
+        FakeSMTP.sent.append(msg['Subject'])
+        if FakeSMTP.fail_send:
+            raise TimeoutError("timed out after DATA")
+
+    def quit(self):
+        if FakeSMTP.fail_quit:
+            raise OSError("quit failed")
+
+    def close(self):
+        pass
+
+
+def publish_email(monkeypatch, **behaviour):
+    import smtplib
+    FakeSMTP.sent = []
+    FakeSMTP.fail_login, FakeSMTP.fail_send, FakeSMTP.fail_quit = 0, False, False
+    for name, value in behaviour.items():
+        setattr(FakeSMTP, name, value)
+    monkeypatch.setattr(smtplib, "SMTP", FakeSMTP)
+    monkeypatch.setattr(scraper.time, "sleep", lambda seconds: None)
+    monkeypatch.setenv("GMAIL_USER", "tracker@example.com")
+    monkeypatch.setenv("GMAIL_APP_PASSWORD", "secret")
+    results = sample_matrix(0).to_results()
+    return scraper.publish_results(results, [], only=["email"])["email"]
+
+
+def test_email_retries_login_failure(state, monkeypatch):
+    outcome = publish_email(monkeypatch, fail_login=1)
+
+    assert outcome["status"] == "ok"
+    assert outcome["attempts"] == 2
+    assert len(FakeSMTP.sent) == 1
+
+
+def test_email_is_not_resent_after_send_error(state, monkeypatch):
+    outcome = publish_email(monkeypatch, fail_send=True)
+
+    assert outcome["status"] == "error"
+    assert len(FakeSMTP.sent) == 1
+
+
+def test_email_quit_error_after_send_is_ok(state, monkeypatch):
+    outcome = publish_email(monkeypatch, fail_quit=True)
+
+    assert outcome["status"] == "ok"
+    assert len(FakeSMTP.sent) == 1
+
+
+def test_timed_out_sink_does_not_block_exit(state, monkeypatch):
+    import threading
+    release = threading.Event()
+    monkeypatch.setattr(scraper, "PUBLISH_SINK_TIMEOUTS", {"export": 0.2})
+    monkeypatch.setattr(scraper, "export_results_json", lambda results, alerts: release.wait(30))
+
+    try:
+        outcome = scraper.publish_results([], [], only=["export"])["export"]
+        hung = [thread for thread in threading.enumerate() if thread.name == "publish-export"]
+    finally:
+        release.set()
+
+    assert outcome["status"] == "timeout"
+    # Изоставената нишка е daemon - интерпретаторът не я чака при изход
+    assert hung and all(thread.daemon for thread in hung)
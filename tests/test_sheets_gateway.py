@@ -0,0 +1,71 @@
+import pytest
+from gspread.exceptions import APIError
+
+import scraper
+from fake_sheets import FakeSheetsClient, api_error
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    monkeypatch.setattr(scraper.time, "sleep", lambda seconds: None)
+    return scraper.SheetsGateway.open(FakeSheetsClient(), "fake")
+
+
+def test_add_worksheet_returns_sheet_created_before_error(gateway, monkeypatch):
+    spreadsheet = gateway.spreadsheet
+    create = spreadsheet.add_worksheet
+
+    def create_then_fail(title, rows, cols):
+        create(title, rows=rows, cols=cols)
+        raise api_error(503, "backend error")
+
+    monkeypatch.setattr(spreadsheet, "add_worksheet", create_then_fail)
+
+    sheet = gateway.add_worksheet("История_2026_Q4", rows=10, cols=5)
+
+    assert sheet.title == "История_2026_Q4"
+    assert [ws.title for ws in spreadsheet.worksheets()] == ["История_2026_Q4"]
+    assert gateway.stats["retries"] == 1
+
+
+def test_call_retries_429_until_success(monkeypatch):
+    client = FakeSheetsClient(error_rate=1.0, error_statuses=(429,), seed=1)
+    delays = []
+
+    def sleep(seconds):
+        # Квотата се освобождава по време на изчакването
+        delays.append(seconds)
+        client.error_rate = 0.0
+
+    monkeypatch.setattr(scraper.time, "sleep", sleep)
+
+    gateway = scraper.SheetsGateway.open(client, "fake")
+
+    assert gateway.spreadsheet.id == "fake"
+    assert client.stats["injected_errors"] == 1
+    assert gateway.stats["retries"] == 1
+    assert 0 <= delays[0] <= scraper.SHEETS_RETRY_BASE_DELAY
+
+
+def test_call_honours_retry_after(gateway, monkeypatch):
+    delays = []
+    monkeypatch.setattr(scraper.time, "sleep", delays.append)
+    responses = iter([api_error(429, "Quota exceeded", {"Retry-After": "7"}), None])
+
+    def read():
+        error = next(responses)
+        if error:
+            raise error
+        return "ok"
+
+    assert gateway.call("read", read) == "ok"
+    assert delays == [7.0]
+
+
+def test_call_does_not_retry_client_errors(gateway):
+    def read():
+        raise api_error(400, "Invalid range")
+
+    with pytest.raises(APIError):
+        gateway.call("read", read)
+    assert gateway.stats["retries"] == 0
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import scraper
+from fake_anthropic import FakeAnthropicServer
+
+PHASE1_PRODUCTS = [
+    {"name": "Harmonica Био сирене козе 200г", "price": 10.49, "currency": "BGN"},
+    {"name": "Harmonica Био лютеница Илиеви 260г", "price": 8.79, "currency": "BGN"},
+    {"name": "Harmonica Био кисело мляко 3,6% 400г", "price": 2.69, "currency": "BGN"},
+    {"name": "Harmonica Био тахан от сусам 700г", "price": 7.99, "currency": "EUR"},
+]
+
+
+class ProgressServer(FakeAnthropicServer):
+    """Fake сървър, който брои изпратените SSE delta-и."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sent = 0
+        self.total = 0
+
+    def stream_events(self, message):
+        text = message["content"][0]["text"]
+        self.total = -(-len(text) // self.stream_chunk_size)
+        for event, data in super().stream_events(message):
+            if event == "content_block_delta":
+                self.sent += 1
+            yield event, data
+
+
+class RecordingMatcher:
+    def __init__(self, matcher, server):
+        self.matcher = matcher
+        self.server = server
+        self.calls = []
+
+    def match(self, extracted_products, **kwargs):
+        self.calls.append((len(extracted_products), self.server.sent))
+        return self.matcher.match(extracted_products, **kwargs)
+
+
+@pytest.mark.skipif(not (scraper.CLAUDE_AVAILABLE and scraper.SCIPY_AVAILABLE), reason="anthropic/scipy")
+@pytest.mark.parametrize("engine", ["ngram", "hybrid"])
+def test_ngram_matching_starts_during_stream(engine, monkeypatch):
+    text = json.dumps(PHASE1_PRODUCTS, ensure_ascii=False)
+    with ProgressServer(default_text=text, stream_chunk_size=20, stream_chunk_delay=0.03) as server:
+        monkeypatch.setenv("ANTHROPIC_API_KEY", "fake")
+        monkeypatch.setenv("ANTHROPIC_BASE_URL", server.base_url)
+        monkeypatch.setattr(scraper, "PHASE2_ENGINE", engine)
+        monkeypatch.setattr(scraper, "PHASE1_STREAMING", True)
+        recorder = RecordingMatcher(scraper.get_ngram_matcher(), server)
+        monkeypatch.setattr(scraper, "get_ngram_matcher", lambda: recorder)
+
+        currencies = {}
+        matched = scraper.extract_prices_with_claude_two_phase("Harmonica", "eBag", currencies)
+
+    # Всеки продукт се съпоставя поотделно, още докато stream-ът тече
+    assert [size for size, _ in recorder.calls] == [1] * len(PHASE1_PRODUCTS)
+    assert recorder.calls[0][1] < server.total
+    assert matched["Био сирене козе"] == 10.49
+    assert currencies["Био сирене козе"] == "BGN"
@@ -0,0 +1,43 @@
+import scraper
+from fake_sheets import FakeSheetsClient
+
+
+def test_changed_cells_coalesce_into_rectangles():
+    cells = [(0, 0), (0, 1), (1, 0), (1, 1), (1, 3), (3, 0), (3, 1)]
+
+    # Ред 2 е празен, затова (3, 0-1) не се слива с горния правоъгълник
+    assert sorted(scraper.coalesce_cells(cells)) == [(0, 2, 0, 2), (1, 2, 3, 4), (3, 4, 0, 2)]
+
+
+def test_diff_writes_only_changed_block():
+    old = [["Продукт", "eBag", "Кашон"], ["Сирене", "10.49", "11.20"], ["Мляко", "2.79", "2.90"]]
+    new = [["Продукт", "eBag", "Кашон"], ["Сирене", "10.99", "11.50"], ["Мляко", "2.89", "2.95"]]
+
+    assert scraper.diff_sheet_values(old, new) == [
+        {"range": "B2:C3", "values": [["10.99", "11.50"], ["2.89", "2.95"]]},
+    ]
+    assert scraper.diff_sheet_values(new, new) == []
+
+
+def test_diff_clears_removed_rows():
+    old = [["a", "b"], ["c", "d"], ["e", "f"]]
+
+    assert scraper.diff_sheet_values(old, [["a", "b"]]) == [{"range": "A2:B3", "values": [["", ""], ["", ""]]}]
+
+
+def test_tracker_formatting_is_skipped_on_the_next_run(monkeypatch):
+    monkeypatch.setattr(scraper.time, "sleep", lambda seconds: None)
+    client = FakeSheetsClient()
+    assert scraper.build_tracker_conditional_rules(7) == scraper.build_tracker_conditional_rules(7)
+
+    first = scraper.SheetsGateway.open(client, "fake")
+    sheet = first.add_worksheet(scraper.TRACKER_SHEET_NAME, rows=10, cols=5)
+    assert scraper.apply_tracker_formatting(first, sheet) > 0
+    first.flush()
+
+    # Ново стартиране: същият отпечатък в developer metadata - нищо не се изпраща
+    second = scraper.SheetsGateway.open(client, "fake")
+    sheet = second.worksheet(scraper.TRACKER_SHEET_NAME)
+    assert scraper.apply_tracker_formatting(second, sheet) == 0
+    assert second.requests == []
+    assert scraper.apply_tracker_formatting(second, sheet, force=True) > 0
@@ -0,0 +1,69 @@
+import pytest
+
+import scraper
+
+OUR_CARD = "Harmonica Био сирене козе 200г\n10,49 лв."
+FOREIGN_CARD = "Шампоан за коса с алое 400мл\n5,99 лв."
+
+
+def discovered(*texts):
+    cards = []
+    for nth, text in enumerate(texts):
+        name, price, currency = scraper.parse_card_text(text)
+        cards.append({"selector": ".card", "nth": nth, "rect": (0, 0, 200, 300), "text": text,
+                      "name": name, "price": price, "currency": currency})
+    return ".card", cards
+
+
+def test_foreign_cards_are_not_captured(state, monkeypatch):
+    captured = []
+    monkeypatch.setattr(scraper, "ENABLE_VISUAL_VERIFICATION", True)
+    monkeypatch.setattr(scraper, "VISION_CAPTURE_MODE", "element")
+    monkeypatch.setattr(scraper, "discover_product_cards", lambda page, selectors: discovered(FOREIGN_CARD, OUR_CARD))
+    monkeypatch.setattr(scraper, "capture_card_screenshot", lambda page, card: captured.append(card['name']))
+
+    scraper.visual_verify_products(object(), object(), "eBag", {})
+
+    assert captured == ["Harmonica Био сирене козе 200г"]
+
+
+def test_only_foreign_cards_skip_vision(state, monkeypatch):
+    monkeypatch.setattr(scraper, "ENABLE_VISUAL_VERIFICATION", True)
+    monkeypatch.setattr(scraper, "discover_product_cards", lambda page, selectors: discovered(FOREIGN_CARD))
+    monkeypatch.setattr(scraper, "capture_card_screenshot", lambda page, card: pytest.fail("captured"))
+
+    assert scraper.visual_verify_products(object(), object(), "eBag", {}) == {}
+
+
+CHEESE_CARD = "Harmonica Био сирене козе 200г\n10,49 лв."
+YOGURT_CARD = "Harmonica Био кисело мляко 3,6% 400г\n2,79 лв."
+LUTENITSA_CARD = "Harmonica Био лютеница Илиеви 260г\n8,79 лв."
+PRODUCT_IDS = {CHEESE_CARD: 3, YOGURT_CARD: 5, LUTENITSA_CARD: 4}
+IMAGE = {"original_bytes": 1, "bytes": 1, "tokens": 1, "media_type": "image/png"}
+
+
+def test_vision_budget_counts_unique_products_and_caches_every_capture(state, monkeypatch):
+    captured, remembered = [], []
+
+    def verify(client, work, store_name, cache=None):
+        return [
+            (dict(card, index=index, image=IMAGE), {"product_id": PRODUCT_IDS[card['text']], "confidence": "high"}, True)
+            for index, card, source in work
+        ]
+
+    monkeypatch.setattr(scraper, "ENABLE_VISUAL_VERIFICATION", True)
+    monkeypatch.setattr(scraper, "VISION_CAPTURE_MODE", "element")
+    monkeypatch.setattr(scraper, "VISION_BATCH_SIZE", 1)
+    monkeypatch.setattr(scraper, "discover_product_cards", lambda page, selectors: discovered(
+        CHEESE_CARD, CHEESE_CARD, YOGURT_CARD, LUTENITSA_CARD, LUTENITSA_CARD))
+    monkeypatch.setattr(scraper, "capture_card_screenshot", lambda page, card: captured.append(card['text']) or b"png")
+    monkeypatch.setattr(scraper, "verify_vision_work_item", verify)
+    monkeypatch.setattr(scraper, "remember_vision_result",
+                        lambda cache, store_name, card, result, accepted: remembered.append(card['text']))
+
+    verified = scraper.visual_verify_products(object(), object(), "eBag", {}, max_verify=2)
+
+    # Втората карта на сиренето не се брои; заснемането спира при покрит бюджет
+    assert set(verified) == {3, 5}
+    assert captured == [CHEESE_CARD, CHEESE_CARD, YOGURT_CARD]
+    assert remembered == captured